@@ -2,19 +2,58 @@
 # Imports
 #----------------------------------------------------------------------------#
 
+import hashlib
+import io
+import mimetypes
+import os
 import json
 import dateutil.parser
 from datetime import *
 import babel
+import babel.dates
+import click
+import random
+import re
 import sys
-from flask import Flask, render_template, request, Response, flash, redirect, url_for
+import threading
+import time
+from collections import Counter, OrderedDict
+from functools import lru_cache
+from bisect import bisect_right, insort
+from itertools import chain, groupby, islice
+from flask import Flask, render_template, request, Response, flash, redirect, url_for, g, stream_with_context, jsonify, abort, make_response, send_file, send_from_directory, safe_join
 from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
+from jinja2 import FileSystemBytecodeCache
 import logging
-from logging import Formatter, FileHandler
+from logging import Formatter
+from logging.handlers import WatchedFileHandler
+from logqueue import QueueLogging
+import atexit
 from flask_wtf import Form
 from forms import *
 from flask_migrate import Migrate
+from sqlalchemy.dialects.postgresql import ARRAY, insert as postgresql_insert
+from sqlalchemy import inspect as inspect_database
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.orm.exc import StaleDataError
+from math import ceil
+from search import SearchIndex, tokenize
+from pagination import keyset_page, InvalidCursor
+from importer import read_records, validate_records, insert_rows
+import sqlstats
+from cache import DetailCache
+import geo
+import ical
+import images
+import synthetic
+import benchmark
+import assets
+from serialize import dumps, select_fields
+import recommend
+import routing
+import sessions
+from routing import RoutingSQLAlchemy, read_only, use_primary
 
 #----------------------------------------------------------------------------#
 # App Config.
@@ -23,31 +62,69 @@ from flask_migrate import Migrate
 app = Flask(__name__)
 moment = Moment(app)
 app.config.from_object('config')
-db = SQLAlchemy(app)
+if not app.config['SECRET_KEY']:
+  app.config['SECRET_KEY'] = sessions.stored_secret_key(app.config['SECRET_KEY_FILE'])
+db = RoutingSQLAlchemy(app)
 migrate = Migrate(app, db)
 
+# read-only views use the replica bind when one is configured
+routing.init_app(app, db)
+
+# query count, database time and N+1 warnings per request
+if app.config['SQL_STATS']:
+  sqlstats.init_app(app)
+
+# trigram indexes back the venue and artist search on Postgres
+db.event.listen(db.metadata, 'before_create',
+    db.DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+# btree_gist lets the show exclusion constraints compare ids with =
+db.event.listen(db.metadata, 'before_create',
+    db.DDL('CREATE EXTENSION IF NOT EXISTS btree_gist').execute_if(dialect='postgresql'))
+
 # TODO: connect to a local postgresql database # DONE
 
 #----------------------------------------------------------------------------#
 # Models.
 #----------------------------------------------------------------------------#
 
+# genres are Postgres arrays; SQLite (local runs, tests) stores them as JSON
+genre_list = ARRAY(db.String).with_variant(db.JSON, 'sqlite')
+
+def search_indexes(tablename):
+    # gin_trgm_ops serves name/city ILIKE '%term%'; genre matches use the array index
+    return (
+        db.Index('ix_%s_name_trgm' % tablename.lower(), 'name',
+            postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
+        db.Index('ix_%s_city_trgm' % tablename.lower(), 'city',
+            postgresql_using='gin', postgresql_ops={'city': 'gin_trgm_ops'}),
+        db.Index('ix_%s_genres' % tablename.lower(), 'genres', postgresql_using='gin'),
+    )
+
 class Venue(db.Model):
     __tablename__ = 'Venue'
+    __table_args__ = search_indexes('Venue')
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String)
-    genres = db.Column(db.ARRAY(db.String()))
+    genres = db.Column(genre_list)
     address = db.Column(db.String(120))
     city = db.Column(db.String(120))
     state = db.Column(db.String(120))
+    # placed from GEOCODE_FILE by city and state unless set explicitly
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
     phone = db.Column(db.String(120))
     image_link = db.Column(db.String(500))
     facebook_link = db.Column(db.String(120))
     website = db.Column(db.String(120))
     seeking_talent = db.Column(db.Boolean)
     seeking_description = db.Column(db.String(500))
+    # set when the venue is deleted; the row stays until its shows are purged
+    deleted_at = db.Column(db.DateTime, index=True)
+    # bumped by every UPDATE, which only applies if the row still has the version it was loaded with
+    version_id = db.Column(db.Integer, nullable=False, server_default='1')
     shows = db.relationship('Show', backref="Venue", lazy='dynamic')
+    __mapper_args__ = {'version_id_col': version_id}
 
     # TODO: implement any missing fields, as a database migration using Flask-Migrate
       # simplify to reusable calls for the API ease
@@ -76,11 +153,11 @@ class Venue(db.Model):
 
 class Artist(db.Model):
     __tablename__ = 'Artist'
-
+    __table_args__ = search_indexes('Artist')
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String)
-    genres = db.Column(db.ARRAY(db.String))
+    genres = db.Column(genre_list)
     city = db.Column(db.String(120))
     state = db.Column(db.String(120))
     phone = db.Column(db.String(120))
@@ -89,7 +166,9 @@ class Artist(db.Model):
     facebook_link = db.Column(db.String(120))
     seeking_venue = db.Column(db.Boolean)
     seeking_description = db.Column(db.String(500))
+    version_id = db.Column(db.Integer, nullable=False, server_default='1')
     shows = db.relationship('Show', backref="Artist", lazy='dynamic')
+    __mapper_args__ = {'version_id_col': version_id}
 
     # TODO: implement any missing fields, as a database migration using Flask-Migrate
       # simplify to reusable calls for the API ease
@@ -118,6 +197,15 @@ class Artist(db.Model):
 
 
 class Show(db.Model):
+    # detail pages read a venue's or an artist's shows in start_time order;
+    # databases created before an index was added get it from `flask upgrade-db`
+    __table_args__ = (
+        db.Index('ix_show_venue_id_start_time', 'venue_id', 'start_time'),
+        db.Index('ix_show_artist_id_start_time', 'artist_id', 'start_time'),
+        # /shows pages through shows in (start_time, id) order
+        db.Index('ix_show_start_time_id', 'start_time', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     artist_id = db.Column(db.Integer, db.ForeignKey(
         'Artist.id'), nullable=False)
@@ -151,117 +239,966 @@ class Show(db.Model):
             'start_time': self.start_time
         }
 
+def create_show_constraints(target, connection, **kw):
+    '''
+    Postgres refuses overlapping shows at a venue or by an artist outright; a
+    show occupies [start_time, start_time + SHOW_DURATION). Runs when the show
+    table is created and from upgrade_schema, which adds the constraints to an
+    existing table; returns the names of the constraints added
+    '''
+    if connection.dialect.name != 'postgresql':
+        return []
+    added = []
+    for column in ('venue_id', 'artist_id'):
+        name = 'show_%s_no_overlap' % column
+        if connection.execute(db.text('SELECT 1 FROM pg_constraint WHERE conname = :name'), name=name).scalar():
+            continue
+        connection.execute(
+            "ALTER TABLE {table} ADD CONSTRAINT {name} EXCLUDE USING gist "
+            "({column} WITH =, tsrange(start_time, start_time + interval '{minutes} minutes') WITH &&)"
+            .format(table=connection.dialect.identifier_preparer.format_table(Show.__table__), name=name,
+                    column=column, minutes=int(app.config['SHOW_DURATION'])))
+        added.append(name)
+    return added
+
+db.event.listen(Show.__table__, 'after_create', create_show_constraints)
+
+
+class ShowRollup(db.Model):
+    # shows per venue and month, kept in step with the show table (see
+    # update_rollups) so /analytics never scans it; city and state are the venue's
+    __table_args__ = (
+        db.Index('ix_show_rollup_month', 'month'),
+    )
+
+    venue_id = db.Column(db.Integer, db.ForeignKey('Venue.id'), primary_key=True)
+    # first day of the month
+    month = db.Column(db.Date, primary_key=True)
+    city = db.Column(db.String(120))
+    state = db.Column(db.String(120))
+    show_count = db.Column(db.Integer, nullable=False)
+
+# /analytics?city= matches the city case-insensitively, like /shows does
+db.Index('ix_show_rollup_lower_city_month', db.func.lower(ShowRollup.city), ShowRollup.month)
+
+class SessionRecord(db.Model):
+    # server-side session data (see sessions.SQLStore), shared by all workers
+    id = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.Text, nullable=False)
+    expires = db.Column(db.DateTime, nullable=False, index=True)
+
+# sessions are written on the primary whatever the request's routing
+session_stores = {
+  'memory': lambda: sessions.MemoryStore(app.config['SESSION_MEMORY_ENTRIES']),
+  'sql': lambda: sessions.SQLStore(lambda: db.get_engine(app), SessionRecord.__table__),
+  'tiered': lambda: sessions.TieredStore(session_stores['memory'](), session_stores['sql']()),
+}
+if app.config['SESSION_BACKEND'] != 'cookie':
+  app.session_interface = sessions.ServerSessionInterface(session_stores[app.config['SESSION_BACKEND']]())
+
+def partition_shows(shows, now):
+    # split show rows into (past, upcoming) in a single pass
+    past_shows = []
+    upcoming_shows = []
+    for show in shows:
+        if show['start_time'] > now:
+            upcoming_shows.append(show)
+        else:
+            past_shows.append(show)
+    return past_shows, upcoming_shows
+
+def genre_filter(model, genres):
+    # rows listing every one of genres; on Postgres an array containment the GIN index serves
+    if db.engine.dialect.name == 'postgresql':
+        return model.genres.contains(db.cast(genres, ARRAY(db.String)))
+    return db.and_(*[db.cast(model.genres, db.Text).like('%' + json.dumps(genre) + '%')
+                     for genre in genres])
+
+def genre_facets(model, *filters):
+    # [(genre, number of matching rows)] from one aggregate over the unnested genre lists
+    if db.engine.dialect.name == 'postgresql':
+        genres = db.session.query(db.func.unnest(model.genres).label('genre')) \
+            .filter(*filters) \
+            .subquery()
+        genre = genres.c.genre
+        query = db.session.query(genre, db.func.count())
+    else:
+        genre = db.literal_column('genre.value')
+        query = db.session.query(genre, db.func.count()) \
+            .select_from(model, db.func.json_each(model.genres).alias('genre')) \
+            .filter(*filters)
+    return query.group_by(genre).order_by(db.func.count().desc(), genre).all()
+
 #----------------------------------------------------------------------------#
 # Filters.
 #----------------------------------------------------------------------------#
 
-def format_datetime(value, format='medium'):
-  date = dateutil.parser.parse(str(value))
-  if format == 'full':
-      format="EEEE MMMM, d, y 'at' h:mma"
-  elif format == 'medium':
-      format="EE MM, dd, y h:mma"
-  return babel.dates.format_datetime(date, format)
+datetime_formats = {
+  'full': "EEEE MMMM, d, y 'at' h:mma",
+  'medium': "EE MM, dd, y h:mma",
+}
+
+@lru_cache(maxsize=64)
+def datetime_pattern(format):
+  # compiled babel pattern for a format name or a custom pattern string
+  return babel.dates.parse_pattern(datetime_formats.get(format, format))
+
+@lru_cache(maxsize=16)
+def babel_locale(locale):
+  return babel.Locale.parse(locale)
+
+@lru_cache(maxsize=4096)
+def cached_format_datetime(value, format, locale, tzinfo=None):
+  # pages render the same show times over and over, so keep recent results.
+  # Every format gets babel.dates.format_datetime's own time zone handling
+  # first: naive values are UTC, and a tzinfo converts them to that zone
+  if value.tzinfo is None:
+    value = value.replace(tzinfo=babel.dates.UTC)
+  if tzinfo is not None:
+    value = value.astimezone(babel.dates.get_timezone(tzinfo))
+  if format in ('long', 'short'):
+    return babel.dates.format_datetime(value, format, locale=locale)
+  return datetime_pattern(format).apply(value, babel_locale(locale))
+
+def format_datetime(value, format='medium', locale=None, tzinfo=None):
+  # model datetimes are used as they are; only strings need parsing
+  if not isinstance(value, datetime):
+    value = dateutil.parser.parse(str(value))
+  return cached_format_datetime(value, format, locale or babel.dates.LC_TIME, tzinfo)
 
 app.jinja_env.filters['datetime'] = format_datetime
 
+# fingerprinted, precompressed static files written by `flask build-assets`
+asset_folder = os.path.join(app.static_folder, 'dist')
+asset_manifest = assets.load_manifest(asset_folder) if app.config['ASSET_PIPELINE'] else {}
+
+def asset_url(filename):
+  # url_for('static', filename=...), but linking the fingerprinted build of the file when there is one
+  if filename in asset_manifest:
+    return url_for('asset', filename=asset_manifest[filename])
+  return url_for('static', filename=filename)
+
+app.jinja_env.globals['asset_url'] = asset_url
+
+def init_templates(flask_app):
+  # compiled templates are kept on disk, so restarts and new workers load bytecode
+  # instead of compiling; with TEMPLATE_PRELOAD every template is loaded right here,
+  # before a preforking server (gunicorn --preload) forks its workers
+  cache_dir = flask_app.config['TEMPLATE_CACHE_DIR']
+  if cache_dir:
+    # a relative directory is kept in the instance folder
+    cache_dir = os.path.join(flask_app.instance_path, cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    flask_app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+  if flask_app.config['TEMPLATE_PRELOAD']:
+    for template_name in flask_app.jinja_env.list_templates():
+      flask_app.jinja_env.get_template(template_name)
+
+init_templates(app)
+
 #----------------------------------------------------------------------------#
 # Controllers.
 #----------------------------------------------------------------------------#
 
+def page_size():
+  # ?per_page= within 1..MAX_PAGE_SIZE
+  per_page = request.args.get('per_page', app.config['PAGE_SIZE'], type=int)
+  return min(max(per_page, 1), app.config['MAX_PAGE_SIZE'])
+
+def cursor_page(query, columns, row_key):
+  # the keyset page at ?after= or ?before=; a cursor that doesn't fit the sort key is a 400
+  try:
+    return keyset_page(query, columns, row_key,
+                       after=request.args.get('after'),
+                       before=request.args.get('before'),
+                       per_page=page_size())
+  except InvalidCursor:
+    abort(400, description='The after or before cursor is not one this listing handed out.')
+
+def stream_template(template_name, **context):
+  # render a template piece by piece as its loops are consumed
+  app.update_template_context(context)
+  template = app.jinja_env.get_template(template_name)
+  stream = template.stream(context)
+  stream.enable_buffering(5)
+  return stream
+
+def selected_genres():
+  # ?genre=Jazz&genre=Blues, limited to the genres the forms offer
+  known = {genre for genre, label in genre_choices}
+  return [genre for genre in request.args.getlist('genre') if genre in known]
+
+def facet_links(endpoint, model, filters, selected):
+  # genre facet counts for the listing, each linking to the listing with that genre toggled
+  facets = []
+  for genre, count in genre_facets(model, *filters):
+    toggled = [other for other in selected if other != genre]
+    if genre not in selected:
+      toggled.append(genre)
+    facets.append({
+      'genre': genre,
+      'count': count,
+      'selected': genre in selected,
+      'url': url_for(endpoint, genre=toggled),
+    })
+  return facets
+
+def request_now():
+  # one "now" per request so every past/upcoming split on a page agrees
+  if 'now' not in g:
+    g.now = datetime.now()
+  return g.now
+
 @app.route('/')
+@read_only
 def index():
   return render_template('pages/home.html')
 
+@app.route('/assets/<path:filename>')
+def asset(filename):
+  # fingerprinted names change with the content, so browsers may keep these for a year
+  # without revalidating; the brotli or gzip copy is sent when the client accepts it
+  mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+  for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+    if request.accept_encodings[encoding] and os.path.isfile(safe_join(asset_folder, filename + suffix)):
+      response = send_from_directory(asset_folder, filename + suffix, mimetype=mimetype)
+      response.headers['Content-Encoding'] = encoding
+      break
+  else:
+    response = send_from_directory(asset_folder, filename, mimetype=mimetype)
+  response.headers['Vary'] = 'Accept-Encoding'
+  response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+  return response
+
+image_models = {'venue': Venue, 'artist': Artist}
+# image links that couldn't be fetched, with the time to try them again; the
+# IMAGE_FAILURE_ENTRIES most recent are kept
+image_failures = OrderedDict()
+image_failures_lock = threading.Lock()
+
+def record_image_failure(key):
+  with image_failures_lock:
+    image_failures[key] = time.time() + app.config['IMAGE_RETRY_SECONDS']
+    image_failures.move_to_end(key)
+    while len(image_failures) > app.config['IMAGE_FAILURE_ENTRIES']:
+      image_failures.popitem(last=False)
+
+@lru_cache(maxsize=None)
+def image_cache(folder, max_bytes):
+  return images.DiskCache(folder, max_bytes)
+
+def link_version(link):
+  return hashlib.sha256(link.encode('utf-8')).hexdigest()[:12]
+
+def image_url(kind, id, link, size):
+  # the proxied thumbnail of a venue's or artist's image_link; ?v= changes with the
+  # link, so a response for the current link can be cached for good
+  if not link or not app.config['IMAGE_PROXY']:
+    return link
+  return url_for('image', kind=kind, id=id, size=size, v=link_version(link))
+
+app.jinja_env.globals['image_url'] = image_url
+
+@app.route('/images/<any(venue, artist):kind>/<int:id>/<size>')
+@read_only
+def image(kind, id, size):
+  # fetches and shrinks the image on first request, then serves it from the disk cache
+  if size not in app.config['IMAGE_SIZES']:
+    abort(404)
+  model = image_models[kind]
+  link = db.session.query(model.image_link) \
+    .filter(model.id == id, *([venue_visible] if model is Venue else [])).scalar()
+  if not link:
+    abort(404)
+  width, height = app.config['IMAGE_SIZES'][size]
+  key = '%dx%d %s' % (width, height, link)
+  if image_failures.get(key, 0) > time.time():
+    abort(404)
+
+  def create():
+    data, content_type = images.fetch(link, app.config['IMAGE_FETCH_TIMEOUT'], app.config['IMAGE_MAX_BYTES'],
+                                      app.config['IMAGE_ALLOW_PRIVATE'])
+    return images.thumbnail(data, content_type, (width, height))
+
+  try:
+    path, digest, mimetype = image_cache(app.config['IMAGE_CACHE_DIR'], app.config['IMAGE_CACHE_BYTES']) \
+      .get_or_create(key, create)
+  except images.ImageError as error:
+    app.logger.warning('image %s: %s', key, error)
+    record_image_failure(key)
+    abort(404)
+  with image_failures_lock:
+    image_failures.pop(key, None)
+
+  response = send_file(path, mimetype=mimetype, add_etags=False)
+  response.set_etag(digest)
+  if request.args.get('v') == link_version(link):
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+  else:
+    response.headers['Cache-Control'] = 'public, max-age=%d' % app.config['IMAGE_MAX_AGE']
+  return response.make_conditional(request)
+
 
 #  Venues
 #  ----------------------------------------------------------------
 
-@app.route('/venues')
-def venues():
-  # TODO: replace with real venues data.
-  #       num_shows should be aggregated based on number of upcoming shows per venue.
-
-    # determine the time, grab the venues, setup empty string and array
-  current_time = datetime.now().strftime('%Y-%m-%d %H:%S:%M')
-  venues = Venue.query.group_by(Venue.id, Venue.state, Venue.city).all()
-  venue_state_and_city = ''
-  venue_data = []
-
-  # loop through venues to check for upcoming shows, city, states and venue information
-  for venue in venues:
-
-    # filter upcoming shows to check if show has already passed
-    current_shows = venue.shows.filter(Show.start_time > current_time).all()
-      # if the venue and state are 
-    if venue_state_and_city == venue.city + venue.state:
-      venue_data[len(venue_data) - 1]["venues"].append({
-        "id": venue.id,
-        "name":venue.name,
-        "num_upcoming_shows": len(current_shows) # a count of the number of shows
-      })
-      # organize data by city and state (area) if not already done
+detail_cache = DetailCache(app.config['DETAIL_CACHE_SIZE'], app.config['DETAIL_CACHE_TTL'])
+
+def detail_page(kind, id):
+  '''
+  the cached venue or artist page payload, loaded on a miss from the primary:
+  misses follow invalidations, just when a replica is likeliest to be behind
+  '''
+  def load():
+    with use_primary():
+      return venue_page(id) if kind == 'venue' else artist_page(id)
+  return detail_cache.get(kind, id, load)
+
+def invalidate_pages(venue_ids=(), artist_ids=()):
+  # drop cached detail pages; call after the change is committed
+  for venue_id in venue_ids:
+    detail_cache.invalidate('venue', int(venue_id))
+  for artist_id in artist_ids:
+    detail_cache.invalidate('artist', int(artist_id))
+
+# deleted venues are hidden everywhere while their shows are being purged
+venue_visible = Venue.deleted_at.is_(None)
+
+places = geo.load_places(app.config['GEOCODE_FILE'])
+
+def geocode(city, state):
+  # (latitude, longitude) of the city in GEOCODE_FILE, (None, None) when it isn't listed
+  return places.get(geo.place_key(city, state), (None, None))
+
+def locate_rows(rows):
+  # bulk-inserted venue rows get the location the ORM would give them
+  for row in rows:
+    if row.get('latitude') is None:
+      row['latitude'], row['longitude'] = geocode(row.get('city'), row.get('state'))
+  return rows
+
+@db.event.listens_for(Venue, 'before_insert')
+@db.event.listens_for(Venue, 'before_update')
+def locate_venue(mapper, connection, venue):
+  # a new or moved venue is placed in its city, unless its coordinates were set as well
+  state = db.inspect(venue)
+  moved = state.attrs.city.history.has_changes() or state.attrs.state.history.has_changes()
+  placed = state.attrs.latitude.history.has_changes() or state.attrs.longitude.history.has_changes()
+  if moved and not placed:
+    venue.latitude, venue.longitude = geocode(venue.city, venue.state)
+
+def geocode_venues(everything=False):
+  '''
+  places venues without a location (every venue with everything=True) with
+  one UPDATE per city; returns the number of venues placed
+  '''
+  placed = 0
+  for city, state in db.session.query(Venue.city, Venue.state).filter(venue_visible).distinct().all():
+    latitude, longitude = geocode(city, state)
+    if latitude is None:
+      continue
+    filters = [Venue.city == city, Venue.state == state]
+    if not everything:
+      filters.append(Venue.latitude.is_(None))
+    placed += Venue.query.filter(*filters).update(
+      {'latitude': latitude, 'longitude': longitude, 'version_id': Venue.version_id + 1},
+      synchronize_session=False)
+  db.session.commit()
+  return placed
+
+def page_details(page):
+  # a cached detail page's details, with its shows split into past and upcoming as of this request
+  details = dict(page['details'])
+  past_shows, upcoming_shows = partition_shows(page['shows'], request_now())
+  details["upcoming_shows"] = upcoming_shows
+  details["upcoming_shows_count"] = len(upcoming_shows)
+  details["past_shows"] = past_shows
+  details["past_shows_count"] = len(past_shows)
+  return details
+
+def booked_artist_ids(venue_id):
+  return [id for id, in db.session.query(Show.artist_id).filter(Show.venue_id == venue_id).distinct()]
+
+def booked_venue_ids(artist_id):
+  return [id for id, in db.session.query(Show.venue_id).filter(Show.artist_id == artist_id).distinct()]
+
+def venue_areas(now, *filters):
+  # one grouped query: every venue with its city, state and upcoming show count
+  num_upcoming_shows = db.func.count(Show.id).label('num_upcoming_shows')
+  rows = db.session.query(Venue.city, Venue.state, Venue.id, Venue.name, num_upcoming_shows) \
+    .outerjoin(Show, db.and_(Show.venue_id == Venue.id, Show.start_time > now)) \
+    .filter(venue_visible, *filters) \
+    .group_by(Venue.id) \
+    .order_by(Venue.state, Venue.city, Venue.id) \
+    .all()
+
+  # rows come back sorted by area, so organize data by city and state in one pass
+  areas = []
+  for (city, state), area_rows in groupby(rows, key=lambda row: (row.city, row.state)):
+    areas.append({
+      "city": city,
+      "state": state,
+      "venues": [{
+        "id": row.id,
+        "name": row.name,
+        "num_upcoming_shows": row.num_upcoming_shows
+      } for row in area_rows]
+    })
+  return areas
+
+
+class AreaIndex:
+  # precomputed /venues payload, rebuilt after a venue or show change is committed,
+  # when the next upcoming show starts (its count moves to past) or after AREA_INDEX_TTL
+  # seconds, which bounds staleness for writes handled by other worker processes
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.generation = 0
+    self.areas = None
+    self.expires = None
+
+  def invalidate(self):
+    with self.lock:
+      self.generation += 1
+      self.areas = None
+
+  def get(self, now):
+    with self.lock:
+      generation, areas, expires = self.generation, self.areas, self.expires
+    if areas is not None and now < expires:
+      return areas
+
+    # a replica that lags would leave a commit out of the index for its whole lifetime
+    with use_primary():
+      areas = venue_areas(now)
+      next_show = db.session.query(db.func.min(Show.start_time)).filter(Show.start_time > now).scalar()
+    expires = now + timedelta(seconds=app.config['AREA_INDEX_TTL'])
+    if next_show is not None:
+      expires = min(expires, next_show)
+
+    with self.lock:
+      # don't store a payload built while a change was being committed
+      if generation == self.generation:
+        self.areas, self.expires = areas, expires
+    return areas
+
+area_index = AreaIndex()
+
+
+class ModelSearch:
+  # ranked, paginated search over name, genres and city: trigram and genre array
+  # indexes on Postgres, an in-process inverted index on other databases
+  weights = {'name': 3.0, 'genres': 2.0, 'city': 1.0}
+
+  def __init__(self, model, *filters):
+    self.model = model
+    self.filters = filters
+    self.lock = threading.Lock()
+    self.index = None
+
+  def document(self, obj):
+    # None takes a (soft-)deleted row out of the index
+    if getattr(obj, 'deleted_at', None) is not None:
+      return None
+    return obj.simple(), {'name': obj.name, 'genres': obj.genres, 'city': obj.city}
+
+  def apply(self, doc_id, document):
+    # waits for an index build in progress so a committed change is never lost
+    with self.lock:
+      if self.index is None:
+        return
+      if document is None:
+        self.index.remove(doc_id)
+      else:
+        self.index.add(doc_id, *document)
+
+  def invalidate(self):
+    with self.lock:
+      self.index = None
+
+  def memory_index(self):
+    with self.lock:
+      if self.index is None:
+        index = SearchIndex(self.weights)
+        query = self.model.query.filter(*self.filters)
+        columns = ['id', 'name', 'genres', 'city']
+        # document() reads deleted_at; leaving it out would load it row by row
+        if hasattr(self.model, 'deleted_at'):
+          columns.append('deleted_at')
+        with use_primary():
+          for obj in query.options(db.load_only(*columns)):
+            index.add(obj.id, *self.document(obj))
+        self.index = index
+      return self.index
+
+  def search(self, search_term, page=1):
+    per_page = app.config['SEARCH_PAGE_SIZE']
+    offset = (page - 1) * per_page
+    if db.engine.dialect.name == 'postgresql':
+      count, data = self.search_database(search_term, offset, per_page)
     else:
-      venue_state_and_city == venue.city + venue.state
-      venue_data.append({
-            "city":venue.city,
-            "state":venue.state,
-            "venues": [{
-              "id": venue.id,
-              "name":venue.name,
-              "num_upcoming_shows": len(current_shows)
-            }]
-      })
-
+      count, data = self.memory_index().search(search_term, offset, per_page)
+    return {
+      "count": count,
+      "data": data,
+      "page": page,
+      "pages": ceil(count / per_page),
+    }
+
+  def search_database(self, search_term, offset, limit):
+    model = self.model
+    query = model.query.filter(*self.filters)
+    ranks = []
+    # every term has to match the name, the city or one of the genres
+    for term in tokenize(search_term):
+      pattern = '%' + term.replace('_', '\\_') + '%'
+      matches = [model.name.ilike(pattern, escape='\\'), model.city.ilike(pattern, escape='\\')]
+      ranks.append(3 * db.func.word_similarity(term, db.func.coalesce(model.name, '')))
+      ranks.append(db.func.word_similarity(term, db.func.coalesce(model.city, '')))
+      genres = [genre for genre, label in genre_choices
+                if any(token.startswith(term) for token in tokenize(genre))]
+      if genres:
+        genre_match = model.genres.overlap(db.cast(genres, ARRAY(db.String)))
+        matches.append(genre_match)
+        ranks.append(db.case([(genre_match, 2.0)], else_=0.0))
+      query = query.filter(db.or_(*matches))
+
+    count = query.count()
+    if ranks:
+      query = query.order_by(sum(ranks).desc())
+    rows = query.order_by(model.name).offset(offset).limit(limit).all()
+    return count, [row.simple() for row in rows]
+
+venue_search = ModelSearch(Venue, venue_visible)
+artist_search = ModelSearch(Artist)
+
+
+class NearbyIndex:
+  # grid index of the visible venues that have a location, built on first use
+  # and kept current by committed changes like the search indexes
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.index = None
+
+  def document(self, venue):
+    if venue.deleted_at is not None or venue.latitude is None or venue.longitude is None:
+      return None
+    return venue.latitude, venue.longitude
+
+  def apply(self, doc_id, document):
+    with self.lock:
+      if self.index is None:
+        return
+      if document is None:
+        self.index.remove(doc_id)
+      else:
+        self.index.add(doc_id, *document)
+
+  def invalidate(self):
+    with self.lock:
+      self.index = None
+
+  def grid(self):
+    with self.lock:
+      if self.index is None:
+        index = geo.GridIndex()
+        with use_primary():
+          for id, latitude, longitude in db.session.query(Venue.id, Venue.latitude, Venue.longitude) \
+              .filter(venue_visible, Venue.latitude.isnot(None), Venue.longitude.isnot(None)):
+            index.add(id, latitude, longitude)
+        self.index = index
+      return self.index
+
+venue_locations = NearbyIndex()
+# in-process indexes of each model, refreshed after commits
+model_indexes = {Venue: [venue_search, venue_locations], Artist: [artist_search]}
+
+
+class Suggestions:
+  # the in-memory recommender, built on first use and then kept current by
+  # committed changes: new venues, artists and shows are applied in place.
+  # Anything else (edited genres, deletions, bulk writes) marks it stale, and a
+  # stale recommender keeps serving until no such change has come in for
+  # SUGGESTION_REBUILD_DELAY seconds (or it has been stale for ten times that),
+  # so an import or a purge committing batch after batch costs one rebuild at
+  # the end instead of one per batch. One thread builds at a time; the others
+  # wait for its result.
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.build_lock = threading.Lock()
+    self.generation = 0
+    self.recommender = None
+    # time.monotonic() of the first and the latest change the recommender is
+    # missing; stale_since is None while it is current
+    self.stale_since = None
+    self.changed_at = None
+
+  def enabled(self):
+    return recommend.numpy is not None and app.config['SUGGESTION_COUNT'] > 0
+
+  def clear(self):
+    # drop the recommender now, e.g. when the whole catalog is replaced
+    with self.lock:
+      self.generation += 1
+      self.recommender = None
+      self.stale_since = self.changed_at = None
+
+  def invalidate(self):
+    with self.lock:
+      self.generation += 1
+      self.mark_stale()
+
+  def mark_stale(self):
+    # called with self.lock held
+    self.changed_at = time.monotonic()
+    if self.stale_since is None:
+      self.stale_since = self.changed_at
+
+  def apply(self, kind, *args):
+    with self.lock:
+      self.generation += 1
+      if self.recommender is None:
+        return
+      if kind == 'venue':
+        self.recommender.add_venue(*args)
+      elif kind == 'artist':
+        self.recommender.add_artist(*args)
+      elif not self.recommender.add_show(*args):
+        self.mark_stale()
+
+  def current(self):
+    # the recommender to use as it is, or None when it has to be (re)built first
+    with self.lock:
+      if self.recommender is None:
+        return None
+      if self.stale_since is not None:
+        now, delay = time.monotonic(), app.config['SUGGESTION_REBUILD_DELAY']
+        if now - self.changed_at >= delay or now - self.stale_since >= 10 * delay:
+          return None
+      return self.recommender
+
+  def build(self):
+    recommender = self.current()
+    if recommender is not None:
+      return recommender
+    with self.build_lock:
+      # another thread may have built it while this one waited
+      recommender = self.current()
+      if recommender is not None:
+        return recommender
+      with self.lock:
+        generation = self.generation
+      with use_primary():
+        recommender = recommend.Recommender(
+          [genre for genre, label in genre_choices],
+          db.session.query(Venue.id, Venue.genres).filter(venue_visible),
+          db.session.query(Artist.id, Artist.genres),
+          db.session.query(Show.venue_id, Show.artist_id, db.func.count()).group_by(Show.venue_id, Show.artist_id))
+      with self.lock:
+        self.recommender = recommender
+        self.stale_since = self.changed_at = None
+        if generation != self.generation:
+          # changes committed during the build may be missing from it
+          self.mark_stale()
+    return recommender
+
+  def suggest(self, method, id, exclude):
+    recommender = self.build()
+    with self.lock:
+      return getattr(recommender, method)(id, app.config['SUGGESTION_COUNT'], exclude)
+
+suggestions = Suggestions()
+
+def suggested(model, scored, *filters):
+  # name and image of each suggested venue or artist, best first, in one query
+  if not scored:
+    return []
+  rows = {row.id: row for row in db.session.query(model.id, model.name, model.image_link)
+          .filter(model.id.in_([id for id, score in scored]), *filters)}
+  return [rows[id]._asdict() for id, score in scored if id in rows]
+
+def suggested_artists(venue_id, shows):
+  # artists like the ones the venue lists and books, leaving out those it has booked;
+  # part of the cached venue page, so a page served from the cache runs no query
+  if not suggestions.enabled():
+    return []
+  booked = {show['artist_id'] for show in shows}
+  return suggested(Artist, suggestions.suggest('artists_for_venue', venue_id, booked))
+
+def suggested_venues(artist_id, shows):
+  if not suggestions.enabled():
+    return []
+  booked = {show['venue_id'] for show in shows}
+  return suggested(Venue, suggestions.suggest('venues_for_artist', artist_id, booked), venue_visible)
+
+
+#  Change tracking
+#  ----------------------------------------------------------------
+#  in-process indexes are refreshed only once the change is committed
+
+def session_changes(session):
+  return session.info.setdefault('changes', {'models': set(), 'indexes': [], 'suggestions': []})
+
+@db.event.listens_for(db.session, 'after_flush')
+def track_changes(session, flush_context):
+  changes = session_changes(session)
+  for obj in chain(session.new, session.dirty):
+    changes['models'].add(type(obj))
+    for index in model_indexes.get(type(obj), ()):
+      changes['indexes'].append((index, obj.id, index.document(obj)))
+  for obj in session.deleted:
+    changes['models'].add(type(obj))
+    for index in model_indexes.get(type(obj), ()):
+      changes['indexes'].append((index, obj.id, None))
+  track_suggestion_changes(session, changes['suggestions'])
+
+def track_suggestion_changes(session, changes):
+  # None means the recommender has to be rebuilt
+  shows = []
+  for obj in session.new:
+    if isinstance(obj, Venue) and obj.deleted_at is None:
+      changes.append(('venue', obj.id, obj.genres))
+    elif isinstance(obj, Artist):
+      changes.append(('artist', obj.id, obj.genres))
+    elif isinstance(obj, Show):
+      shows.append(('show', obj.venue_id, obj.artist_id))
+  # after the venues and artists they may refer to
+  changes.extend(shows)
+  for obj in session.dirty:
+    state = db.inspect(obj)
+    if isinstance(obj, Show) or (isinstance(obj, (Venue, Artist)) and (
+        state.attrs.genres.history.has_changes() or
+        (isinstance(obj, Venue) and state.attrs.deleted_at.history.has_changes()))):
+      changes.append(None)
+  if any(isinstance(obj, (Venue, Artist, Show)) for obj in session.deleted):
+    changes.append(None)
+
+def track_bulk_change(session, model):
+  # rows written by a bulk statement are unknown, so indexes are rebuilt on next use
+  changes = session_changes(session)
+  changes['models'].add(model)
+  for index in model_indexes.get(model, ()):
+    changes['indexes'].append((index, None, None))
+  if model in (Venue, Artist, Show):
+    changes['suggestions'].append(None)
+
+@db.event.listens_for(db.session, 'after_bulk_delete')
+@db.event.listens_for(db.session, 'after_bulk_update')
+def track_bulk_query(query_context):
+  track_bulk_change(query_context.session, query_context.mapper.class_)
+
+@db.event.listens_for(db.session, 'after_commit')
+def refresh_indexes(session):
+  changes = session.info.pop('changes', None)
+  if not changes:
+    return
+  if changes['models'] & {Venue, Show}:
+    area_index.invalidate()
+  for index, doc_id, document in changes['indexes']:
+    if doc_id is None:
+      index.invalidate()
+    else:
+      index.apply(doc_id, document)
+  for change in changes['suggestions']:
+    if change is None:
+      suggestions.invalidate()
+    else:
+      suggestions.apply(*change)
 
-  return render_template('pages/venues.html', areas=venue_data)
+@db.event.listens_for(db.session, 'after_rollback')
+def discard_changes(session):
+  session.info.pop('changes', None)
 
-@app.route('/venues/search', methods=['POST'])
-def search_venues():
-  # TODO: implement search on artists with partial string search. Ensure it is case-insensitive.
-  # seach for Hop should return "The Musical Hop".
-  # search for "Music" should return "The Musical Hop" and "Park Square Live Music & Coffee"
-
-  # search_term = request.form.get('search_term')
-  venue_query = Venue.query.filter(Venue.name.ilike('%' + request.form['search_term'] + '%'))
-    # compare the search term query to the simple venue json
-  venue_list = list(map(Venue.simple, venue_query))
-
- 
-  response = {
-    "count":len(venue_list),
-    "data": venue_list
-  }
-  return render_template('pages/search_venues.html', 
-                          results=response, 
-                          search_term=request.form.get('search_term', ''))
-
-@app.route('/venues/<int:venue_id>')
-def show_venue(venue_id):
-  # shows the venue page with the given venue_id
-  # TODO: replace with real venue  data from the venues table, using venue_id
-  
 
+#  Rollups
+#  ----------------------------------------------------------------
+#  show_rollup is written in the transaction that adds or removes the shows it counts
+
+def show_month(start_time):
+  return date(start_time.year, start_time.month, 1)
+
+def update_rollups(connection, shows, sign=1):
+  '''
+  adds shows, as (venue_id, start_time) pairs, to their venues' monthly
+  counts, or takes them away with sign=-1. Deleted venues have no rollups.
+  '''
+  deltas = Counter((venue_id, show_month(start_time)) for venue_id, start_time in shows)
+  if not deltas:
+    return
+  table = ShowRollup.__table__
+  key = db.and_(table.c.venue_id == db.bindparam('key_venue_id'), table.c.month == db.bindparam('key_month'))
+  # sorted, so concurrent transactions lock the rows in the same order
+  keys = sorted(deltas)
+  if sign < 0:
+    connection.execute(table.update().where(key).values(show_count=table.c.show_count - db.bindparam('shows')),
+                       [{'key_venue_id': venue_id, 'key_month': month, 'shows': deltas[venue_id, month]}
+                        for venue_id, month in keys])
+    connection.execute(table.delete().where(db.and_(key, table.c.show_count <= 0)),
+                       [{'key_venue_id': venue_id, 'key_month': month} for venue_id, month in keys])
+    return
+
+  venues = {row.id: row for row in connection.execute(
+    db.select([Venue.id, Venue.city, Venue.state])
+    .where(db.and_(Venue.id.in_({venue_id for venue_id, month in keys}), venue_visible)))}
+  rows = [{'venue_id': venue_id, 'month': month, 'city': venues[venue_id].city,
+           'state': venues[venue_id].state, 'show_count': deltas[venue_id, month]}
+          for venue_id, month in keys if venue_id in venues]
+  if not rows:
+    return
+  if connection.dialect.name == 'postgresql':
+    insert = postgresql_insert(table).values(rows)
+    connection.execute(insert.on_conflict_do_update(
+      index_elements=[table.c.venue_id, table.c.month],
+      set_={'show_count': table.c.show_count + insert.excluded.show_count}))
+    return
+  # other databases: add to the months that have a row, then insert the rest
+  for row in rows:
+    updated = connection.execute(table.update().where(key).values(show_count=table.c.show_count + row['show_count']),
+                                 key_venue_id=row['venue_id'], key_month=row['month'])
+    if not updated.rowcount:
+      connection.execute(table.insert(), row)
+
+@db.event.listens_for(db.session, 'after_flush')
+def track_rollups(session, flush_context):
+  # shows added or deleted through the session, and venue moves and deletions
+  connection = session.connection()
+  update_rollups(connection, [(obj.venue_id, obj.start_time) for obj in session.new if isinstance(obj, Show)])
+  update_rollups(connection, [(obj.venue_id, obj.start_time) for obj in session.deleted if isinstance(obj, Show)],
+                 sign=-1)
+  table = ShowRollup.__table__
+  for venue in session.dirty:
+    if not isinstance(venue, Venue):
+      continue
+    state = db.inspect(venue)
+    if venue.deleted_at is not None and state.attrs.deleted_at.history.has_changes():
+      # analytics leave a deleted venue out at once, before its shows are purged
+      connection.execute(table.delete().where(table.c.venue_id == venue.id))
+    elif state.attrs.city.history.has_changes() or state.attrs.state.history.has_changes():
+      connection.execute(table.update().where(table.c.venue_id == venue.id)
+                         .values(city=venue.city, state=venue.state))
+
+def backfill_rollups():
+  # rebuilds every rollup from the show table in one transaction; returns the rows written
+  if db.engine.dialect.name == 'postgresql':
+    month = db.cast(db.func.date_trunc('month', Show.start_time), db.Date)
+  else:
+    month = db.func.date(Show.start_time, 'start of month')
+  table = ShowRollup.__table__
+  counts = db.select([Show.venue_id, month, Venue.city, Venue.state, db.func.count()]) \
+    .select_from(Show.__table__.join(Venue.__table__, Show.venue_id == Venue.id)) \
+    .where(venue_visible) \
+    .group_by(Show.venue_id, month, Venue.city, Venue.state)
+  db.session.execute(table.delete())
+  db.session.execute(table.insert().from_select(
+    ['venue_id', 'month', 'city', 'state', 'show_count'], counts))
+  db.session.commit()
+  return db.session.query(ShowRollup).count()
+
+
+def listed_areas(genres, filters):
+  # the precomputed area index serves the unfiltered listing
+  if app.config['AREA_INDEX'] and not genres:
+    return area_index.get(request_now())
+  return venue_areas(request_now(), *filters)
 
-  venue_query = Venue.query.get(venue_id)
-  # 
-  if venue_query:
-    venue_details = Venue.details(venue_query)
-    current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+@app.route('/venues')
+@read_only
+def venues():
+  # num_shows is aggregated based on number of upcoming shows per venue
+  genres = selected_genres()
+  filters = [genre_filter(Venue, genres)] if genres else []
+  venue_data = listed_areas(genres, filters)
 
-    new_shows_query = Show.query.options(db.joinedload(Show.Venue)).filter(Show.venue_id == venue_id).filter(Show.start_time > current_time).all()
-    new_show = list(map(Show.show_artist, new_shows_query))
+  return render_template('pages/venues.html', areas=venue_data,
+                          facets=facet_links('venues', Venue, [venue_visible] + filters, genres))
 
-    venue_details["upcoming_shows"] = new_show
-    venue_details["upcoming_shows_count"] = len(new_show)
+@app.route('/venues/search', methods=['GET', 'POST'])
+@read_only
+def search_venues():
+  # ranked search on venue name, genres and city; terms match word prefixes
+  # case-insensitively, so "Hop" and "music" both find "The Musical Hop"
+  search_term = request.values.get('search_term', '')
+  page = max(request.args.get('page', 1, type=int), 1)
+  response = venue_search.search(search_term, page)
+  return render_template('pages/search_venues.html',
+                          results=response,
+                          search_term=search_term)
+
+def nearby_venues():
+  '''
+  the ?limit= (NEARBY_COUNT) venues nearest ?lat= and ?lng= within ?radius=
+  km, from the grid index, with their upcoming show counts
+  '''
+  latitude = request.args.get('lat', type=float)
+  longitude = request.args.get('lng', type=float)
+  if latitude is None or longitude is None or not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+    abort(400, description='lat and lng must be a latitude and a longitude in degrees.')
+  radius = request.args.get('radius', app.config['NEARBY_RADIUS_KM'], type=float)
+  if not 0 < radius <= app.config['NEARBY_MAX_RADIUS_KM']:
+    abort(400, description='radius must be more than 0 and at most %s km.' % app.config['NEARBY_MAX_RADIUS_KM'])
+  limit = min(max(request.args.get('limit', app.config['NEARBY_COUNT'], type=int), 1), app.config['MAX_PAGE_SIZE'])
+
+  nearest = venue_locations.grid().nearest(latitude, longitude, radius, limit)
+  rows = {}
+  if nearest:
+    num_upcoming_shows = db.func.count(Show.id).label('num_upcoming_shows')
+    rows = {row.id: row for row in db.session.query(
+        Venue.id, Venue.name, Venue.address, Venue.city, Venue.state, num_upcoming_shows) \
+      .outerjoin(Show, db.and_(Show.venue_id == Venue.id, Show.start_time > request_now())) \
+      .filter(Venue.id.in_([venue_id for distance, venue_id in nearest]), venue_visible) \
+      .group_by(Venue.id)}
+  return {
+    'lat': latitude,
+    'lng': longitude,
+    'radius': radius,
+    'venues': [dict(rows[venue_id]._asdict(), distance_km=round(distance, 2))
+               for distance, venue_id in nearest if venue_id in rows],
+  }
 
-    past_shows_query = Show.query.options(db.joinedload(Show.Venue)).filter(Show.venue_id == venue_id).filter(Show.start_time <= current_time).all()
-    past_shows = list(map(Show.show_artist, past_shows_query))
+@app.route('/venues/nearby')
+@read_only
+def venues_nearby():
+  # venues closest to a point; without ?lat= and ?lng= only the form is shown
+  results = nearby_venues() if 'lat' in request.args or 'lng' in request.args else None
+  return render_template('pages/nearby_venues.html', results=results,
+                         radius=request.args.get('radius', app.config['NEARBY_RADIUS_KM']))
 
-    venue_details["past_shows"] = past_shows
-    venue_details["past_shows_count"] = len(past_shows)
+def venue_page(venue_id):
+  # venue details and every show at the venue, the part of the page that only changes on writes
+  venue_query = Venue.query.get(venue_id)
+  if venue_query is None or venue_query.deleted_at is not None:
+    return None
+
+  # one query for every show at the venue with the artist columns the page needs
+  shows_query = db.session.query(
+      Show.start_time,
+      Show.artist_id,
+      Artist.name.label('artist_name'),
+      Artist.image_link.label('artist_image_link')) \
+    .join(Artist, Show.artist_id == Artist.id) \
+    .filter(Show.venue_id == venue_id) \
+    .order_by(Show.start_time) \
+    .all()
+  shows = [row._asdict() for row in shows_query]
+  return {
+    'details': Venue.details(venue_query),
+    'shows': shows,
+    'suggested': suggested_artists(venue_id, shows),
+  }
 
-    return render_template('pages/show_venue.html', venue=venue_details)
+@app.route('/venues/<int:venue_id>')
+@read_only
+def show_venue(venue_id):
+  # shows the venue page with the given venue_id, served from the detail cache when possible
+  page = detail_page('venue', venue_id)
+  if page:
+    return render_template('pages/show_venue.html', venue=page_details(page),
+                           suggested_artists=page['suggested'])
   return render_template('errors/404.html')
 
 #  Create Venue
@@ -322,86 +1259,197 @@ def create_venue_submission():
 
 
 
-@app.route('/venues/<venue_id>', methods=['DELETE'])
+@app.route('/venues/<int:venue_id>', methods=['DELETE'])
 def delete_venue(venue_id):
   # TODO: Complete this endpoint for taking a venue_id, and using
   # SQLAlchemy ORM to delete a record. Handle cases where the session commit could fail.
+  # the venue is soft-deleted, which hides it at once; its shows are purged afterwards
+  venue = Venue.query.filter(Venue.id == venue_id, venue_visible).first()
+  if venue is None:
+    return jsonify({'success': False}), 404
+  error = False
   try:
-    Venue.query.filter_by(id=venue_id).delete()
+    artist_ids = booked_artist_ids(venue_id)
+    venue.deleted_at = datetime.now()
     db.session.commit()
   except:
-    db.session.rollback() 
+    error = True
+    db.session.rollback()
+    print(sys.exc_info())
   finally:
     db.session.close()
+  if error:
+    return jsonify({'success': False}), 500
+
+  # only this worker's caches; other workers keep showing the venue on its and
+  # its artists' cached pages for up to DETAIL_CACHE_TTL (AREA_INDEX_TTL on /venues)
+  invalidate_pages(venue_ids=[venue_id], artist_ids=artist_ids)
+  if app.config['PURGE_IN_BACKGROUND']:
+    start_purge(venue_id)
   # BONUS CHALLENGE: Implement a button to delete a Venue on a Venue Page, have it so that
   # clicking that button delete it from the db then redirect the user to the homepage
-  return None
+  return jsonify({'success': True})
+
+def purge_venue(venue_id):
+  '''
+  deletes a soft-deleted venue's shows PURGE_BATCH_SIZE at a time, each batch in
+  its own short transaction so bookings at other venues never wait on it, then
+  the venue itself; returns the number of shows deleted. Deleting the venue is
+  tried PURGE_RETRIES times before its IntegrityError is raised
+  '''
+  purged = 0
+  attempts = 0
+  while True:
+    show_ids = [id for id, in db.session.query(Show.id)
+                .filter(Show.venue_id == venue_id)
+                .limit(app.config['PURGE_BATCH_SIZE'])]
+    if show_ids:
+      Show.query.filter(Show.id.in_(show_ids)).delete(synchronize_session=False)
+      db.session.commit()
+      purged += len(show_ids)
+      time.sleep(app.config['PURGE_BATCH_PAUSE'])
+      continue
+    try:
+      ShowRollup.query.filter(ShowRollup.venue_id == venue_id).delete(synchronize_session=False)
+      Venue.query.filter(Venue.id == venue_id, Venue.deleted_at.isnot(None)) \
+        .delete(synchronize_session=False)
+      db.session.commit()
+      return purged
+    except IntegrityError:
+      # a show was booked while the delete was committing; purge it too. Anything
+      # else still pointing at the venue fails the same way every time
+      db.session.rollback()
+      attempts += 1
+      if attempts >= app.config['PURGE_RETRIES']:
+        raise
+
+def start_purge(venue_id):
+  def run():
+    with app.app_context():
+      try:
+        purge_venue(venue_id)
+      except Exception:
+        app.logger.exception('purging venue %s failed, `flask purge-venues` will retry it', venue_id)
+      finally:
+        db.session.remove()
+
+  thread = threading.Thread(target=run, name='purge-venue-%s' % venue_id, daemon=True)
+  thread.start()
+  return thread
 
 #  Artists
 #  ----------------------------------------------------------------
+def artist_listing(filters):
+  artist_query = Artist.query.options(db.load_only('id', 'name')).filter(*filters)
+  return cursor_page(artist_query, [Artist.id], lambda artist: (artist.id,))
+
 @app.route('/artists')
+@read_only
 def artists():
-  # TODO: replace with real data returned from querying the database
-  #query all artists in the database
-  artist_query = Artist.query.all()
-  #data = list(map(Artist.short, artist_query))
-  return render_template('pages/artists.html', artists=artist_query)
+  # one keyset page of artists in id order
+  genres = selected_genres()
+  filters = [genre_filter(Artist, genres)] if genres else []
+  page = artist_listing(filters)
+  return render_template('pages/artists.html', artists=page['items'], page=page,
+                          facets=facet_links('artists', Artist, filters, genres))
 
 
-@app.route('/artists/search', methods=['POST'])
+@app.route('/artists/search', methods=['GET', 'POST'])
+@read_only
 def search_artists():
-  # TODO: implement search on artists with partial string search. Ensure it is case-insensitive.
-  # seach for "A" should return "Guns N Petals", "Matt Quevado", and "The Wild Sax Band".
-  # search for "band" should return "The Wild Sax Band".
-  artist_query = Artist.query.filter(Artist.name.ilike('%' + request.form['search_term'] + '%'))
-  artist_list = list(map(Artist.simple, artist_query)) 
-  response = {
-    "count":len(artist_list),
-    "data": artist_list
-  }
-  return render_template('pages/search_artists.html', results=response, search_term=request.form.get('search_term', ''))
+  # ranked search on artist name, genres and city; search for "band"
+  # returns "The Wild Sax Band"
+  search_term = request.values.get('search_term', '')
+  page = max(request.args.get('page', 1, type=int), 1)
+  response = artist_search.search(search_term, page)
+  return render_template('pages/search_artists.html', results=response, search_term=search_term)
 
 
+def artist_page(artist_id):
+  # artist details and every show by the artist, the part of the page that only changes on writes
+  artist_query = Artist.query.get(artist_id)
+  if artist_query is None:
+    return None
+
+  # one query for every show by the artist with the venue columns the page needs
+  shows_query = db.session.query(
+      Show.start_time,
+      Show.venue_id,
+      Venue.name.label('venue_name'),
+      Venue.image_link.label('venue_image_link')) \
+    .join(Venue, Show.venue_id == Venue.id) \
+    .filter(Show.artist_id == artist_id, venue_visible) \
+    .order_by(Show.start_time) \
+    .all()
+  shows = [row._asdict() for row in shows_query]
+  return {
+    'details': Artist.details(artist_query),
+    'shows': shows,
+    'suggested': suggested_venues(artist_id, shows),
+  }
+
 @app.route('/artists/<int:artist_id>')
+@read_only
 def show_artist(artist_id):
-  # shows the venue page with the given venue_id
-  # TODO: replace with real venue data from the venues table, using venue_id
-  
-  artist_query = Artist.query.get(artist_id)
-  if artist_query:
-    artist_details = Artist.details(artist_query)
-        # get the current time
-    current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    new_shows_query = Show.query.options(db.joinedload(Show.Artist)).filter(Show.artist_id == artist_id).filter(Show.start_time > current_time).all()
-    new_shows_list = list(map(Show.show_venue, new_shows_query))
-    artist_details["upcoming_shows"] = new_shows_list
-    artist_details["upcoming_shows_count"] = len(new_shows_list)
-    past_shows_query = Show.query.options(db.joinedload(Show.Artist)).filter(Show.artist_id == artist_id).filter(Show.start_time <= current_time).all()
-    past_shows_list = list(map(Show.show_venue, past_shows_query))
-    artist_details["past_shows"] = past_shows_list
-    artist_details["past_shows_count"] = len(past_shows_list)
-    return render_template('pages/show_artist.html', artist=artist_details)
+  # shows the artist page with the given artist_id, served from the detail cache when possible
+  page = detail_page('artist', artist_id)
+  if page:
+    return render_template('pages/show_artist.html', artist=page_details(page),
+                           suggested_venues=page['suggested'])
   return render_template('errors/404.html')
 
 #  Update
 #  ----------------------------------------------------------------
+
+artist_fields = ('name', 'genres', 'city', 'state', 'phone', 'website', 'facebook_link',
+                 'image_link', 'seeking_venue', 'seeking_description')
+venue_fields = ('name', 'genres', 'address', 'city', 'state', 'phone', 'website', 'facebook_link',
+                'image_link', 'seeking_talent', 'seeking_description')
+
+# other pages show these, so changing them invalidates the pages on the other side of a show
+listed_fields = {'name', 'image_link'}
+
+def load_form(form, obj, fields):
+  for name in fields:
+    form[name].data = getattr(obj, name)
+  form.version.data = obj.version_id
+
+def changed_values(form, obj, fields):
+  # submitted values that differ from the row; None, '' and [] are all "empty"
+  changes = {}
+  for name in fields:
+    value, current = form[name].data, getattr(obj, name)
+    if value != current and (value or current):
+      changes[name] = value
+  return changes
+
+def save_changes(form, obj, fields):
+  '''
+  writes only the changed columns, in one UPDATE that also checks and bumps
+  version_id; returns the changed names, or None when someone else saved the
+  row after this form was loaded
+  '''
+  if form.version.data != str(obj.version_id):
+    return None
+  changes = changed_values(form, obj, fields)
+  if not changes:
+    return []
+  for name, value in changes.items():
+    setattr(obj, name, value)
+  try:
+    db.session.commit()
+  except StaleDataError:
+    db.session.rollback()
+    return None
+  return list(changes)
+
 @app.route('/artists/<int:artist_id>/edit', methods=['GET'])
 def edit_artist(artist_id):
-  form = ArtistForm(request.form)
+  form = ArtistForm()
   artist_data = Artist.query.get(artist_id)
   if artist_data:
-    artist_details = Artist.details(artist_data)
-    form.name.data = artist_details["name"]
-    form.genres.data = artist_details["genres"]
-    form.city.data = artist_details["city"]
-    form.state.data = artist_details["state"]
-    form.phone.data = artist_details["phone"]
-    form.website.data = artist_details["website"]
-    form.facebook_link.data = artist_details["facebook_link"]
-    form.seeking_venue.data = artist_details["seeking_venue"]
-    form.seeking_description.data = artist_details["seeking_description"]
-    form.image_link.data = artist_details["image_link"]
-    return render_template('forms/edit_artist.html', form=form, artist=artist_details)
+    load_form(form, artist_data, artist_fields)
+    return render_template('forms/edit_artist.html', form=form, artist=Artist.details(artist_data))
   return render_template('errors/404.html')
 
 
@@ -413,23 +1461,17 @@ def edit_artist_submission(artist_id):
   artist_data = Artist.query.get(artist_id)
   if artist_data:
       if form.validate():
-          seeking_venue = False
-          seeking_description = ''
-          if 'seeking_venue' in request.form:
-              seeking_venue = request.form['seeking_venue'] == 1
-          if 'seeking_description' in request.form:
-              seeking_description = request.form['seeking_description']
-          setattr(artist_data, 'name', request.form['name'])
-          setattr(artist_data, 'genres', request.form.getlist('genres'))
-          setattr(artist_data, 'city', request.form['city'])
-          setattr(artist_data, 'state', request.form['state'])
-          setattr(artist_data, 'phone', request.form['phone'])
-          setattr(artist_data, 'website', request.form['website'])
-          setattr(artist_data, 'facebook_link', request.form['facebook_link'])
-          setattr(artist_data, 'image_link', request.form['image_link'])
-          setattr(artist_data, 'seeking_description', seeking_description)
-          setattr(artist_data, 'seeking_venue', seeking_venue)
-          Artist.update(artist_data)
+          changed = save_changes(form, artist_data, artist_fields)
+          if changed is None:
+              flash('Artist ' + artist_data.name + ' was changed by someone else meanwhile. '
+                    'Review the current details and submit your edit again.')
+              load_form(form, artist_data, artist_fields)
+              return render_template('forms/edit_artist.html', form=form,
+                                     artist=Artist.details(artist_data)), 409
+          if changed:
+              # the artist's venues show its name and image too
+              venue_ids = booked_venue_ids(artist_id) if listed_fields.intersection(changed) else []
+              invalidate_pages(venue_ids=venue_ids, artist_ids=[artist_id])
           return redirect(url_for('show_artist', artist_id=artist_id))
       else:
           print(form.errors)
@@ -438,21 +1480,10 @@ def edit_artist_submission(artist_id):
 @app.route('/venues/<int:venue_id>/edit', methods=['GET'])
 def edit_venue(venue_id):
   form = VenueForm()
-  venue_query = Venue.query.get(venue_id)
+  venue_query = Venue.query.filter(Venue.id == venue_id, venue_visible).first()
   if venue_query:
-    venue_details = Venue.details(venue_query)
-    form.name.data = venue_details["name"]
-    form.genres.data = venue_details["genres"]
-    form.address.data = venue_details["address"]
-    form.city.data = venue_details["city"]
-    form.state.data = venue_details["state"]
-    form.phone.data = venue_details["phone"]
-    form.website.data = venue_details["website"]
-    form.facebook_link.data = venue_details["facebook_link"]
-    form.seeking_talent.data = venue_details["seeking_talent"]
-    form.seeking_description.data = venue_details["seeking_description"]
-    form.image_link.data = venue_details["image_link"]
-    return render_template('forms/edit_venue.html', form=form, Venue=venue_details)
+    load_form(form, venue_query, venue_fields)
+    return render_template('forms/edit_venue.html', form=form, Venue=Venue.details(venue_query))
   return render_template('errors/404.html')
 
 @app.route('/venues/<int:venue_id>/edit', methods=['POST'])
@@ -460,27 +1491,20 @@ def edit_venue_submission(venue_id):
   # TODO: take values from the form submitted, and update existing
   # venue record with ID <venue_id> using the new attributes
   form = VenueForm(request.form)
-  venue_data = Venue.query.get(venue_id)
+  venue_data = Venue.query.filter(Venue.id == venue_id, venue_visible).first()
   if venue_data:
       if form.validate():
-          seeking_talent = False
-          seeking_description = ''
-          if 'seeking_talent' in request.form:
-              seeking_talent = request.form['seeking_talent'] == 1
-          if 'seeking_description' in request.form:
-              seeking_description = request.form['seeking_description']
-          setattr(venue_data, 'name', request.form['name'])
-          setattr(venue_data, 'genres', request.form.getlist('genres'))
-          setattr(venue_data, 'address', request.form['address'])
-          setattr(venue_data, 'city', request.form['city'])
-          setattr(venue_data, 'state', request.form['state'])
-          setattr(venue_data, 'phone', request.form['phone'])
-          setattr(venue_data, 'website', request.form['website'])
-          setattr(venue_data, 'facebook_link', request.form['facebook_link'])
-          setattr(venue_data, 'image_link', request.form['image_link'])
-          setattr(venue_data, 'seeking_description', seeking_description)
-          setattr(venue_data, 'seeking_talent', seeking_talent)
-          Venue.update(venue_data)
+          changed = save_changes(form, venue_data, venue_fields)
+          if changed is None:
+              flash('Venue ' + venue_data.name + ' was changed by someone else meanwhile. '
+                    'Review the current details and submit your edit again.')
+              load_form(form, venue_data, venue_fields)
+              return render_template('forms/edit_venue.html', form=form,
+                                     Venue=Venue.details(venue_data)), 409
+          if changed:
+              # the venue's artists show its name and image too
+              artist_ids = booked_artist_ids(venue_id) if listed_fields.intersection(changed) else []
+              invalidate_pages(venue_ids=[venue_id], artist_ids=artist_ids)
           return redirect(url_for('show_venue', venue_id=venue_id))
       else:
           print(form.errors)
@@ -544,15 +1568,124 @@ def create_artist_submission():
 #  Shows
 #  ----------------------------------------------------------------
 
+def show_listing(*filters):
+  # shows with the venue and artist columns the show listing and calendar feeds need
+  return db.session.query(
+      Show.id,
+      Show.start_time,
+      Show.venue_id,
+      Venue.name.label('venue_name'),
+      Venue.address.label('venue_address'),
+      Venue.city.label('venue_city'),
+      Venue.state.label('venue_state'),
+      Show.artist_id,
+      Artist.name.label('artist_name'),
+      Artist.image_link.label('artist_image_link')) \
+    .join(Venue, Show.venue_id == Venue.id) \
+    .join(Artist, Show.artist_id == Artist.id) \
+    .filter(venue_visible, *filters)
+
+def time_arg(name, end=False):
+  # ?from= / ?to= as YYYY-MM-DD or an ISO date and time; a bare `to` date includes that whole day
+  value = request.args.get(name)
+  if not value:
+    return None
+  try:
+    if len(value) == 10:
+      day = datetime.strptime(value, '%Y-%m-%d')
+      if not end:
+        return day
+      # there is no day after 9999-12-31
+      return day + timedelta(days=1) if day.date() < date.max else datetime.max
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+      # start times are naive local times, like datetime.now()
+      moment = moment.astimezone().replace(tzinfo=None)
+    return moment
+  except (ValueError, OverflowError):
+    abort(400, description='%s must be a date (YYYY-MM-DD) or an ISO date and time.' % name)
+
+def date_range(default_from=None):
+  # start_time filters for ?from= and ?to=, both served by the start_time indexes
+  start, end = time_arg('from') or default_from, time_arg('to', end=True)
+  filters = []
+  if start:
+    filters.append(Show.start_time >= start)
+  if end:
+    filters.append(Show.start_time < end)
+  return filters
+
+def feed_etag(show_query, *parts):
+  '''
+  weak ETag of a calendar feed, from one aggregate over the rows it covers: it
+  changes when a show is added or removed or a listed venue or artist is edited.
+  A feed covers one venue or artist, so this is a range scan on its start_time index.
+  '''
+  fingerprint = show_query.with_entities(
+    db.func.count(Show.id),
+    db.func.sum(Show.id),
+    db.func.sum(Venue.version_id),
+    db.func.sum(Artist.version_id)).one()
+  source = repr((request.full_path,) + tuple(fingerprint) + parts)
+  return hashlib.sha1(source.encode()).hexdigest()
+
+def page_etag(page):
+  '''
+  weak ETag of one keyset page of a listing, from the rows it shows and its
+  cursors; the page is fetched anyway, so this costs no extra query however
+  long the listing is
+  '''
+  source = repr((request.full_path, page['prev'], page['next']) + tuple(tuple(row) for row in page['items']))
+  return hashlib.sha1(source.encode()).hexdigest()
+
+def not_modified(etag):
+  # a 304 when the client already has this version, without building the page
+  if request.if_none_match.contains_weak(etag):
+    return with_etag(Response(status=304), etag)
+  return None
+
+def with_etag(response, etag):
+  response.set_etag(etag, weak=True)
+  # clients may keep the response but must revalidate it before every use
+  response.headers['Cache-Control'] = 'no-cache'
+  return response
+
+def show_filters():
+  # ?from=, ?to= and ?city= of the show listings
+  filters = date_range()
+  city = request.args.get('city', '').strip()
+  if city:
+    filters.append(db.func.lower(Venue.city) == city.lower())
+  return filters
+
+def show_page(show_query):
+  return cursor_page(show_query, [Show.start_time, Show.id], lambda show: (show.start_time, show.id))
+
 @app.route('/shows')
+@read_only
 def shows():
-  # displays list of shows at /shows
-  # TODO: replace with real venues data.
-  #       num_shows should be aggregated based on number of upcoming shows per venue.
-  #a query of all shows from db using join
-  show_query = Show.query.options(db.joinedload(Show.Venue), db.joinedload(Show.Artist)).all()
-  data = list(map(Show.details, show_query))
-  return render_template('pages/shows.html', shows=data)
+  # displays one keyset page of shows at /shows, in (start_time, id) order;
+  # ?from= and ?to= limit it to a date range and ?city= to the venues of one city
+  show_query = show_listing(*show_filters())
+  listing_args = {name: request.args.get(name) for name in ('from', 'to', 'city', 'per_page')}
+
+  if request.args.get('stream'):
+    # the whole catalog, rendered while a server-side cursor feeds rows in
+    # batches, so the first bytes go out right away and memory stays flat;
+    # no ETag, since that would take a pass over every row before the first byte
+    show_rows = show_query.order_by(Show.start_time, Show.id) \
+      .execution_options(stream_results=True) \
+      .yield_per(app.config['STREAM_BATCH_SIZE'])
+    return Response(stream_with_context(
+      stream_template('pages/shows.html', shows=show_rows, page=None, listing_args=listing_args)))
+
+  page = show_page(show_query)
+  etag = page_etag(page)
+  response = not_modified(etag)
+  if response:
+    return response
+  return with_etag(make_response(render_template('pages/shows.html', shows=page['items'], page=page,
+                                                 listing_args=listing_args)), etag)
 
 @app.route('/shows/create')
 def create_shows():
@@ -560,18 +1693,55 @@ def create_shows():
   form = ShowForm()
   return render_template('forms/new_show.html', form=form)
 
+def booking_conflicts(venue_id, artist_id, start_time):
+  '''
+  shows at the venue or by the artist that overlap a show starting at start_time;
+  both sides are range scans on the (venue_id, start_time) and (artist_id, start_time) indexes
+  '''
+  duration = timedelta(minutes=app.config['SHOW_DURATION'])
+  return Show.query \
+    .filter(db.or_(Show.venue_id == venue_id, Show.artist_id == artist_id)) \
+    .filter(Show.start_time > start_time - duration, Show.start_time < start_time + duration) \
+    .order_by(Show.start_time) \
+    .all()
+
+def conflict_message(conflicts, venue_id):
+  times = ', '.join(format_datetime(show.start_time, 'full') for show in conflicts)
+  if all(show.venue_id == venue_id for show in conflicts):
+    return 'The venue is already booked around that time: ' + times
+  if all(show.venue_id != venue_id for show in conflicts):
+    return 'The artist is already booked around that time: ' + times
+  return 'The venue and the artist are already booked around that time: ' + times
+
 @app.route('/shows/create', methods=['POST'])
 def create_show_submission():
   # called to create new shows in the db, upon submitting new show listing form
   # TODO: insert form data as a new Show record in the db, instead
+  form = ShowForm(request.form)
+  error = False
+  conflicts = []
   try:
+    if not form.validate():
+      raise ValueError(form.errors)
+    venue_id, artist_id = int(form.venue_id.data), int(form.artist_id.data)
+    start_time = form.start_time.data
+    # lock the venue, then the artist: concurrent bookings for either one wait here
+    # instead of both passing the overlap check. No new bookings at a deleted venue.
+    if not db.session.query(Venue.id).filter(Venue.id == venue_id, venue_visible).with_for_update().scalar():
+      raise ValueError('venue %s does not exist' % venue_id)
+    if not db.session.query(Artist.id).filter(Artist.id == artist_id).with_for_update().scalar():
+      raise ValueError('artist %s does not exist' % artist_id)
+    conflicts = booking_conflicts(venue_id, artist_id, start_time)
+    if conflicts:
+      raise ValueError('overlapping shows')
     new_show = Show(
-      venue_id=request.form['venue_id'],
-      artist_id=request.form['artist_id'],
-      start_time=request.form['start_time'],
+      venue_id=venue_id,
+      artist_id=artist_id,
+      start_time=start_time,
     )
     db.session.add(new_show)
     db.session.commit()
+    invalidate_pages(venue_ids=[venue_id], artist_ids=[artist_id])
   except:
     # TODO: on unsuccessful db insert, flash an error instead.
     # e.g., flash('An error occurred. Show could not be listed.')
@@ -579,17 +1749,351 @@ def create_show_submission():
       error = True
       db.session.rollback()
       print(sys.exc_info())
-      flash('An error occured. Show could not be listed.')
+      if isinstance(sys.exc_info()[1], IntegrityError):
+        # the exclusion constraint caught an overlap committed after our check
+        conflicts = booking_conflicts(venue_id, artist_id, start_time)
+      if conflicts:
+        flash(conflict_message(conflicts, venue_id) + '. Show could not be listed.')
+      else:
+        flash('An error occured. Show could not be listed.')
       
   finally:
       db.session.close()
      
     # on successful db insert, flash success
-      flash('Show was successfully listed!')
+      if error == False:
+        flash('Show was successfully listed!')
 
-    
+  if conflicts:
+    return render_template('forms/new_show.html', form=form), 409
   return render_template('pages/home.html')
 
+#  Calendars
+#  ----------------------------------------------------------------
+#  per-venue and per-artist show feeds for calendar clients, as iCal or JSON
+
+def calendar_feed(name, show_query, format, *etag_parts):
+  etag = feed_etag(show_query, *etag_parts)
+  response = not_modified(etag)
+  if response:
+    return response
+
+  duration = timedelta(minutes=app.config['SHOW_DURATION'])
+  rows = show_query.order_by(Show.start_time, Show.id).all()
+  if format == 'json':
+    response = jsonify({
+      'name': name,
+      'shows': [{
+        'id': row.id,
+        'start_time': row.start_time.isoformat(),
+        'end_time': (row.start_time + duration).isoformat(),
+        'venue_id': row.venue_id,
+        'venue_name': row.venue_name,
+        'artist_id': row.artist_id,
+        'artist_name': row.artist_name,
+      } for row in rows],
+    })
+  else:
+    events = (ical.event(
+      uid='show-%d@%s' % (row.id, request.host),
+      start=row.start_time,
+      end=row.start_time + duration,
+      summary='%s at %s' % (row.artist_name, row.venue_name),
+      location=', '.join(part for part in (row.venue_address, row.venue_city, row.venue_state) if part),
+      url=url_for('show_venue', venue_id=row.venue_id, _external=True)) for row in rows)
+    response = Response(ical.calendar(name, events), mimetype='text/calendar')
+  return with_etag(response, etag)
+
+def feed_start():
+  # feeds leave out shows older than CALENDAR_PAST_DAYS unless ?from= says otherwise
+  return request_now() - timedelta(days=app.config['CALENDAR_PAST_DAYS'])
+
+@app.route('/venues/<int:venue_id>/calendar.<any(ics, json):format>')
+@read_only
+def venue_calendar(venue_id, format):
+  venue = Venue.query.filter(Venue.id == venue_id, venue_visible).first_or_404()
+  show_query = show_listing(Show.venue_id == venue_id, *date_range(feed_start()))
+  return calendar_feed(venue.name, show_query, format, venue.version_id)
+
+@app.route('/artists/<int:artist_id>/calendar.<any(ics, json):format>')
+@read_only
+def artist_calendar(artist_id, format):
+  artist = Artist.query.get_or_404(artist_id)
+  show_query = show_listing(Show.artist_id == artist_id, *date_range(feed_start()))
+  return calendar_feed(artist.name, show_query, format, artist.version_id)
+
+#  Analytics
+#  ----------------------------------------------------------------
+#  monthly show counts, read from the rollups alone
+
+def add_months(month, count):
+  index = month.year * 12 + month.month - 1 + count
+  return date(index // 12, index % 12 + 1, 1)
+
+def month_range():
+  # first and last month for ?from= and ?to=, widened to whole months;
+  # ANALYTICS_PAST_MONTHS back to ANALYTICS_FUTURE_MONTHS ahead by default
+  this_month = show_month(request_now())
+  start, end = time_arg('from'), time_arg('to', end=True)
+  first = show_month(start) if start else add_months(this_month, -app.config['ANALYTICS_PAST_MONTHS'])
+  last = show_month(end - timedelta(microseconds=1)) if end else \
+    add_months(this_month, app.config['ANALYTICS_FUTURE_MONTHS'])
+  return first, last
+
+@app.route('/analytics')
+@read_only
+def analytics():
+  # shows per month, busiest cities and busiest venues, for every city or the one in ?city=
+  first, last = month_range()
+  month_count = (last.year - first.year) * 12 + last.month - first.month + 1
+  if month_count > app.config['ANALYTICS_MAX_MONTHS']:
+    abort(400, description='from and to can be at most %d months apart.' % app.config['ANALYTICS_MAX_MONTHS'])
+  city = request.args.get('city', '').strip()
+  filters = [ShowRollup.month >= first, ShowRollup.month <= last]
+  if city:
+    filters.append(db.func.lower(ShowRollup.city) == city.lower())
+  shows = db.func.sum(ShowRollup.show_count).label('shows')
+
+  totals = dict(db.session.query(ShowRollup.month, shows).filter(*filters).group_by(ShowRollup.month))
+  months = [{'month': month, 'shows': totals.get(month, 0)}
+            for month in (add_months(first, index) for index in range(month_count))]
+
+  cities = [] if city else db.session.query(ShowRollup.city, ShowRollup.state, shows).filter(*filters) \
+    .group_by(ShowRollup.city, ShowRollup.state).order_by(shows.desc(), ShowRollup.city) \
+    .limit(app.config['ANALYTICS_TOP']).all()
+  venue_counts = db.session.query(ShowRollup.venue_id, shows).filter(*filters) \
+    .group_by(ShowRollup.venue_id).order_by(shows.desc(), ShowRollup.venue_id) \
+    .limit(app.config['ANALYTICS_TOP']).all()
+  names = dict(db.session.query(Venue.id, Venue.name)
+               .filter(Venue.id.in_([row.venue_id for row in venue_counts]))) if venue_counts else {}
+
+  return render_template('pages/analytics.html',
+                          months=months,
+                          peak=max([row['shows'] for row in months] + [1]),
+                          cities=[row._asdict() for row in cities],
+                          venues=[{'id': row.venue_id, 'name': names.get(row.venue_id), 'shows': row.shows}
+                                  for row in venue_counts],
+                          city=city,
+                          first=first,
+                          last=last)
+
+#  API
+#  ----------------------------------------------------------------
+#  JSON versions of the listing and detail pages, from the same queries and
+#  caches. ?fields=name,city returns only those fields of each record.
+
+def api_response(data, status=200):
+  return Response(dumps(data), status=status, mimetype='application/json')
+
+def api_error(status, message):
+  return api_response({'success': False, 'error': status, 'message': message}, status)
+
+def requested_fields():
+  return {field.strip() for field in request.args.get('fields', '').split(',') if field.strip()}
+
+@app.route('/api/v1/venues')
+@read_only
+def api_venues():
+  genres = selected_genres()
+  filters = [genre_filter(Venue, genres)] if genres else []
+  fields = requested_fields()
+  return api_response({'data': [
+    dict(area, venues=[select_fields(venue, fields) for venue in area['venues']])
+    for area in listed_areas(genres, filters)
+  ]})
+
+@app.route('/api/v1/venues/<int:venue_id>')
+@read_only
+def api_venue(venue_id):
+  page = detail_page('venue', venue_id)
+  if not page:
+    return api_error(404, 'venue not found')
+  return api_response({'data': select_fields(page_details(page), requested_fields())})
+
+@app.route('/api/v1/venues/nearby')
+@read_only
+def api_venues_nearby():
+  results = nearby_venues()
+  fields = requested_fields()
+  return api_response(dict(results, venues=[select_fields(venue, fields) for venue in results['venues']]))
+
+@app.route('/api/v1/artists')
+@read_only
+def api_artists():
+  genres = selected_genres()
+  page = artist_listing([genre_filter(Artist, genres)] if genres else [])
+  fields = requested_fields()
+  return api_response({
+    'data': [select_fields(artist.simple(), fields) for artist in page['items']],
+    'prev': page['prev'],
+    'next': page['next'],
+  })
+
+@app.route('/api/v1/artists/<int:artist_id>')
+@read_only
+def api_artist(artist_id):
+  page = detail_page('artist', artist_id)
+  if not page:
+    return api_error(404, 'artist not found')
+  return api_response({'data': select_fields(page_details(page), requested_fields())})
+
+@app.route('/api/v1/shows')
+@read_only
+def api_shows():
+  page = show_page(show_listing(*show_filters()))
+  etag = page_etag(page)
+  response = not_modified(etag)
+  if response:
+    return response
+
+  fields = requested_fields()
+  return with_etag(api_response({
+    'data': [select_fields(show._asdict(), fields) for show in page['items']],
+    'prev': page['prev'],
+    'next': page['next'],
+  }), etag)
+
+#  Import
+#  ----------------------------------------------------------------
+
+import_kinds = {
+  'venues': (Venue, VenueForm),
+  'artists': (Artist, ArtistForm),
+  'shows': (Show, ShowForm),
+}
+
+def missing_references(rows):
+  '''
+  show rows whose venue or artist doesn't exist, checked with one query per
+  side; the rest are locked like a booking locks them (venues, then artists,
+  each in id order) until the batch commits
+  '''
+  venue_ids = {row['venue_id'] for line, row in rows}
+  artist_ids = {row['artist_id'] for line, row in rows}
+  venue_ids -= {id for id, in db.session.query(Venue.id).filter(Venue.id.in_(venue_ids), venue_visible)
+                .order_by(Venue.id).with_for_update()}
+  artist_ids -= {id for id, in db.session.query(Artist.id).filter(Artist.id.in_(artist_ids))
+                 .order_by(Artist.id).with_for_update()}
+  missing = {}
+  for line, row in rows:
+    errors = {}
+    if row['venue_id'] in venue_ids:
+      errors['venue_id'] = ['Venue %d does not exist.' % row['venue_id']]
+    if row['artist_id'] in artist_ids:
+      errors['artist_id'] = ['Artist %d does not exist.' % row['artist_id']]
+    if errors:
+      missing[line] = errors
+  return missing
+
+def booking_overlaps(rows):
+  '''
+  show rows that overlap an existing show, or an earlier row of the batch, at
+  their venue or by their artist; the existing shows come from one query over
+  the batch's time span
+  '''
+  if not rows:
+    return {}
+  duration = timedelta(minutes=app.config['SHOW_DURATION'])
+  times = [row['start_time'] for line, row in rows]
+  # sorted start times per ('venue_id', id) and ('artist_id', id)
+  booked = {}
+  existing = db.session.query(Show.venue_id, Show.artist_id, Show.start_time) \
+    .filter(db.or_(Show.venue_id.in_({row['venue_id'] for line, row in rows}),
+                   Show.artist_id.in_({row['artist_id'] for line, row in rows}))) \
+    .filter(Show.start_time > min(times) - duration, Show.start_time < max(times) + duration)
+  for venue_id, artist_id, start_time in existing:
+    insort(booked.setdefault(('venue_id', venue_id), []), start_time)
+    insort(booked.setdefault(('artist_id', artist_id), []), start_time)
+  overlaps = {}
+  for line, row in rows:
+    errors = {}
+    for column, label in (('venue_id', 'venue'), ('artist_id', 'artist')):
+      starts = booked.setdefault((column, row[column]), [])
+      after = bisect_right(starts, row['start_time'] - duration)
+      if after < len(starts) and starts[after] < row['start_time'] + duration:
+        errors[column] = ['The %s is already booked around that time.' % label]
+    if errors:
+      overlaps[line] = errors
+      continue
+    for column in ('venue_id', 'artist_id'):
+      insort(booked[(column, row[column])], row['start_time'])
+  return overlaps
+
+def import_records(kind, stream, format):
+  '''
+  validates every record like the matching create form does and inserts the
+  valid ones in batches of IMPORT_BATCH_SIZE; returns the per-row error report
+  '''
+  model, form_class = import_kinds[kind]
+  use_copy = app.config['IMPORT_USE_COPY'] and db.engine.dialect.name == 'postgresql'
+  report = {'imported': 0, 'errors': []}
+
+  def write(batch):
+    if model is Show:
+      missing = missing_references(batch)
+      batch = [(line, row) for line, row in batch if line not in missing]
+      missing.update(booking_overlaps(batch))
+      report['errors'].extend({'line': line, 'errors': errors} for line, errors in missing.items())
+      batch = [(line, row) for line, row in batch if line not in missing]
+    if not batch:
+      return
+    if model is Venue:
+      locate_rows([row for line, row in batch])
+    try:
+      insert_rows(db.session.connection(), model.__table__, [row for line, row in batch], use_copy)
+      track_bulk_change(db.session, model)
+      if model is Show:
+        update_rollups(db.session.connection(), [(row['venue_id'], row['start_time']) for line, row in batch])
+      db.session.commit()
+      if model is Show:
+        invalidate_pages(venue_ids={row['venue_id'] for line, row in batch},
+                         artist_ids={row['artist_id'] for line, row in batch})
+      report['imported'] += len(batch)
+    except Exception:
+      db.session.rollback()
+      if len(batch) == 1:
+        report['errors'].append({'line': batch[0][0], 'errors': {'record': [str(sys.exc_info()[1])]}})
+      else:
+        # find the rows the database rejected by retrying them one at a time
+        for line, row in batch:
+          write([(line, row)])
+
+  batch = []
+  for line, row, errors in validate_records(read_records(stream, format), form_class, model.__table__):
+    if errors:
+      report['errors'].append({'line': line, 'errors': errors})
+      continue
+    batch.append((line, row))
+    if len(batch) >= app.config['IMPORT_BATCH_SIZE']:
+      write(batch)
+      batch = []
+  write(batch)
+  report['errors'].sort(key=lambda error: error['line'])
+  return report
+
+def import_format(filename, format=None):
+  # csv or ndjson, from the explicit format or the file extension
+  if format:
+    return format
+  return 'csv' if filename.lower().endswith('.csv') else 'ndjson'
+
+@app.route('/import/<kind>', methods=['POST'])
+def import_submission(kind):
+  # upload a CSV or NDJSON file of venues, artists or shows
+  if kind not in import_kinds or 'file' not in request.files:
+    return jsonify({'success': False, 'message': 'bad request'}), 400
+  upload = request.files['file']
+  format = import_format(upload.filename, request.form.get('format'))
+  report = import_records(kind, io.TextIOWrapper(upload.stream, encoding='utf-8'), format)
+  return jsonify(dict(report, success=not report['errors']))
+
+@app.errorhandler(400)
+def bad_request_error(error):
+    # the helpers shared by pages and API abort with a description; the API sends it as JSON
+    if request.path.startswith('/api/'):
+        return api_error(400, error.description)
+    return error
+
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('errors/404.html'), 404
@@ -600,15 +2104,317 @@ def server_error(error):
 
 
 if not app.debug:
-    file_handler = FileHandler('error.log')
-    file_handler.setFormatter(
-        Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]')
-    )
+    formatter = Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]')
+    if app.config['LOG_QUEUE']:
+        # request threads only enqueue records; a background thread writes them in batches
+        log_pipeline = QueueLogging(
+            'error.log',
+            max_bytes=app.config['LOG_MAX_BYTES'],
+            backup_count=app.config['LOG_BACKUP_COUNT'],
+            queue_size=app.config['LOG_QUEUE_SIZE'],
+            batch_size=app.config['LOG_BATCH_SIZE'],
+        )
+        log_pipeline.setFormatter(formatter)
+        atexit.register(log_pipeline.stop)
+        file_handler = log_pipeline.handler
+    else:
+        file_handler = WatchedFileHandler('error.log')
+        file_handler.setFormatter(formatter)
     app.logger.setLevel(logging.INFO)
     file_handler.setLevel(logging.INFO)
     app.logger.addHandler(file_handler)
     app.logger.info('errors')
 
+#----------------------------------------------------------------------------#
+# Commands.
+#----------------------------------------------------------------------------#
+
+def clear_catalog():
+  # deletes every show, venue and artist
+  if db.engine.dialect.name == 'postgresql':
+    db.session.execute('TRUNCATE "%s", "%s", "%s", "%s" RESTART IDENTITY' % (
+      ShowRollup.__tablename__, Show.__tablename__, Venue.__tablename__, Artist.__tablename__))
+    for model in (Show, Venue, Artist):
+      track_bulk_change(db.session, model)
+  else:
+    for model in (ShowRollup, Show, Venue, Artist):
+      model.query.delete()
+  db.session.commit()
+  detail_cache.clear()
+  suggestions.clear()
+
+# index names of a table, including the expression indexes the inspector leaves out
+index_name_queries = {
+  'postgresql': 'SELECT indexname FROM pg_indexes WHERE tablename = :table',
+  'sqlite': "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table",
+}
+
+def index_names(connection, inspector, table):
+  query = index_name_queries.get(connection.dialect.name)
+  if query:
+    return {name for name, in connection.execute(db.text(query), table=table.name)}
+  return {index['name'] for index in inspector.get_indexes(table.name)}
+
+def upgrade_schema():
+  '''
+  brings a database created by an earlier version up to the models: adds the
+  missing tables, columns, indexes and show constraints (nothing is changed or
+  dropped), then fills the rollups and venue locations if their table or
+  columns are new; returns what was added
+  '''
+  added = []
+  with db.engine.begin() as connection:
+    if connection.dialect.name == 'postgresql':
+      for extension in ('pg_trgm', 'btree_gist'):
+        connection.execute('CREATE EXTENSION IF NOT EXISTS %s' % extension)
+    inspector = inspect_database(connection)
+    existing = set(inspector.get_table_names())
+    for table in db.metadata.sorted_tables:
+      if table.name not in existing:
+        table.create(connection)
+        added.append('table %s' % table.name)
+        continue
+      columns = {column['name'] for column in inspector.get_columns(table.name)}
+      for column in table.columns:
+        if column.name not in columns:
+          # new NOT NULL columns have a server default for the existing rows
+          connection.execute('ALTER TABLE %s ADD COLUMN %s' % (
+            connection.dialect.identifier_preparer.format_table(table),
+            CreateColumn(column).compile(dialect=connection.dialect)))
+          added.append('column %s.%s' % (table.name, column.name))
+      indexes = index_names(connection, inspector, table)
+      for index in table.indexes:
+        if index.name not in indexes:
+          index.create(connection)
+          added.append('index %s' % index.name)
+    added.extend('constraint %s' % name for name in create_show_constraints(Show.__table__, connection))
+  if 'table %s' % ShowRollup.__tablename__ in added:
+    backfill_rollups()
+  if 'column %s.latitude' % Venue.__tablename__ in added:
+    geocode_venues()
+  return added
+
+def insert_generated(model, rows):
+  # IMPORT_BATCH_SIZE rows per statement (or COPY) and commit, like the bulk import;
+  # returns the number of rows inserted
+  use_copy = app.config['IMPORT_USE_COPY'] and db.engine.dialect.name == 'postgresql'
+  rows = iter(rows)
+  inserted = 0
+  while True:
+    batch = list(islice(rows, app.config['IMPORT_BATCH_SIZE']))
+    if not batch:
+      return inserted
+    inserted += len(batch)
+    if model is Venue:
+      locate_rows(batch)
+    insert_rows(db.session.connection(), model.__table__, batch, use_copy)
+    track_bulk_change(db.session, model)
+    db.session.commit()
+
+def generate_catalog(shows, seed):
+  '''
+  adds a synthetic catalog of about the given number of shows, with venues and
+  artists in proportion; returns the (venues, artists, shows) actually added,
+  fewer shows than asked for when a day runs out of venue and artist pairs
+  '''
+  rng = random.Random(seed)
+  genres = [genre for genre, label in genre_choices]
+  venues, artists = synthetic.dataset_size(shows)
+  ids = {}
+  for model, rows in ((Venue, synthetic.venue_rows(rng, venues, genres)),
+                      (Artist, synthetic.artist_rows(rng, artists, genres))):
+    last_id = db.session.query(db.func.max(model.id)).scalar() or 0
+    insert_generated(model, rows)
+    # ids are assigned in insertion order
+    ids[model] = [id for id, in db.session.query(model.id).filter(model.id > last_id).order_by(model.id)]
+  added = insert_generated(Show, synthetic.show_rows(rng, shows, ids[Venue], ids[Artist]))
+  # one grouped pass is quicker than counting every batch
+  backfill_rollups()
+  return len(ids[Venue]), len(ids[Artist]), added
+
+def benchmark_routes(rng, samples):
+  '''
+  {label: [url, ...]} for every GET route that takes no arguments or one
+  venue or artist id (filled with up to `samples` random ids), plus the
+  filtered, search and streaming variants of the listings
+  '''
+  path_values = {
+    'venue_id': [id for id, in db.session.query(Venue.id).filter(venue_visible)],
+    'artist_id': [id for id, in db.session.query(Artist.id)],
+  }
+  for name, ids in path_values.items():
+    path_values[name] = rng.sample(ids, min(samples, len(ids)))
+  city = db.session.query(Venue.city).filter(venue_visible) \
+    .group_by(Venue.city).order_by(db.func.count().desc()).limit(1).scalar()
+  # the nearby routes answer 400 without a point, so search around a placed venue
+  placed = db.session.query(Venue.latitude, Venue.longitude) \
+    .filter(venue_visible, Venue.latitude.isnot(None), Venue.longitude.isnot(None)).all()
+  point = dict(zip(('lat', 'lng'), rng.choice(placed))) if placed else {}
+  today = date.today()
+  date_range = {'from': today.isoformat(), 'to': (today + timedelta(days=30)).isoformat()}
+
+  routes = {}
+  with app.test_request_context():
+    for rule in sorted(app.url_map.iter_rules(), key=lambda rule: rule.rule):
+      arguments = set(rule.arguments) - {'format'}
+      if 'GET' not in rule.methods or rule.endpoint in ('static', 'asset') or \
+          len(arguments) > 1 or not arguments <= set(path_values):
+        continue
+      for format in (('ics', 'json') if 'format' in rule.arguments else (None,)):
+        values = {'format': format} if format else {}
+        label = re.sub(r'<[^>]*:format>', format or '', rule.rule)
+        if arguments:
+          name = arguments.copy().pop()
+          urls = [url_for(rule.endpoint, **dict(values, **{name: id})) for id in path_values[name]]
+        else:
+          urls = [url_for(rule.endpoint, **values)]
+        if urls:
+          routes[label] = urls
+
+    routes.update({
+      '/venues?genre=Jazz': [url_for('venues', genre='Jazz')],
+      '/artists?genre=Jazz': [url_for('artists', genre='Jazz')],
+      '/venues/search?search_term=': [url_for('search_venues', search_term=term)
+                                      for term in ('the', 'hall', 'jazz', city or 'new')],
+      '/artists/search?search_term=': [url_for('search_artists', search_term=term)
+                                       for term in ('the', 'wolves', 'rock', city or 'new')],
+      '/shows?from=&to=': [url_for('shows', **date_range)],
+      '/shows?from=&to=&city=': [url_for('shows', city=city, **date_range)],
+      '/shows?stream=1': [url_for('shows', stream=1)],
+      '/api/v1/shows?from=&to=': [url_for('api_shows', **date_range)],
+    })
+    if point:
+      routes['/venues/nearby'] = [url_for('venues_nearby', **point)]
+      routes['/api/v1/venues/nearby'] = [url_for('api_venues_nearby', **point)]
+    else:
+      # nothing to search around, so the api timing would only be of the 400
+      routes.pop('/api/v1/venues/nearby', None)
+  return routes
+
+@app.cli.command('bench-datetime')
+@click.option('--rows', default=10000, help='Number of shows to render.')
+def bench_datetime(rows):
+  '''Time the shows page render with the old and the current datetime filter.'''
+  def parse_and_format(value, format='medium'):
+    # the filter as it was: string round trip and a babel lookup per call
+    date = dateutil.parser.parse(str(value))
+    return babel.dates.format_datetime(date, datetime_formats.get(format, format))
+
+  start = datetime(2020, 1, 1, 20, 0)
+  shows = [{
+    'venue_id': 1,
+    'venue_name': 'The Musical Hop',
+    'artist_id': 1,
+    'artist_name': 'Guns N Petals',
+    'artist_image_link': 'https://example.com/artist.jpg',
+    'start_time': start + timedelta(minutes=30 * (i % 2000)),
+  } for i in range(rows)]
+
+  def render(label):
+    began = time.perf_counter()
+    with app.test_request_context('/shows'):
+      render_template('pages/shows.html', shows=shows, page=None)
+    click.echo('%-22s %8.1f ms' % (label, (time.perf_counter() - began) * 1000))
+
+  app.jinja_env.filters['datetime'] = parse_and_format
+  try:
+    render('parse + format')
+  finally:
+    app.jinja_env.filters['datetime'] = format_datetime
+  cached_format_datetime.cache_clear()
+  render('format_datetime, cold')
+  render('format_datetime, warm')
+
+@app.cli.command('build-assets')
+def build_assets():
+  '''Fingerprint and precompress everything under static/ into static/dist/.'''
+  manifest = assets.build(app.static_folder, asset_folder)
+  click.echo('%d assets built in %s%s' % (len(manifest), asset_folder,
+                                          '' if assets.brotli else ' (gzip only, install brotli for .br files)'))
+
+@app.cli.command('generate-data')
+@click.option('--shows', default=1000, help='Number of shows; venues and artists scale with it.')
+@click.option('--seed', default=1, help='Random seed; the same seed generates the same data.')
+def generate_data(shows, seed):
+  '''Add a synthetic catalog of venues, artists and shows.'''
+  began = time.perf_counter()
+  venues, artists, shows = generate_catalog(shows, seed)
+  click.echo('%d venues, %d artists and %d shows added in %.1f s' % (
+    venues, artists, shows, time.perf_counter() - began))
+
+@app.cli.command('benchmark')
+@click.option('--sizes', help='Comma separated show counts such as 1000,100000,1000000. Each size '
+              'REPLACES every venue, artist and show with a generated catalog; without it the '
+              'current data is measured.')
+@click.option('--requests', default=20, help='Timed requests per route.')
+@click.option('--samples', default=20, help='Venue and artist ids spread over the detail route requests.')
+@click.option('--seed', default=1, help='Random seed for the data and the sampled ids.')
+@click.option('--route', 'route_filter', help='Only routes whose label contains this text.')
+@click.option('--yes', is_flag=True, help='Replace the data without asking.')
+def run_benchmark(sizes, requests, samples, seed, route_filter, yes):
+  '''
+  Report p50/p95 latency, queries and peak RSS for every page and API route.
+  Sizes run smallest first, so each peak RSS is the peak up to that size.
+  '''
+  sizes = sorted(int(size) for size in sizes.split(',')) if sizes else [None]
+  if sizes != [None] and not yes:
+    click.confirm('This deletes every venue, artist and show in %r. Continue?' % db.engine.url, abort=True)
+  for size in sizes:
+    if size is not None:
+      began = time.perf_counter()
+      clear_catalog()
+      venues, artists, shows = generate_catalog(size, seed)
+      click.echo('generated %d venues, %d artists and %d shows in %.1f s' % (
+        venues, artists, shows, time.perf_counter() - began))
+    routes = benchmark_routes(random.Random(seed), samples)
+    if route_filter:
+      routes = {label: urls for label, urls in routes.items() if route_filter in label}
+    click.echo('\n%d shows, %d requests per route' % (Show.query.count(), requests))
+    benchmark.report(benchmark.run(app, routes, requests), click.echo)
+
+@app.cli.command('upgrade-db')
+def upgrade_db():
+  '''Add the tables, columns, indexes and constraints an existing database is missing.'''
+  try:
+    added = upgrade_schema()
+  except IntegrityError as error:
+    raise click.ClickException('%s\nExisting shows overlap; move or delete them and run upgrade-db again.'
+                               % error.orig)
+  for change in added:
+    click.echo('added %s' % change)
+  click.echo('%d changes, the database is up to date' % len(added))
+
+@app.cli.command('backfill-rollups')
+def backfill():
+  '''Rebuild the monthly show rollups behind /analytics from the show table.'''
+  click.echo('%d rollup rows written' % backfill_rollups())
+
+@app.cli.command('geocode-venues')
+@click.option('--all', 'everything', is_flag=True, help='Re-place venues that already have a location.')
+def place_venues(everything):
+  '''Give venues the location of their city from GEOCODE_FILE.'''
+  click.echo('%d venues placed' % geocode_venues(everything))
+
+@app.cli.command('purge-venues')
+def purge_venues():
+  '''Purge the shows and rows of every soft-deleted venue.'''
+  venue_ids = [id for id, in db.session.query(Venue.id).filter(Venue.deleted_at.isnot(None))]
+  for venue_id in venue_ids:
+    click.echo('venue %d: %d shows purged' % (venue_id, purge_venue(venue_id)))
+  click.echo('%d venues purged' % len(venue_ids))
+
+@app.cli.command('import-data')
+@click.argument('kind', type=click.Choice(sorted(import_kinds)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', type=click.Choice(['csv', 'ndjson']), help='Defaults to the file extension.')
+def import_data(kind, path, format):
+  '''Bulk import venues, artists or shows from a CSV or NDJSON file.'''
+  with open(path, newline='', encoding='utf-8') as stream:
+    report = import_records(kind, stream, import_format(path, format))
+  for error in report['errors']:
+    click.echo('line %d: %s' % (error['line'], json.dumps(error['errors'])), err=True)
+  click.echo('%d imported, %d rejected' % (report['imported'], len(report['errors'])))
+
 #----------------------------------------------------------------------------#
 # Launch.
 #----------------------------------------------------------------------------#
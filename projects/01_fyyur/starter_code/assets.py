@@ -0,0 +1,117 @@
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+
+# Static asset build. Every file under static/ is copied to static/dist/ with
+# a content hash in its name (css/main.css -> css/main.3f2a9c0d1b7e.css), so
+# it can be cached forever, next to .gz and .br (with the optional `brotli`
+# package) copies of the files that compress. manifest.json maps each
+# original path to its fingerprinted one. Stylesheets are rewritten to point
+# at the fingerprinted names of the fonts and images they reference.
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = 'manifest.json'
+COMPRESSIBLE = {'.css', '.js', '.map', '.svg', '.ttf', '.otf', '.eot', '.ico', '.json', '.txt', '.html'}
+# variants that don't save at least this fraction of the file aren't kept
+MIN_SAVING = 0.05
+
+css_url = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+source_map = re.compile(r'(sourceMappingURL=)(\S+)')
+
+
+def fingerprint(path, content):
+    root, ext = posixpath.splitext(path)
+    return '%s.%s%s' % (root, hashlib.sha256(content).hexdigest()[:12], ext)
+
+
+def source_files(static_folder, out_folder):
+    # static paths, '/'-separated and relative to static_folder, leaving out the build output
+    for directory, subdirectories, filenames in os.walk(static_folder):
+        subdirectories[:] = sorted(name for name in subdirectories
+                                   if os.path.join(directory, name) != out_folder)
+        for filename in sorted(filenames):
+            if filename.startswith('.'):
+                continue
+            path = os.path.relpath(os.path.join(directory, filename), static_folder)
+            yield path.replace(os.sep, '/')
+
+
+def rewrite_references(path, content, manifest):
+    # point url(...) and sourceMappingURL references at fingerprinted names
+    directory = posixpath.dirname(path)
+
+    def replace(reference):
+        # keep ?#iefix style suffixes
+        target, suffix = re.match(r'([^?#]*)(.*)', reference).groups()
+        if not target or re.match(r'^([a-z]+:|/)', target):
+            return reference
+        resolved = posixpath.normpath(posixpath.join(directory, target))
+        if resolved not in manifest:
+            return reference
+        return posixpath.relpath(manifest[resolved], directory or '.') + suffix
+
+    try:
+        text = content.decode('utf-8')
+    except UnicodeDecodeError:
+        return content
+    text = css_url.sub(lambda m: 'url(%s%s%s)' % (m.group(1), replace(m.group(2)), m.group(1)), text)
+    text = source_map.sub(lambda m: m.group(1) + replace(m.group(2)), text)
+    return text.encode('utf-8')
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def compressed_variants(content):
+    # (suffix, bytes) for each encoding that is worth serving
+    variants = [('.gz', gzip.compress(content, 9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(content, quality=11)))
+    return [(suffix, data) for suffix, data in variants
+            if len(data) <= len(content) * (1 - MIN_SAVING)]
+
+
+def build(static_folder, out_folder):
+    '''
+    fingerprints and precompresses every file under static_folder into
+    out_folder and writes the manifest; returns the manifest
+    '''
+    paths = list(source_files(static_folder, out_folder))
+    # stylesheets last, so the files they reference already have their names
+    paths.sort(key=lambda path: posixpath.splitext(path)[1] in ('.css', '.js'))
+    manifest = {}
+    for path in paths:
+        with open(os.path.join(static_folder, path), 'rb') as f:
+            content = f.read()
+        ext = posixpath.splitext(path)[1].lower()
+        if ext in ('.css', '.js'):
+            content = rewrite_references(path, content, manifest)
+        built = fingerprint(path, content)
+        manifest[path] = built
+        target = os.path.join(out_folder, built)
+        write(target, content)
+        if ext in COMPRESSIBLE:
+            for suffix, data in compressed_variants(content):
+                write(target + suffix, data)
+    with open(os.path.join(out_folder, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(out_folder):
+    # the manifest of the last build, empty if assets were never built
+    try:
+        with open(os.path.join(out_folder, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
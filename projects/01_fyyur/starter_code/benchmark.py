@@ -0,0 +1,64 @@
+import math
+import resource
+import sys
+import time
+
+import sqlstats
+
+# Route benchmark: requests URLs through the Flask test client and reports
+# latency percentiles, the SQL statements each request ran and the peak
+# resident set size of the process.
+
+
+def percentile(values, fraction):
+    # nearest-rank percentile of a non-empty list
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run(app, routes, requests):
+    '''
+    requests each route `requests` times, cycling through its URLs, after one
+    untimed warm-up request; routes maps a label to a list of URLs. Returns a
+    list of {'route', 'p50', 'p95', 'queries', 'db', 'status'}, times in ms.
+    '''
+    client = app.test_client()
+    results = []
+    for label, urls in routes.items():
+        client.get(urls[0]).close()
+        timings, queries, db_times, statuses = [], [], [], set()
+        for number in range(requests):
+            with sqlstats.recording() as stats:
+                started = time.perf_counter()
+                response = client.get(urls[number % len(urls)])
+                # streamed pages render while the body is read
+                response.get_data()
+                timings.append((time.perf_counter() - started) * 1000)
+                response.close()
+            queries.append(stats.count)
+            db_times.append(stats.duration * 1000)
+            statuses.add(response.status_code)
+        results.append({
+            'route': label,
+            'p50': percentile(timings, 0.5),
+            'p95': percentile(timings, 0.95),
+            'queries': percentile(queries, 0.5),
+            'db': percentile(db_times, 0.5),
+            'status': ','.join(str(status) for status in sorted(statuses)),
+        })
+    return results
+
+
+def report(results, echo):
+    echo('%-40s %9s %9s %8s %9s %7s' % ('route', 'p50 ms', 'p95 ms', 'queries', 'db ms', 'status'))
+    for result in results:
+        echo('%-40s %9.1f %9.1f %8d %9.1f %7s' % (
+            result['route'][:40], result['p50'], result['p95'], result['queries'], result['db'],
+            result['status']))
+    echo('peak RSS: %.0f MB' % peak_rss_mb())
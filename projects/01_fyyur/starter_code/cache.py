@@ -0,0 +1,68 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Read-through cache for venue and artist page payloads, keyed by (kind, id).
+# A payload loaded while its entity was invalidated, or the cache cleared, is
+# returned but never stored: the keys being loaded carry a counter that
+# invalidate() bumps, and clear() bumps one for the whole cache. The counters
+# only exist while a load is running, so they don't outgrow the entries.
+# Least recently used entries are evicted past maxsize, and every entry
+# expires after ttl seconds, which bounds how long a change made by another
+# worker process can go unnoticed.
+
+
+class DetailCache:
+
+    def __init__(self, maxsize=1000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        # key -> [loads running, invalidations since the first started]
+        self.loading = {}
+        self.generation = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, kind, id, load):
+        '''returns the cached payload for (kind, id), calling load() on a miss'''
+        key = (kind, id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                return entry[1]
+            state = self.loading.setdefault(key, [0, 0])
+            state[0] += 1
+            version = (self.generation, state[1])
+
+        value = None
+        try:
+            value = load()
+        finally:
+            with self.lock:
+                state = self.loading[key]
+                current = (self.generation, state[1])
+                state[0] -= 1
+                if not state[0]:
+                    del self.loading[key]
+                if value is not None and self.maxsize > 0 and current == version:
+                    self.entries[key] = (time.monotonic() + self.ttl, value)
+                    self.entries.move_to_end(key)
+                    while len(self.entries) > self.maxsize:
+                        self.entries.popitem(last=False)
+        return value
+
+    def invalidate(self, kind, id):
+        key = (kind, id)
+        with self.lock:
+            self.entries.pop(key, None)
+            if key in self.loading:
+                self.loading[key][1] += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
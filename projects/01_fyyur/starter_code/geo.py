@@ -0,0 +1,96 @@
+import csv
+import heapq
+import math
+import threading
+
+# Venue locations. Venues are placed offline from a CSV of city,state,
+# latitude,longitude rows (places.csv), and a grid index buckets them by
+# CELL_DEGREES latitude/longitude cells, so a radius search only looks at
+# the cells around the point instead of every venue.
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+CELL_DEGREES = 0.1
+
+
+def place_key(city, state):
+    return (city or '').strip().casefold(), (state or '').strip().upper()
+
+
+def load_places(path):
+    # {(city, state): (latitude, longitude)}; empty when the file is missing
+    try:
+        with open(path, newline='', encoding='utf-8') as f:
+            return {place_key(row['city'], row['state']): (float(row['latitude']), float(row['longitude']))
+                    for row in csv.DictReader(f)}
+    except OSError:
+        return {}
+
+
+def distance_km(lat1, lng1, lat2, lng2):
+    # great-circle (haversine) distance
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GridIndex:
+
+    def __init__(self, cell_degrees=CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        self.columns = math.ceil(360 / cell_degrees)
+        self.lock = threading.Lock()
+        self.cells = {}
+        self.points = {}
+
+    def __len__(self):
+        return len(self.points)
+
+    def cell(self, lat, lng):
+        return (math.floor((lat + 90) / self.cell_degrees),
+                math.floor((lng + 180) / self.cell_degrees) % self.columns)
+
+    def add(self, point_id, lat, lng):
+        # add (or move) one point
+        with self.lock:
+            self._remove(point_id)
+            self.points[point_id] = (lat, lng)
+            self.cells.setdefault(self.cell(lat, lng), {})[point_id] = (lat, lng)
+
+    def remove(self, point_id):
+        with self.lock:
+            self._remove(point_id)
+
+    def _remove(self, point_id):
+        point = self.points.pop(point_id, None)
+        if point is not None:
+            cell = self.cell(*point)
+            del self.cells[cell][point_id]
+            if not self.cells[cell]:
+                del self.cells[cell]
+
+    def nearest(self, lat, lng, radius_km, count):
+        '''
+        up to count (distance_km, point_id) pairs within radius_km of the
+        point, nearest first; only the cells overlapping the radius are read
+        '''
+        lat_span = radius_km / KM_PER_DEGREE
+        # a degree of longitude shrinks towards the poles, so size the span at
+        # the box's latitude nearest to one
+        shrink = math.cos(math.radians(min(abs(lat) + lat_span, 90)))
+        lng_span = 180 if shrink < 1e-9 else min(radius_km / (KM_PER_DEGREE * shrink), 180)
+        first_row, first_column = self.cell(max(lat - lat_span, -90), lng - lng_span)
+        last_row, last_column = self.cell(min(lat + lat_span, 90), lng + lng_span)
+        column_count = (last_column - first_column) % self.columns + 1 if lng_span < 180 else self.columns
+
+        candidates = []
+        with self.lock:
+            for row in range(first_row, last_row + 1):
+                for offset in range(column_count):
+                    points = self.cells.get((row, (first_column + offset) % self.columns))
+                    if points:
+                        candidates.extend(points.items())
+        matches = ((distance_km(lat, lng, point_lat, point_lng), point_id)
+                   for point_id, (point_lat, point_lng) in candidates)
+        return heapq.nsmallest(count, (match for match in matches if match[0] <= radius_km))
@@ -0,0 +1,65 @@
+from datetime import datetime
+
+# Minimal iCalendar (RFC 5545) writer for the venue and artist show feeds.
+# Times are written as floating local times, the same naive datetimes the
+# shows table stores.
+
+
+def escape(text):
+    return (text or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,') \
+        .replace('\r\n', '\\n').replace('\n', '\\n')
+
+
+def format_time(value):
+    return value.strftime('%Y%m%dT%H%M%S')
+
+
+def fold(line):
+    # content lines longer than 75 octets continue on lines starting with a space
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return line
+    parts = []
+    while encoded:
+        limit = 75 if not parts else 74
+        # don't split a multi-byte character
+        while limit < len(encoded) and (encoded[limit] & 0xC0) == 0x80:
+            limit -= 1
+        parts.append(encoded[:limit].decode('utf-8'))
+        encoded = encoded[limit:]
+    return '\r\n '.join(parts)
+
+
+def event(uid, start, end, summary, location=None, url=None, stamp=None):
+    lines = [
+        'BEGIN:VEVENT',
+        'UID:' + uid,
+        'DTSTAMP:' + format_time(stamp or datetime.utcnow()) + 'Z',
+        'DTSTART:' + format_time(start),
+        'DTEND:' + format_time(end),
+        'SUMMARY:' + escape(summary),
+    ]
+    if location:
+        lines.append('LOCATION:' + escape(location))
+    if url:
+        lines.append('URL:' + url)
+    lines.append('END:VEVENT')
+    return lines
+
+
+def calendar(name, events):
+    '''
+    returns the text of a VCALENDAR named name; events is an iterable of the
+    line lists event() returns
+    '''
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//Fyyur//Show calendar//EN',
+        'CALSCALE:GREGORIAN',
+        'X-WR-CALNAME:' + escape(name),
+    ]
+    for event_lines in events:
+        lines.extend(event_lines)
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(fold(line) for line in lines) + '\r\n'
@@ -0,0 +1,293 @@
+import hashlib
+import http.client
+import io
+import ipaddress
+import mimetypes
+import os
+import socket
+import ssl
+import tempfile
+import threading
+import urllib.parse
+from contextlib import contextmanager
+
+# Image proxy: remote venue and artist images are fetched once, cut down to
+# fixed-size JPEG thumbnails with Pillow (optional, `pip install Pillow`;
+# without it the original image is cached and served as is) and kept in a
+# content-addressed disk cache that drops the least recently used files once
+# it grows past its size limit.
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# the cache folder is locked with flock where there is one (not on Windows)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+THUMBNAIL_QUALITY = 85
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+# eviction deletes files until the cache is down to this share of its limit
+LOW_WATER = 0.9
+
+
+class ImageError(Exception):
+    # the image could not be fetched or decoded
+    pass
+
+
+def resolve(host, port, allow_private):
+    '''
+    the address to connect to for host; the fetch connects to it directly
+    rather than resolving host again, so a second DNS answer can't send it
+    somewhere the check didn't see
+    '''
+    try:
+        addresses = [info[4][0] for info in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)]
+    except (OSError, UnicodeError) as error:
+        raise ImageError('could not resolve %s: %s' % (host, error))
+    # image links are user input; don't let them reach the server's own network
+    if not allow_private and not all(ipaddress.ip_address(address.split('%')[0]).is_global
+                                     for address in addresses):
+        raise ImageError('not a public address: %s' % host)
+    return addresses[0]
+
+
+class PinnedHTTPConnection(http.client.HTTPConnection):
+    # sends Host: host, but connects to an address resolved and checked beforehand
+
+    def __init__(self, host, address, **kwargs):
+        super().__init__(host, **kwargs)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port), self.timeout)
+
+
+class PinnedHTTPSConnection(http.client.HTTPSConnection):
+    # the certificate is still checked against host
+
+    def __init__(self, host, address, **kwargs):
+        self.ssl_context = ssl.create_default_context()
+        super().__init__(host, context=self.ssl_context, **kwargs)
+        self.address = address
+
+    def connect(self):
+        sock = socket.create_connection((self.address, self.port), self.timeout)
+        self.sock = self.ssl_context.wrap_socket(sock, server_hostname=self.host)
+
+
+def fetch(url, timeout, max_bytes, allow_private=False):
+    # (body, content type) of an image URL; every redirect is checked like the URL itself
+    for redirect in range(MAX_REDIRECTS + 1):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ImageError('not an http(s) URL: %s' % url)
+        try:
+            port = parts.port or (443 if parts.scheme == 'https' else 80)
+        except ValueError:
+            raise ImageError('bad port in %s' % url)
+        address = resolve(parts.hostname, port, allow_private)
+        connection_class = PinnedHTTPSConnection if parts.scheme == 'https' else PinnedHTTPConnection
+        connection = connection_class(parts.hostname, address, port=port, timeout=timeout)
+        try:
+            connection.request('GET', urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, '')),
+                               headers={'User-Agent': 'Fyyur image proxy'})
+            response = connection.getresponse()
+            location = response.getheader('Location')
+            if response.status in REDIRECT_STATUSES and location:
+                url = urllib.parse.urljoin(url, location)
+                continue
+            content_type = response.headers.get_content_type()
+            data = response.read(max_bytes + 1)
+        except (OSError, http.client.HTTPException) as error:
+            raise ImageError('fetching %s failed: %s' % (url, error))
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise ImageError('fetching %s failed: HTTP %d' % (url, response.status))
+        if not content_type.startswith('image/'):
+            raise ImageError('%s is %s, not an image' % (url, content_type))
+        if len(data) > max_bytes:
+            raise ImageError('%s is larger than %d bytes' % (url, max_bytes))
+        return data, content_type
+    raise ImageError('too many redirects: %s' % url)
+
+
+def thumbnail(data, content_type, size):
+    '''
+    (JPEG bytes, 'image/jpeg') of exactly size (width, height), cropped to
+    fill it; without Pillow the image is returned unchanged
+    '''
+    if Image is None:
+        return data, content_type
+    try:
+        image = Image.open(io.BytesIO(data))
+        # JPEGs can decode straight to a smaller scale
+        image.draft('RGB', (size[0] * 2, size[1] * 2))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        image = ImageOps.fit(image, size, Image.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=THUMBNAIL_QUALITY, optimize=True, progressive=True)
+    except (OSError, ValueError, Image.DecompressionBombError) as error:
+        raise ImageError('could not read the image: %s' % error)
+    return output.getvalue(), 'image/jpeg'
+
+
+class DiskCache:
+    '''
+    Every file is stored once, under objects/ and named by the sha256 of its
+    content; keys/ maps each key (an image URL and size) to one. Every process
+    using the folder shares one size budget: the total is kept in a size file
+    they update under the folder lock, and once it passes max_bytes the folder
+    is scanned and the least recently used files (by modification time, which
+    get() refreshes) are deleted down to LOW_WATER of it, together with the
+    keys that pointed to them.
+    '''
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+    def path(self, *parts):
+        return os.path.join(self.folder, *parts)
+
+    def key_path(self, key):
+        return self.path('keys', hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    @contextmanager
+    def locked(self):
+        # the threads of this process, then other processes
+        with self.lock:
+            os.makedirs(self.folder, exist_ok=True)
+            with open(self.path('lock'), 'a') as lock_file:
+                if fcntl is not None:
+                    # released when the file is closed
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                yield
+
+    def get(self, key):
+        # (path, digest, content type) of the file stored for key, or None
+        try:
+            with open(self.key_path(key)) as f:
+                name = f.read().strip()
+        except OSError:
+            return None
+        try:
+            # the recency order every process shares
+            os.utime(self.path(name))
+        except OSError:
+            # evicted; the key goes with the next eviction
+            return None
+        return self.describe(name)
+
+    def describe(self, name):
+        digest, extension = os.path.splitext(os.path.basename(name))
+        return self.path(name), digest, mimetypes.guess_type('image' + extension)[0] or 'application/octet-stream'
+
+    def put(self, key, data, content_type):
+        digest = hashlib.sha256(data).hexdigest()
+        name = os.path.join('objects', digest[:2], digest + (mimetypes.guess_extension(content_type) or ''))
+        path = self.path(name)
+        with self.locked():
+            size = self.read_size()
+            if os.path.exists(path):
+                os.utime(path)
+            else:
+                write_file(path, data)
+                if size is not None:
+                    size += len(data)
+            write_file(self.key_path(key), name.encode('utf-8'))
+            if size is None or size > self.max_bytes:
+                # a missing size file is rebuilt by the scan
+                size = self.evict(keep=path)
+            write_file(self.path('size'), str(size).encode('ascii'))
+        return self.describe(name)
+
+    def read_size(self):
+        try:
+            with open(self.path('size')) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def evict(self, keep):
+        '''
+        called with the folder locked; deletes the least recently used files
+        until the rest fit in LOW_WATER of max_bytes, keeping the file just
+        stored even if it alone is too big, then the keys of deleted files;
+        returns the size left
+        '''
+        files = []
+        for directory, subdirectories, filenames in os.walk(self.path('objects')):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, path, stat.st_size))
+        files.sort()
+        size = sum(file_size for mtime, path, file_size in files)
+        remaining = {path for mtime, path, file_size in files}
+        for mtime, path, file_size in files:
+            if size <= self.max_bytes * LOW_WATER:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            remaining.discard(path)
+            size -= file_size
+        # including keys of files another process deleted
+        with os.scandir(self.path('keys')) as entries:
+            for entry in entries:
+                try:
+                    with open(entry.path) as f:
+                        if self.path(f.read().strip()) in remaining:
+                            continue
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+        return size
+
+    def get_or_create(self, key, create):
+        '''
+        the cached file for key, calling create() for its (data, content type)
+        on a miss; concurrent misses on the same key wait for one create()
+        '''
+        cached = self.get(key)
+        if cached:
+            return cached
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        try:
+            with key_lock:
+                cached = self.get(key)
+                if cached:
+                    return cached
+                return self.put(key, *create())
+        finally:
+            with self.lock:
+                self.key_locks.pop(key, None)
+
+
+def write_file(path, data):
+    # readers see the old file or the whole new one, never a partial write
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(descriptor, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
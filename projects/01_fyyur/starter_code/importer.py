@@ -0,0 +1,111 @@
+import csv
+import io
+import json
+from datetime import datetime
+
+from sqlalchemy import Integer
+from werkzeug.datastructures import MultiDict
+from wtforms import SelectMultipleField
+
+# Bulk import of venues, artists and shows. Records are streamed from CSV or
+# NDJSON, checked with the same form classes the create pages use, and written
+# in batches with executemany or, on Postgres, COPY.
+
+
+def read_records(stream, format):
+    '''yields (line number, record dict or None if the line can't be parsed)'''
+    if format == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+    else:
+        for number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield number, record if isinstance(record, dict) else None
+
+
+def form_data(record, multiple):
+    # record values as posted by the form: one entry per selected choice,
+    # checkboxes as 'y' or absent, CSV multi-selects as comma separated text
+    data = MultiDict()
+    for key, value in record.items():
+        if value is None or value is False:
+            continue
+        if value is True:
+            value = 'y'
+        if key in multiple and isinstance(value, str):
+            value = [item.strip() for item in value.split(',') if item.strip()]
+        if isinstance(value, list):
+            for item in value:
+                data.add(key, str(item))
+        else:
+            data.add(key, str(value))
+    return data
+
+
+def validate_records(records, form_class, table):
+    '''
+    yields (line, row, errors): row is a dict of column values ready to insert
+    when the record passes form_class validation, otherwise errors says why
+    '''
+    columns = [column for column in table.columns if not column.primary_key]
+    multiple = {field.name for field in form_class(meta={'csrf': False})
+                if isinstance(field, SelectMultipleField)}
+    for line, record in records:
+        if record is None:
+            yield line, None, {'record': ['Could not parse this line.']}
+            continue
+        form = form_class(formdata=form_data(record, multiple), meta={'csrf': False})
+        if not form.validate():
+            yield line, None, form.errors
+            continue
+        row = {}
+        errors = {}
+        for column in columns:
+            if column.name not in form:
+                continue
+            value = form[column.name].data
+            if isinstance(column.type, Integer):
+                try:
+                    value = int(value)
+                except (TypeError, ValueError):
+                    errors[column.name] = ['Not a valid integer value.']
+            row[column.name] = value
+        yield line, (None if errors else row), errors or None
+
+
+def copy_value(value):
+    if value is None:
+        return r'\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    if isinstance(value, (list, tuple)):
+        items = ('"%s"' % str(item).replace('\\', '\\\\').replace('"', '\\"') for item in value)
+        return '{%s}' % ','.join(items)
+    return value
+
+
+def insert_rows(connection, table, rows, use_copy=False):
+    '''writes rows (dicts with the same keys) in one round trip'''
+    if not use_copy:
+        connection.execute(table.insert(), rows)
+        return
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([copy_value(row[column]) for column in columns])
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert('COPY "%s" (%s) FROM STDIN WITH (FORMAT csv, NULL \'\\N\')' % (
+            table.name, ', '.join('"%s"' % column for column in columns)), buffer)
+    finally:
+        cursor.close()
@@ -0,0 +1,110 @@
+import logging
+import os
+import queue
+import threading
+from logging.handlers import QueueHandler, RotatingFileHandler, WatchedFileHandler
+
+# Non-blocking logging. Request threads only put records on a bounded queue;
+# one background thread takes them off in batches, writes them to the log file
+# and flushes once per batch. When the queue is full, records are dropped (and
+# counted) rather than making a request wait on disk I/O.
+#
+# Every worker process appends to the same file. By default it is rotated by
+# an external logrotate (without copytruncate); each worker reopens the file
+# once it has been moved. With max_bytes the file is rotated here instead,
+# which is only safe with a single process writing it: two workers would each
+# rotate on their own count and rename the file under each other.
+
+
+class DroppingQueueHandler(QueueHandler):
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchFlush:
+    # emit() normally flushes after every record; flush once per batch instead
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+
+class BatchFileHandler(BatchFlush, WatchedFileHandler):
+    pass
+
+
+class BatchRotatingFileHandler(BatchFlush, RotatingFileHandler):
+    pass
+
+
+class QueueLogging:
+
+    def __init__(self, filename, max_bytes=0, backup_count=0, queue_size=10000, batch_size=100):
+        if max_bytes:
+            self.file_handler = BatchRotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count)
+        else:
+            self.file_handler = BatchFileHandler(filename)
+        self.handler = DroppingQueueHandler(queue.Queue(queue_size))
+        self.batch_size = batch_size
+        self.reported_drops = 0
+        self.thread = None
+        self.start()
+        # a forked worker (gunicorn --preload) inherits the queue but not the thread
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.restart)
+
+    def setFormatter(self, formatter):
+        self.file_handler.setFormatter(formatter)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='log-writer', daemon=True)
+        self.thread.start()
+
+    def restart(self):
+        self.handler.queue = queue.Queue(self.handler.queue.maxsize)
+        self.start()
+
+    def stop(self):
+        # write out what is queued and end the background thread
+        if self.thread is not None and self.thread.is_alive():
+            self.handler.queue.put(None)
+            self.thread.join()
+        self.file_handler.close()
+
+    def run(self):
+        log_queue = self.handler.queue
+        while True:
+            batch = [log_queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(log_queue.get_nowait())
+                except queue.Empty:
+                    break
+            for record in batch:
+                if record is not None:
+                    self.file_handler.handle(record)
+            self.report_drops()
+            self.file_handler.flush_batch()
+            if None in batch:
+                return
+
+    def report_drops(self):
+        dropped = self.handler.dropped - self.reported_drops
+        if dropped:
+            self.reported_drops += dropped
+            self.file_handler.handle(logging.makeLogRecord({
+                'name': 'logqueue',
+                'levelno': logging.WARNING,
+                'levelname': 'WARNING',
+                'msg': '%d log records dropped, the log queue was full' % dropped,
+            }))
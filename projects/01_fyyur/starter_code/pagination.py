@@ -0,0 +1,83 @@
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import DateTime, tuple_
+
+# Keyset (cursor) pagination. Each page continues from the sort key of the
+# last row the client saw (WHERE (key) > (cursor) ORDER BY key LIMIT n), so
+# the database walks an index from that point instead of counting past an
+# OFFSET, and the cost of a page doesn't grow with how deep it is.
+
+
+def encode_cursor(values):
+    values = [value.isoformat() if isinstance(value, datetime) else value
+              for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+class InvalidCursor(ValueError):
+    # a cursor this listing doesn't hand out: malformed, or not one value of the right type per column
+    pass
+
+
+def decode_cursor(cursor, columns):
+    # returns the key values for columns; the database only sees values of the columns' types
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise InvalidCursor(cursor)
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise InvalidCursor(cursor)
+    return tuple(cursor_value(column, value, cursor) for column, value in zip(columns, values))
+
+
+def cursor_value(column, value, cursor):
+    if isinstance(column.type, DateTime):
+        try:
+            moment = datetime.fromisoformat(value)
+        except (ValueError, TypeError):
+            raise InvalidCursor(cursor)
+        # the columns are naive
+        if moment.tzinfo is not None:
+            raise InvalidCursor(cursor)
+        return moment
+    # exact types: JSON true is not an id, and 1.5 isn't one either
+    if type(value) is not column.type.python_type:
+        raise InvalidCursor(cursor)
+    return value
+
+
+def keyset_page(query, columns, row_key, after=None, before=None, per_page=50):
+    '''
+    returns {'items', 'prev', 'next'} for the page of query following the
+    `after` cursor (or preceding the `before` cursor); columns must form a
+    unique sort key and row_key(row) must return their values for a row.
+    Raises InvalidCursor for a cursor that doesn't fit the columns.
+    '''
+    key = tuple_(*columns)
+    before = before and decode_cursor(before, columns)
+    after = after and decode_cursor(after, columns)
+
+    if before:
+        # walk the index backwards from the cursor, then restore ascending order
+        rows = query.filter(key < before) \
+            .order_by(*[column.desc() for column in columns]) \
+            .limit(per_page + 1) \
+            .all()
+        has_prev = len(rows) > per_page
+        rows = rows[:per_page][::-1]
+        has_next = True
+    else:
+        if after:
+            query = query.filter(key > after)
+        rows = query.order_by(*columns).limit(per_page + 1).all()
+        has_next = len(rows) > per_page
+        rows = rows[:per_page]
+        has_prev = bool(after)
+
+    return {
+        'items': rows,
+        'prev': encode_cursor(row_key(rows[0])) if rows and has_prev else None,
+        'next': encode_cursor(row_key(rows[-1])) if rows and has_next else None,
+    }
@@ -0,0 +1,151 @@
+# Artist suggestions for venues and venue suggestions for artists, scored
+# from genres and booking history with NumPy (optional, `pip install numpy`;
+# without it no suggestions are shown).
+#
+# Every venue and artist is a unit vector over the genres it lists. From the
+# shows, the recommender keeps a genre co-occurrence matrix (how often a venue
+# listing genre g booked an artist listing genre h) and, per venue and
+# artist, the summed genre vectors of everyone it has been booked with. A
+# venue's query vector is its own genres carried through the co-occurrence
+# matrix into artist genres, plus the genres of the artists it actually
+# books. Artists are ranked by cosine similarity to it, each as its own
+# genres plus the genres of the venues it plays, and the same works the
+# other way round. A show only changes the matrix and two venue and artist
+# rows, so bookings are applied in place instead of rebuilding.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# weight of the booking history and of the co-occurrence matrix relative to
+# an exact genre match
+HISTORY_WEIGHT = 1.0
+COOCCURRENCE_WEIGHT = 1.0
+
+
+def unit(vectors):
+    # rows (or a single vector) scaled to length 1; zero vectors stay zero
+    norms = numpy.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / numpy.where(norms == 0, 1, norms)
+
+
+class Side:
+    # the venues or the artists: ids, genre vectors, booking history and the
+    # blend of both they are ranked by, in arrays with spare capacity so new
+    # rows are appended in place
+
+    def __init__(self, ids, genres):
+        self.size = len(ids)
+        self.ids = numpy.array(ids, dtype=numpy.int64)
+        self.rows = {id: row for row, id in enumerate(ids)}
+        self.genres = genres
+        self.history = numpy.zeros_like(genres)
+        self.profiles = genres.copy()
+
+    def refresh(self, rows):
+        self.profiles[rows] = unit(self.genres[rows] + HISTORY_WEIGHT * unit(self.history[rows]))
+
+    def add(self, id, genres):
+        if self.size == len(self.ids):
+            capacity = max(2 * self.size, 16)
+            self.ids = numpy.resize(self.ids, capacity)
+            self.genres = numpy.resize(self.genres, (capacity, self.genres.shape[1]))
+            self.history = numpy.resize(self.history, (capacity, self.history.shape[1]))
+            self.profiles = numpy.resize(self.profiles, (capacity, self.profiles.shape[1]))
+        self.ids[self.size] = id
+        self.genres[self.size] = genres
+        self.history[self.size] = 0
+        self.profiles[self.size] = genres
+        self.rows[id] = self.size
+        self.size += 1
+
+
+class Recommender:
+
+    def __init__(self, genres, venues, artists, bookings):
+        '''
+        genres: every genre name; venues and artists: (id, genres) pairs;
+        bookings: (venue_id, artist_id, number of shows) rows. Bookings of
+        venues or artists that aren't listed are left out.
+        '''
+        self.columns = {genre: column for column, genre in enumerate(genres)}
+        self.venues = Side(*self.vectors(venues))
+        self.artists = Side(*self.vectors(artists))
+
+        bookings = numpy.array([(self.venues.rows[venue_id], self.artists.rows[artist_id], count)
+                                for venue_id, artist_id, count in bookings
+                                if venue_id in self.venues.rows and artist_id in self.artists.rows],
+                               dtype=numpy.intp).reshape(-1, 3)
+        venue_rows, artist_rows, counts = bookings.T
+        counts = counts.astype(numpy.float32)
+        venue_genres = self.venues.genres[venue_rows] * counts[:, None]
+        artist_genres = self.artists.genres[artist_rows]
+        # cooccurrence[g, h]: shows where the venue lists genre g and the artist genre h
+        self.cooccurrence = venue_genres.T @ artist_genres
+        numpy.add.at(self.venues.history, venue_rows, artist_genres * counts[:, None])
+        numpy.add.at(self.artists.history, artist_rows, venue_genres)
+        self.venues.refresh(slice(None))
+        self.artists.refresh(slice(None))
+
+    def vectors(self, profiles):
+        ids, rows = [], []
+        for id, genres in profiles:
+            ids.append(id)
+            rows.append(self.vector(genres))
+        return ids, numpy.array(rows, dtype=numpy.float32).reshape(len(ids), len(self.columns))
+
+    def vector(self, genres):
+        vector = numpy.zeros(len(self.columns), dtype=numpy.float32)
+        for genre in genres or ():
+            if genre in self.columns:
+                vector[self.columns[genre]] = 1
+        return unit(vector)
+
+    def add_venue(self, venue_id, genres):
+        self.venues.add(venue_id, self.vector(genres))
+
+    def add_artist(self, artist_id, genres):
+        self.artists.add(artist_id, self.vector(genres))
+
+    def add_show(self, venue_id, artist_id):
+        # returns False when the venue or artist isn't known, and the caller should rebuild
+        venue_row = self.venues.rows.get(venue_id)
+        artist_row = self.artists.rows.get(artist_id)
+        if venue_row is None or artist_row is None:
+            return False
+        venue_genres, artist_genres = self.venues.genres[venue_row], self.artists.genres[artist_row]
+        self.cooccurrence += numpy.outer(venue_genres, artist_genres)
+        self.venues.history[venue_row] += artist_genres
+        self.artists.history[artist_row] += venue_genres
+        self.venues.refresh(venue_row)
+        self.artists.refresh(artist_row)
+        return True
+
+    def artists_for_venue(self, venue_id, count, exclude=()):
+        # [(artist_id, score)], best first
+        return self.suggest(self.venues, self.artists, self.cooccurrence, venue_id, count, exclude)
+
+    def venues_for_artist(self, artist_id, count, exclude=()):
+        # [(venue_id, score)], best first
+        return self.suggest(self.artists, self.venues, self.cooccurrence.T, artist_id, count, exclude)
+
+    def suggest(self, side, candidates, cooccurrence, id, count, exclude):
+        row = side.rows.get(id)
+        if row is None or not candidates.size:
+            return []
+        genres = side.genres[row]
+        # each of the genres' share of the other side's genres it was booked with
+        translated = genres @ unit(cooccurrence)
+        query = unit(genres + COOCCURRENCE_WEIGHT * unit(translated)
+                     + HISTORY_WEIGHT * unit(side.history[row]))
+        scores = candidates.profiles[:candidates.size] @ query
+        for excluded in exclude:
+            if excluded in candidates.rows:
+                scores[candidates.rows[excluded]] = 0
+        count = min(count, candidates.size)
+        best = numpy.argpartition(-scores, count - 1)[:count]
+        best = best[scores[best] > 0]
+        # highest score first, then by id
+        best = best[numpy.lexsort((candidates.ids[best], -scores[best]))]
+        return [(int(candidates.ids[index]), float(scores[index])) for index in best]
@@ -0,0 +1,93 @@
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+
+# Read-replica routing. Views marked with @read_only run their queries on
+# the 'replica' bind; everything else (writes, edit forms, CLI commands)
+# stays on the primary. A client that has just committed a write gets a
+# cookie that keeps its reads on the primary for READ_YOUR_WRITES_SECONDS,
+# so it never sees a replica that has not caught up with its own change.
+# In-process indexes and caches outlive the request that fills them, so they
+# always load from the primary (see use_primary).
+
+REPLICA = 'replica'
+LAST_WRITE_COOKIE = 'last_write'
+
+
+def read_only(view):
+    # marks a view function whose queries may be served by the replica
+    view.read_only = True
+    return view
+
+
+@contextmanager
+def use_primary():
+    # runs the block's queries on the primary, even inside a read-only view
+    if not has_request_context() or not g.get('use_replica'):
+        yield
+        return
+    g.use_replica = False
+    try:
+        yield
+    finally:
+        g.use_replica = True
+
+
+def replica_configured(app):
+    return REPLICA in (app.config.get('SQLALCHEMY_BINDS') or {})
+
+
+class RoutingSession(SignallingSession):
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        # flushes always go to the primary, even inside a read-only view
+        if not self._flushing and has_request_context() and g.get('use_replica'):
+            return self.db.get_engine(self.app, bind=REPLICA)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def wrote_recently(app):
+    try:
+        last_write = float(request.cookies.get(LAST_WRITE_COOKIE, 0))
+    except ValueError:
+        return False
+    return time.time() - last_write < app.config['READ_YOUR_WRITES_SECONDS']
+
+
+def after_commit(session):
+    if has_request_context():
+        g.committed = True
+
+
+def init_app(app, db):
+    if not replica_configured(app):
+        return
+
+    event.listen(db.session, 'after_commit', after_commit)
+
+    @app.before_request
+    def choose_bind():
+        view = app.view_functions.get(request.endpoint)
+        g.use_replica = app.config['REPLICA_READS'] and getattr(view, 'read_only', False) \
+            and not wrote_recently(app)
+
+    @app.after_request
+    def remember_write(response):
+        if g.pop('committed', False):
+            window = app.config['READ_YOUR_WRITES_SECONDS']
+            response.set_cookie(LAST_WRITE_COOKIE, '%.3f' % time.time(), max_age=window,
+                                httponly=True)
+        return response
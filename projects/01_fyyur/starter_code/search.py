@@ -0,0 +1,106 @@
+import re
+import threading
+from bisect import bisect_left, insort
+
+# In-process inverted index for venue and artist search. Used when the
+# database has no trigram index to lean on (SQLite, tests): every token of
+# the indexed fields maps to the documents containing it, and a sorted
+# vocabulary makes prefix lookups a binary search instead of a scan.
+
+TOKEN_RE = re.compile(r'\w+')
+
+# a term matching a whole token scores higher than one matching its prefix
+EXACT_MATCH = 2.0
+PREFIX_MATCH = 1.0
+
+
+def tokenize(value):
+    if not value:
+        return []
+    if isinstance(value, (list, tuple)):
+        value = ' '.join(value)
+    return TOKEN_RE.findall(value.lower())
+
+
+class SearchIndex:
+
+    def __init__(self, weights):
+        # weights: {field name: score of a match in that field}
+        self.weights = weights
+        self.lock = threading.Lock()
+        self.postings = {}
+        self.documents = {}
+        self.vocabulary = []
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, doc_id, payload, fields):
+        # index (or re-index) one document; payload is what search() returns
+        token_weights = {}
+        for field, weight in self.weights.items():
+            for token in tokenize(fields.get(field)):
+                token_weights[token] = token_weights.get(token, 0) + weight
+        with self.lock:
+            self._remove(doc_id)
+            self.documents[doc_id] = (payload, token_weights)
+            for token, weight in token_weights.items():
+                if token not in self.postings:
+                    self.postings[token] = {}
+                    insort(self.vocabulary, token)
+                self.postings[token][doc_id] = weight
+
+    def remove(self, doc_id):
+        with self.lock:
+            self._remove(doc_id)
+
+    def _remove(self, doc_id):
+        document = self.documents.pop(doc_id, None)
+        if document is None:
+            return
+        for token in document[1]:
+            postings = self.postings[token]
+            del postings[doc_id]
+            if not postings:
+                del self.postings[token]
+                del self.vocabulary[bisect_left(self.vocabulary, token)]
+
+    def _expand(self, term):
+        # every indexed token starting with term, found by binary search
+        start = bisect_left(self.vocabulary, term)
+        end = bisect_left(self.vocabulary, term + '\uffff', start)
+        return self.vocabulary[start:end]
+
+    def search(self, query, offset=0, limit=None):
+        '''
+        returns (total, payloads) for documents matching every term of query,
+        best matches first; an empty query matches everything
+        '''
+        terms = tokenize(query)
+        with self.lock:
+            if not terms:
+                scores = dict.fromkeys(self.documents, 0)
+            else:
+                scores = None
+                for term in terms:
+                    term_scores = {}
+                    for token in self._expand(term):
+                        match = EXACT_MATCH if token == term else PREFIX_MATCH
+                        for doc_id, weight in self.postings[token].items():
+                            score = weight * match
+                            if score > term_scores.get(doc_id, 0):
+                                term_scores[doc_id] = score
+                    if scores is None:
+                        scores = term_scores
+                    else:
+                        scores = {doc_id: score + term_scores[doc_id]
+                                  for doc_id, score in scores.items()
+                                  if doc_id in term_scores}
+                    if not scores:
+                        break
+            documents = [(score, self.documents[doc_id][0])
+                         for doc_id, score in scores.items()]
+
+        documents.sort(key=lambda match: (-match[0], match[1]['name'] or ''))
+        end = None if limit is None else offset + limit
+        return len(documents), [payload for score, payload in documents[offset:end]]
@@ -0,0 +1,31 @@
+import json
+from datetime import date, datetime
+
+# JSON encoding for the API. orjson (optional, `pip install orjson`) is several
+# times faster than the standard library and writes datetimes natively; without
+# it the json module is used with the same compact output and ISO 8601 dates.
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError('%r is not JSON serializable' % type(value).__name__)
+
+
+def dumps(data):
+    # returns UTF-8 encoded JSON
+    if orjson is not None:
+        return orjson.dumps(data, default=default)
+    return json.dumps(data, default=default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def select_fields(record, fields):
+    # sparse fieldset: only the requested keys of record, always with its id
+    if not fields:
+        return record
+    return {key: value for key, value in record.items() if key in fields or key == 'id'}
@@ -0,0 +1,187 @@
+import os
+import random
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SessionInterface
+from itsdangerous import BadSignature, Signer
+from sqlalchemy import and_, select
+
+# Server-side sessions. The cookie only carries a signed session id and a
+# version number that goes up with every save; the data lives in a store.
+# MemoryStore keeps recent sessions in the worker, SQLStore in a table all
+# workers share, and TieredStore puts the first in front of the second: a
+# worker answers from memory only when it holds the version the cookie names,
+# so a session saved by another worker is always read back from the table.
+
+# share of SQL saves that also delete expired sessions
+CLEANUP_CHANCE = 0.001
+
+serializer = TaggedJSONSerializer()
+
+
+def stored_secret_key(path):
+    # a random key written to path the first time, so every worker on the host reads the same one
+    try:
+        descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # another worker may still be writing it
+        for attempt in range(50):
+            with open(path) as f:
+                key = f.read().strip()
+            if key:
+                return key
+            time.sleep(0.01)
+        raise RuntimeError('%s is empty; delete it or set SECRET_KEY' % path)
+    key = secrets.token_hex(32)
+    with os.fdopen(descriptor, 'w') as f:
+        f.write(key)
+    return key
+
+
+class ServerSession(SecureCookieSession):
+
+    def __init__(self, initial=None, sid=None, version=0):
+        super().__init__(initial)
+        self.sid = sid or secrets.token_urlsafe(32)
+        self.version = version
+        self.new = sid is None
+
+
+class MemoryStore:
+    # the max_entries most recently used sessions of this process; kept
+    # serialized so no request can change another's copy in place
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()
+
+    def load(self, sid, version):
+        with self.lock:
+            entry = self.sessions.get(sid)
+            if entry is None or entry[0] != version or entry[2] <= datetime.utcnow():
+                return None
+            self.sessions.move_to_end(sid)
+        return serializer.loads(entry[1])
+
+    def save(self, sid, version, data, expires):
+        data = serializer.dumps(data)
+        with self.lock:
+            self.sessions[sid] = (version, data, expires)
+            self.sessions.move_to_end(sid)
+            while len(self.sessions) > self.max_entries:
+                self.sessions.popitem(last=False)
+
+    def delete(self, sid):
+        with self.lock:
+            self.sessions.pop(sid, None)
+
+
+class SQLStore:
+    # sessions in a table with id, version, data and expires columns, on its own connection
+
+    def __init__(self, engine, table):
+        self.engine = engine
+        self.table = table
+
+    def record(self, sid):
+        # (version, data, expires) of the newest save, or None
+        table = self.table
+        with self.engine().connect() as connection:
+            row = connection.execute(select([table.c.version, table.c.data, table.c.expires]).where(
+                and_(table.c.id == sid, table.c.expires > datetime.utcnow()))).first()
+        return None if row is None else (row.version, serializer.loads(row.data), row.expires)
+
+    def load(self, sid, version):
+        # the newest saved data, even if the cookie names an older version
+        record = self.record(sid)
+        return None if record is None else record[1]
+
+    def save(self, sid, version, data, expires):
+        table = self.table
+        values = {'version': version, 'data': serializer.dumps(data), 'expires': expires}
+        with self.engine().begin() as connection:
+            updated = connection.execute(table.update().where(table.c.id == sid).values(values))
+            if not updated.rowcount:
+                connection.execute(table.insert().values(id=sid, **values))
+            if random.random() < CLEANUP_CHANCE:
+                connection.execute(table.delete().where(table.c.expires <= datetime.utcnow()))
+
+    def delete(self, sid):
+        with self.engine().begin() as connection:
+            connection.execute(self.table.delete().where(self.table.c.id == sid))
+
+
+class TieredStore:
+
+    def __init__(self, memory, shared):
+        self.memory = memory
+        self.shared = shared
+
+    def load(self, sid, version):
+        data = self.memory.load(sid, version)
+        if data is not None:
+            return data
+        record = self.shared.record(sid)
+        if record is None:
+            return None
+        self.memory.save(sid, *record)
+        return record[1]
+
+    def save(self, sid, version, data, expires):
+        self.shared.save(sid, version, data, expires)
+        self.memory.save(sid, version, data, expires)
+
+    def delete(self, sid):
+        self.shared.delete(sid)
+        self.memory.delete(sid)
+
+
+class ServerSessionInterface(SessionInterface):
+    # Flask session interface keeping the data in store; the cookie holds "id.version", signed
+
+    def __init__(self, store):
+        self.store = store
+
+    def signer(self, app):
+        return Signer(app.secret_key, salt='server-session')
+
+    def open_session(self, app, request):
+        if not app.secret_key:
+            return None
+        cookie = request.cookies.get(app.session_cookie_name)
+        if cookie:
+            try:
+                sid, version = self.signer(app).unsign(cookie).decode('ascii').rsplit('.', 1)
+                data = self.store.load(sid, int(version))
+            except (BadSignature, ValueError):
+                data = None
+            if data is not None:
+                return ServerSession(data, sid, int(version))
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+        if not session.modified:
+            return
+        session.version += 1
+        expires = datetime.utcnow() + app.permanent_session_lifetime
+        self.store.save(session.sid, session.version, dict(session), expires)
+        cookie = self.signer(app).sign('%s.%d' % (session.sid, session.version)).decode('ascii')
+        response.set_cookie(app.session_cookie_name, cookie,
+                            expires=self.get_expiration_time(app, session), httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path, secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
@@ -0,0 +1,129 @@
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Per-request SQL instrumentation: counts every statement the request runs,
+# times it, and reports the totals as response headers and a log line
+# (only the log line for a streamed response, logged when it is closed).
+# The same statement text repeated many times in one request is the
+# signature of a lazy load inside a loop (an N+1 pattern), so those are
+# logged as warnings. recording() collects the same numbers outside a request
+# (the benchmark uses it).
+
+# QueryStats collecting every statement, whatever the request; see recording()
+recorders = []
+
+
+class QueryStats:
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+        self.timings = []
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.statements[statement] += 1
+        self.timings.append((duration, statement))
+
+    def slowest(self, limit):
+        return sorted(self.timings, key=lambda timing: timing[0], reverse=True)[:limit]
+
+    def repeated(self, threshold):
+        return [(statement, count) for statement, count in self.statements.most_common()
+                if count >= threshold]
+
+
+def current_stats():
+    # the QueryStats of the request being handled, if it is being recorded
+    return g.get('sql_stats') if g else None
+
+
+def record(statement, duration):
+    stats = current_stats()
+    if stats is not None:
+        stats.record(statement, duration)
+    for recorder in recorders:
+        recorder.record(statement, duration)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # a stack, for statements run from inside another's execution
+    conn.info.setdefault('query_start_time', []).append((context, time.perf_counter()))
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_start_time'].pop()[1]
+    record(statement, time.perf_counter() - started)
+
+
+def handle_error(exception_context):
+    # a failed statement never reaches after_cursor_execute; take its start time off the stack
+    conn = exception_context.connection
+    if conn is None or conn.invalidated:
+        return
+    started = conn.info.get('query_start_time')
+    if started and started[-1][0] is exception_context.execution_context:
+        record(exception_context.statement, time.perf_counter() - started.pop()[1])
+
+
+def listen():
+    # the engine listeners, installed once for requests and recording() alike
+    if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        event.listen(Engine, 'handle_error', handle_error)
+
+
+@contextmanager
+def recording():
+    '''yields a QueryStats of every statement the block runs, in a request or not'''
+    listen()
+    stats = QueryStats()
+    recorders.append(stats)
+    try:
+        yield stats
+    finally:
+        recorders.remove(stats)
+
+
+def init_app(app):
+    listen()
+
+    @app.before_request
+    def start_sql_stats():
+        g.sql_stats = QueryStats()
+
+    @app.after_request
+    def report_sql_stats(response):
+        stats = g.get('sql_stats')
+        if stats is None:
+            return response
+        method, path, full_path = request.method, request.path, request.full_path.rstrip('?')
+        if response.is_streamed:
+            # a streamed body runs its queries while it is sent, after this hook:
+            # leave the headers off and log the totals once the response is closed
+            response.call_on_close(lambda: log(app, stats, method, path, full_path, response.status_code))
+            return response
+        g.pop('sql_stats')
+        if app.config['SQL_STATS_HEADERS']:
+            response.headers['X-Query-Count'] = str(stats.count)
+            response.headers['X-DB-Time'] = '%.1fms' % (stats.duration * 1000)
+        log(app, stats, method, path, full_path, response.status_code)
+        return response
+
+
+def log(app, stats, method, path, full_path, status):
+    app.logger.info('%s %s %s: %d queries, %.1f ms in the database',
+                    method, full_path, status, stats.count, stats.duration * 1000)
+    for duration, statement in stats.slowest(app.config['SQL_STATS_SLOWEST']):
+        app.logger.debug('  %.1f ms: %s', duration * 1000, ' '.join(statement.split()))
+    for statement, count in stats.repeated(app.config['SQL_STATS_REPEAT_THRESHOLD']):
+        app.logger.warning('possible N+1 on %s %s: %d x %s', method, path,
+                           count, ' '.join(statement.split()))
@@ -0,0 +1,140 @@
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+# Seeded synthetic catalog for load testing: venues, artists and shows with
+# skewed (Zipf-like) popularity, so a few cities, genres, venues and artists
+# account for most rows the way real listings do. The same seed and size
+# always produce the same rows.
+
+# (city, state), most populous first
+cities = [
+    ('New York', 'NY'), ('Los Angeles', 'CA'), ('Chicago', 'IL'), ('Houston', 'TX'),
+    ('Phoenix', 'AZ'), ('Philadelphia', 'PA'), ('San Antonio', 'TX'), ('San Diego', 'CA'),
+    ('Dallas', 'TX'), ('Austin', 'TX'), ('San Jose', 'CA'), ('Jacksonville', 'FL'),
+    ('Columbus', 'OH'), ('Charlotte', 'NC'), ('San Francisco', 'CA'), ('Indianapolis', 'IN'),
+    ('Seattle', 'WA'), ('Denver', 'CO'), ('Washington', 'DC'), ('Boston', 'MA'),
+    ('Nashville', 'TN'), ('Detroit', 'MI'), ('Portland', 'OR'), ('Memphis', 'TN'),
+    ('Las Vegas', 'NV'), ('Louisville', 'KY'), ('Baltimore', 'MD'), ('Milwaukee', 'WI'),
+    ('Atlanta', 'GA'), ('New Orleans', 'LA'),
+]
+
+# most common first; genres the forms offer that aren't listed come last
+genre_popularity = [
+    'Rock n Roll', 'Pop', 'Hip-Hop', 'Jazz', 'Electronic', 'Alternative', 'Country', 'R&B',
+    'Blues', 'Folk', 'Soul', 'Punk', 'Heavy Metal', 'Classical', 'Reggae', 'Funk',
+    'Instrumental', 'Musical Theatre', 'Other',
+]
+
+adjectives = ['Blue', 'Velvet', 'Electric', 'Golden', 'Midnight', 'Crimson', 'Silver', 'Wild',
+              'Lucky', 'Hollow', 'Neon', 'Rusty', 'Broken', 'Little', 'Grand', 'Painted']
+venue_nouns = ['Hall', 'Lounge', 'Room', 'Club', 'Tavern', 'Theater', 'Ballroom', 'Garden',
+               'Cellar', 'Warehouse', 'Cafe', 'Stage']
+artist_nouns = ['Petals', 'Wolves', 'Sparrows', 'Horns', 'Saints', 'Machines', 'Rivers',
+                'Ghosts', 'Strings', 'Lions', 'Echoes', 'Owls']
+streets = ['Main', 'Oak', 'Pine', 'Maple', 'Cedar', 'Elm', 'Market', 'Mission', 'Broadway',
+           'Folsom', 'Delancey', 'Harbor']
+
+
+def dataset_size(shows):
+    # (venues, artists) for a catalog of the given number of shows
+    return max(shows // 20, 10), max(shows // 10, 20)
+
+
+def zipf(count, exponent=1.0):
+    # cumulative weights for random.choices: item i is picked in proportion to 1 / (i + 1) ** exponent
+    return list(accumulate(1.0 / (rank + 1) ** exponent for rank in range(count)))
+
+
+def distinct_picks(rng, count, cum_weights, k):
+    # k distinct items out of range(count), favouring the heavily weighted ones
+    if k * 2 >= count:
+        return rng.sample(range(count), k)
+    picks = list(dict.fromkeys(rng.choices(range(count), cum_weights=cum_weights, k=k * 2)))[:k]
+    chosen = set(picks)
+    while len(picks) < k:
+        item = rng.randrange(count)
+        if item not in chosen:
+            chosen.add(item)
+            picks.append(item)
+    return picks
+
+
+def pick_genres(rng, genres, cum_weights):
+    return list(dict.fromkeys(rng.choices(genres, cum_weights=cum_weights, k=rng.choice((1, 1, 2, 3)))))
+
+
+def name(rng, nouns, number):
+    return 'The %s %s %d' % (rng.choice(adjectives), rng.choice(nouns), number)
+
+
+def profile(rng, genres, genre_weights, city_weights, nouns, number):
+    city, state = rng.choices(cities, cum_weights=city_weights)[0]
+    slug = 'fyyur-%s-%d' % (nouns[0].lower(), number)
+    return {
+        'name': name(rng, nouns, number),
+        'genres': pick_genres(rng, genres, genre_weights),
+        'city': city,
+        'state': state,
+        'phone': '%03d-%03d-%04d' % (rng.randint(200, 999), rng.randint(200, 999), rng.randint(0, 9999)),
+        'website': 'https://%s.example.com' % slug,
+        'facebook_link': 'https://www.facebook.com/%s' % slug,
+        'image_link': 'https://images.example.com/%s.jpg' % slug,
+    }
+
+
+def ordered_genres(genres):
+    return [genre for genre in genre_popularity if genre in genres] + \
+        [genre for genre in genres if genre not in genre_popularity]
+
+
+def venue_rows(rng, count, genres):
+    genres = ordered_genres(genres)
+    genre_weights, city_weights = zipf(len(genres)), zipf(len(cities), 0.8)
+    for number in range(1, count + 1):
+        row = profile(rng, genres, genre_weights, city_weights, venue_nouns, number)
+        row['address'] = '%d %s Street' % (rng.randint(1, 2999), rng.choice(streets))
+        row['seeking_talent'] = rng.random() < 0.3
+        row['seeking_description'] = 'Looking for local acts.' if row['seeking_talent'] else ''
+        yield row
+
+
+def artist_rows(rng, count, genres):
+    genres = ordered_genres(genres)
+    genre_weights, city_weights = zipf(len(genres)), zipf(len(cities), 0.8)
+    for number in range(1, count + 1):
+        row = profile(rng, genres, genre_weights, city_weights, artist_nouns, number)
+        row['seeking_venue'] = rng.random() < 0.3
+        row['seeking_description'] = 'Looking for weekend gigs.' if row['seeking_venue'] else ''
+        yield row
+
+
+def show_rows(rng, count, venue_ids, artist_ids, today=None, past_days=730, future_days=365):
+    '''
+    yields count shows spread over past_days before and future_days after
+    today, busier on Fridays and Saturdays. A venue or an artist has at most
+    one show a day, all starting in the evening, so no two shows overlap;
+    a day that would need more shows than min(venues, artists) gets fewer.
+    '''
+    today = (today or datetime.now()).replace(hour=0, minute=0, second=0, microsecond=0)
+    days = [today + timedelta(days=offset) for offset in range(-past_days, future_days)]
+    day_weights = [1.6 if day.weekday() in (4, 5) else 1.0 for day in days]
+    total = sum(day_weights)
+    shares = [count * weight / total for weight in day_weights]
+    per_day = [int(share) for share in shares]
+    # the rounding remainder goes to the days with the largest fractions
+    by_fraction = sorted(range(len(days)), key=lambda index: shares[index] - per_day[index], reverse=True)
+    for index in by_fraction[:count - sum(per_day)]:
+        per_day[index] += 1
+
+    limit = min(len(venue_ids), len(artist_ids))
+    venue_weights, artist_weights = zipf(len(venue_ids)), zipf(len(artist_ids))
+    for day, shows_today in zip(days, per_day):
+        shows_today = min(shows_today, limit)
+        venues = distinct_picks(rng, len(venue_ids), venue_weights, shows_today)
+        artists = distinct_picks(rng, len(artist_ids), artist_weights, shows_today)
+        for venue, artist in zip(venues, artists):
+            yield {
+                'venue_id': venue_ids[venue],
+                'artist_id': artist_ids[artist],
+                'start_time': day + timedelta(hours=rng.randint(18, 22), minutes=rng.choice((0, 30))),
+            }
@@ -0,0 +1,1587 @@
+import base64
+import io
+import json
+import logging
+import os
+import random
+import re
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import babel.dates
+from flask import Flask
+from sqlalchemy.exc import IntegrityError
+
+# the app reads its database URLs at import time; default to two SQLite files
+# standing in for the primary and its replica
+database_dir = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = os.environ.get(
+    'TEST_DATABASE_URL', 'sqlite:///' + os.path.join(database_dir, 'primary.db'))
+os.environ['REPLICA_DATABASE_URL'] = os.environ.get(
+    'TEST_REPLICA_DATABASE_URL', 'sqlite:///' + os.path.join(database_dir, 'replica.db'))
+os.environ['SECRET_KEY'] = 'test secret key'
+
+from app import app, db, Artist, Venue, Show, ShowRollup, purge_venue, backfill_rollups, detail_cache, suggestions, \
+    venue_locations, image_url, image_failures, SessionRecord, artist_search, \
+    venue_search, upgrade_schema, area_index, format_datetime, datetime_formats, generate_catalog, \
+    init_templates, asset_url
+import assets
+import benchmark
+import images
+import logqueue
+import recommend
+import sessions
+import sqlstats
+import synthetic
+from cache import DetailCache
+from routing import REPLICA, LAST_WRITE_COOKIE
+
+
+class FyyurTestCase(unittest.TestCase):
+    """Creates the tables on the primary and the replica for every test."""
+
+    def setUp(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        # only the routing tests read from the replica, which nothing copies data to
+        app.config['REPLICA_READS'] = False
+        self.client = app.test_client
+        with app.app_context():
+            self.primary = db.get_engine(app)
+            self.replica = db.get_engine(app, bind=REPLICA)
+            for engine in (self.primary, self.replica):
+                db.metadata.create_all(engine)
+
+    def tearDown(self):
+        with app.app_context():
+            for engine in (self.primary, self.replica):
+                db.metadata.drop_all(engine)
+
+
+class ReplicaRoutingTestCase(FyyurTestCase):
+    """Read-only views use the replica, writes and recent writers the primary."""
+
+    def setUp(self):
+        super().setUp()
+        app.config['REPLICA_READS'] = True
+        with app.app_context():
+            # the two databases are never replicated here, so each row
+            # shows which one served a page
+            self.add_artist(self.primary, 'Primary Player')
+            self.add_artist(self.replica, 'Replica Player')
+
+    def add_artist(self, engine, name):
+        engine.execute(Artist.__table__.insert(), name=name, city='San Francisco', state='CA', genres=['Jazz'])
+
+    def artist_form(self, name):
+        return {
+            'name': name,
+            'city': 'San Francisco',
+            'state': 'CA',
+            'phone': '',
+            'website': '',
+            'image_link': '',
+            'facebook_link': '',
+            'genres': 'Jazz',
+        }
+
+    def test_read_only_view_uses_replica(self):
+        res = self.client().get('/artists')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'Replica Player', res.data)
+        self.assertNotIn(b'Primary Player', res.data)
+
+    def test_write_goes_to_primary(self):
+        res = self.client().post('/artists/create', data=self.artist_form('New Player'))
+
+        self.assertEqual(res.status_code, 200)
+        with app.app_context():
+            self.assertEqual(db.session.query(Artist).filter_by(name='New Player').count(), 1)
+            self.assertEqual(
+                self.replica.execute(Artist.__table__.select()
+                                     .where(Artist.name == 'New Player')).fetchall(), [])
+
+    def test_reads_follow_own_writes(self):
+        client = self.client()
+        res = client.post('/artists/create', data=self.artist_form('New Player'))
+        self.assertIn(LAST_WRITE_COOKIE, res.headers.get('Set-Cookie', ''))
+
+        res = client.get('/artists')
+        self.assertIn(b'New Player', res.data)
+        self.assertIn(b'Primary Player', res.data)
+
+        # other clients keep reading from the replica
+        res = self.client().get('/artists')
+        self.assertNotIn(b'New Player', res.data)
+
+    def test_read_your_writes_window_expires(self):
+        client = self.client()
+        client.post('/artists/create', data=self.artist_form('New Player'))
+        window = app.config['READ_YOUR_WRITES_SECONDS']
+        app.config['READ_YOUR_WRITES_SECONDS'] = 0
+        try:
+            res = client.get('/artists')
+        finally:
+            app.config['READ_YOUR_WRITES_SECONDS'] = window
+
+        self.assertIn(b'Replica Player', res.data)
+
+    def test_replica_reads_can_be_turned_off(self):
+        app.config['REPLICA_READS'] = False
+
+        res = self.client().get('/artists')
+        self.assertIn(b'Primary Player', res.data)
+        self.assertNotIn(b'Replica Player', res.data)
+
+    def test_caches_load_from_primary(self):
+        # both outlive the request, so a lagging replica would leave them stale for good
+        detail_cache.clear()
+        artist_search.invalidate()
+
+        self.assertIn(b'Primary Player', self.client().get('/artists/1').data)
+        if db.engine.dialect.name != 'postgresql':
+            # other databases search the in-process index
+            res = self.client().get('/artists/search?search_term=player')
+            self.assertIn(b'Primary Player', res.data)
+            self.assertNotIn(b'Replica Player', res.data)
+
+    def test_failed_write_sets_no_cookie(self):
+        res = self.client().post('/artists/create', data={'name': 'Incomplete'})
+
+        self.assertNotIn(LAST_WRITE_COOKIE, res.headers.get('Set-Cookie', ''))
+
+
+class VenueDeletionTestCase(FyyurTestCase):
+    """Deleted venues disappear at once and their shows are purged in batches."""
+
+    def setUp(self):
+        super().setUp()
+        app.config['PURGE_IN_BACKGROUND'] = False
+        with app.app_context():
+            venue = Venue(name='Closing Hall', city='San Francisco', state='CA', genres=['Jazz'])
+            artist = Artist(name='Touring Band', city='San Francisco', state='CA', genres=['Jazz'])
+            db.session.add_all([venue, artist])
+            db.session.flush()
+            start = datetime.now() + timedelta(days=1)
+            db.session.add_all([Show(venue_id=venue.id, artist_id=artist.id,
+                                     start_time=start + timedelta(days=day)) for day in range(5)])
+            db.session.commit()
+            self.venue_id, self.artist_id = venue.id, artist.id
+
+    def tearDown(self):
+        app.config['PURGE_IN_BACKGROUND'] = True
+        super().tearDown()
+
+    def test_delete_venue_hides_it(self):
+        client = self.client()
+        res = client.delete('/venues/%d' % self.venue_id)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertNotIn(b'Closing Hall', client.get('/venues').data)
+        self.assertNotIn(b'Closing Hall', client.get('/shows').data)
+        self.assertNotIn(b'Closing Hall', client.get('/artists/%d' % self.artist_id).data)
+        self.assertNotIn(b'Closing Hall', client.get('/venues/%d' % self.venue_id).data)
+        with app.app_context():
+            self.assertEqual(Show.query.filter_by(venue_id=self.venue_id).count(), 5)
+
+    def test_delete_missing_venue(self):
+        self.client().delete('/venues/%d' % self.venue_id)
+        res = self.client().delete('/venues/%d' % self.venue_id)
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_purge_venue_in_batches(self):
+        self.client().delete('/venues/%d' % self.venue_id)
+        batch_size = app.config['PURGE_BATCH_SIZE']
+        app.config['PURGE_BATCH_SIZE'] = 2
+        try:
+            with app.app_context():
+                self.assertEqual(purge_venue(self.venue_id), 5)
+                self.assertEqual(Show.query.count(), 0)
+                self.assertIsNone(Venue.query.get(self.venue_id))
+                self.assertIsNotNone(Artist.query.get(self.artist_id))
+        finally:
+            app.config['PURGE_BATCH_SIZE'] = batch_size
+
+    def test_purge_gives_up_on_a_lasting_integrity_error(self):
+        self.client().delete('/venues/%d' % self.venue_id)
+        error = IntegrityError('DELETE FROM "Venue"', {}, Exception('still referenced'))
+        with app.app_context(), mock.patch.object(ShowRollup, 'query') as rollups:
+            rollups.filter.return_value.delete.side_effect = error
+            with self.assertRaises(IntegrityError):
+                purge_venue(self.venue_id)
+
+        self.assertEqual(rollups.filter.return_value.delete.call_count, app.config['PURGE_RETRIES'])
+
+
+
+class ArtistEditTestCase(FyyurTestCase):
+    """Edits write only changed columns and refuse to overwrite newer versions."""
+
+    def setUp(self):
+        super().setUp()
+        with app.app_context():
+            artist = Artist(name='Matt Quevedo', city='New York', state='NY', genres=['Jazz'],
+                            phone='300-400-5000', facebook_link='https://www.facebook.com/mq',
+                            website='https://mq.example.com',
+                            image_link='https://mq.example.com/photo.jpg')
+            db.session.add(artist)
+            db.session.commit()
+            self.artist_id = artist.id
+
+    def edit_form(self, version, **changes):
+        form = {
+            'name': 'Matt Quevedo',
+            'city': 'New York',
+            'state': 'NY',
+            'phone': '300-400-5000',
+            'genres': 'Jazz',
+            'facebook_link': 'https://www.facebook.com/mq',
+            'website': 'https://mq.example.com',
+            'image_link': 'https://mq.example.com/photo.jpg',
+            'version': str(version),
+        }
+        form.update(changes)
+        return form
+
+    def artist(self):
+        with app.app_context():
+            artist = Artist.query.get(self.artist_id)
+            return artist.details(), artist.version_id
+
+    def test_edit_updates_changed_columns(self):
+        res = self.client().post('/artists/%d/edit' % self.artist_id,
+                                 data=self.edit_form(1, city='Brooklyn'))
+
+        self.assertEqual(res.status_code, 302)
+        details, version = self.artist()
+        self.assertEqual(details['city'], 'Brooklyn')
+        self.assertEqual(details['genres'], ['Jazz'])
+        self.assertEqual(version, 2)
+
+    def test_unchanged_edit_writes_nothing(self):
+        res = self.client().post('/artists/%d/edit' % self.artist_id, data=self.edit_form(1))
+
+        self.assertEqual(res.status_code, 302)
+        details, version = self.artist()
+        self.assertEqual(version, 1)
+
+    def test_stale_edit_is_rejected(self):
+        self.client().post('/artists/%d/edit' % self.artist_id,
+                           data=self.edit_form(1, city='Brooklyn'))
+        res = self.client().post('/artists/%d/edit' % self.artist_id,
+                                 data=self.edit_form(1, name='Matt Q'))
+
+        self.assertEqual(res.status_code, 409)
+        details, version = self.artist()
+        self.assertEqual(details['name'], 'Matt Quevedo')
+        self.assertEqual(details['city'], 'Brooklyn')
+        self.assertEqual(version, 2)
+
+    def test_edit_refreshes_cached_page(self):
+        detail_cache.clear()
+        self.assertIn(b'New York', self.client().get('/artists/%d' % self.artist_id).data)
+        self.client().post('/artists/%d/edit' % self.artist_id, data=self.edit_form(1, city='Brooklyn'))
+
+        self.assertIn(b'Brooklyn', self.client().get('/artists/%d' % self.artist_id).data)
+
+
+class SQLStatsTestCase(FyyurTestCase):
+    """recording() counts every statement, failed ones included."""
+
+    def test_failed_statement_leaves_no_start_time(self):
+        with app.app_context(), sqlstats.recording() as stats:
+            with db.engine.connect() as connection:
+                with self.assertRaises(Exception):
+                    connection.execute('SELECT * FROM no_such_table')
+                connection.execute('SELECT 1')
+                self.assertEqual(connection.info['query_start_time'], [])
+
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(list(stats.statements), ['SELECT * FROM no_such_table', 'SELECT 1'])
+
+
+class DetailCacheTestCase(unittest.TestCase):
+    """Cached pages expire, make way for newer ones and never outlive an invalidation."""
+
+    def test_invalidation_during_load_is_not_stored(self):
+        cache = DetailCache()
+
+        def load():
+            cache.invalidate('venue', 1)
+            return 'old'
+
+        self.assertEqual(cache.get('venue', 1, load), 'old')
+        self.assertEqual(cache.get('venue', 1, lambda: 'new'), 'new')
+        self.assertEqual(cache.get('venue', 1, lambda: 'newer'), 'new')
+        self.assertEqual(cache.loading, {})
+
+    def test_clear_during_load_is_not_stored(self):
+        cache = DetailCache()
+
+        def load():
+            cache.clear()
+            return 'old'
+
+        cache.get('venue', 1, load)
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidating_uncached_keys_keeps_nothing(self):
+        cache = DetailCache()
+        for id in range(1000):
+            cache.invalidate('artist', id)
+
+        self.assertEqual((len(cache), cache.loading), (0, {}))
+
+    def test_failed_load_is_not_stored(self):
+        cache = DetailCache()
+
+        def load():
+            raise RuntimeError('database went away')
+
+        with self.assertRaises(RuntimeError):
+            cache.get('venue', 1, load)
+        self.assertEqual(cache.get('venue', 1, lambda: 'page'), 'page')
+        self.assertEqual(cache.loading, {})
+
+    def test_least_recently_used_and_expired_entries_go(self):
+        cache = DetailCache(maxsize=2, ttl=60)
+        for id in (1, 2):
+            cache.get('venue', id, lambda: 'page %d' % id)
+        cache.get('venue', 1, lambda: 'reloaded')
+        cache.get('venue', 3, lambda: 'page 3')
+
+        self.assertEqual(cache.get('venue', 1, lambda: 'reloaded'), 'page 1')
+        self.assertEqual(cache.get('venue', 2, lambda: 'reloaded'), 'reloaded')
+        with mock.patch('time.monotonic', return_value=time.monotonic() + 61):
+            self.assertEqual(cache.get('venue', 1, lambda: 'expired'), 'expired')
+
+
+class ShowBookingTestCase(FyyurTestCase):
+    """Shows can't overlap at a venue or for an artist."""
+
+    def setUp(self):
+        super().setUp()
+        with app.app_context():
+            venues = [Venue(name=name, city='San Francisco', state='CA')
+                      for name in ('The Musical Hop', 'Park Square')]
+            artists = [Artist(name=name, city='San Francisco', state='CA')
+                       for name in ('Guns N Petals', 'The Wild Sax Band')]
+            db.session.add_all(venues + artists)
+            db.session.flush()
+            db.session.add(Show(venue_id=venues[0].id, artist_id=artists[0].id,
+                                start_time=datetime(2035, 4, 1, 20, 0)))
+            db.session.commit()
+            self.venue_ids = [venue.id for venue in venues]
+            self.artist_ids = [artist.id for artist in artists]
+
+    def book(self, venue, artist, start_time):
+        return self.client().post('/shows/create', data={
+            'venue_id': str(self.venue_ids[venue]),
+            'artist_id': str(self.artist_ids[artist]),
+            'start_time': start_time,
+        })
+
+    def show_count(self):
+        with app.app_context():
+            return Show.query.count()
+
+    def test_overlap_at_venue_is_rejected(self):
+        res = self.book(0, 1, '2035-04-01 21:30:00')
+
+        self.assertEqual(res.status_code, 409)
+        self.assertIn(b'The venue is already booked', res.data)
+        self.assertEqual(self.show_count(), 1)
+
+    def test_overlap_for_artist_is_rejected(self):
+        res = self.book(1, 0, '2035-04-01 18:00:00')
+
+        self.assertEqual(res.status_code, 409)
+        self.assertIn(b'The artist is already booked', res.data)
+        self.assertEqual(self.show_count(), 1)
+
+    def test_show_after_previous_one_ends(self):
+        res = self.book(0, 0, '2035-04-01 23:00:00')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'Show was successfully listed!', res.data)
+        self.assertEqual(self.show_count(), 2)
+
+    def test_invalid_start_time(self):
+        res = self.book(1, 1, 'next friday')
+
+        self.assertIn(b'Show could not be listed', res.data)
+        self.assertEqual(self.show_count(), 1)
+
+    def test_import_rejects_overlaps(self):
+        rows = [(self.venue_ids[1], self.artist_ids[0], '2035-04-01 22:00:00'),  # artist's existing show
+                (self.venue_ids[1], self.artist_ids[1], '2035-04-02 20:00:00'),
+                (self.venue_ids[1], self.artist_ids[0], '2035-04-02 21:00:00'),  # the row above
+                (self.venue_ids[0], self.artist_ids[1], '2035-04-02 23:00:00')]
+        upload = '\n'.join(json.dumps({'venue_id': venue_id, 'artist_id': artist_id, 'start_time': start_time})
+                           for venue_id, artist_id, start_time in rows)
+
+        res = self.client().post('/import/shows', data={'file': (io.BytesIO(upload.encode()), 'shows.ndjson')})
+
+        self.assertEqual(res.json['imported'], 2)
+        self.assertEqual(res.json['errors'], [
+            {'line': 1, 'errors': {'artist_id': ['The artist is already booked around that time.']}},
+            {'line': 3, 'errors': {'venue_id': ['The venue is already booked around that time.']}},
+        ])
+        self.assertEqual(self.show_count(), 3)
+
+
+
+class ListingTestCase(FyyurTestCase):
+    """One venue and one artist with three shows in May 2035."""
+
+    def setUp(self):
+        super().setUp()
+        with app.app_context():
+            venue = Venue(name='The Musical Hop', city='San Francisco', state='CA',
+                          address='1015 Folsom Street')
+            artist = Artist(name='Guns N Petals', city='San Francisco', state='CA')
+            db.session.add_all([venue, artist])
+            db.session.flush()
+            db.session.add_all([Show(venue_id=venue.id, artist_id=artist.id,
+                                     start_time=datetime(2035, 5, day, 20, 0)) for day in (1, 8, 15)])
+            db.session.commit()
+            self.venue_id, self.artist_id = venue.id, artist.id
+
+
+class AreaListingTestCase(ListingTestCase):
+    """/venues groups venues by city and state with their upcoming show counts."""
+
+    def setUp(self):
+        super().setUp()
+        area_index.invalidate()
+        with app.app_context():
+            db.session.add_all([Venue(name='Park Square', city='San Francisco', state='CA'),
+                                Venue(name='The Dueling Pianos Bar', city='New York', state='NY'),
+                                Show(venue_id=self.venue_id, artist_id=self.artist_id,
+                                     start_time=datetime(2000, 5, 1, 20, 0))])
+            db.session.commit()
+
+    def areas(self):
+        res = self.client().get('/api/v1/venues')
+        return [(area['city'], [(venue['name'], venue['num_upcoming_shows']) for venue in area['venues']])
+                for area in res.json['data']]
+
+    def test_areas_count_upcoming_shows(self):
+        self.assertEqual(self.areas(), [('San Francisco', [('The Musical Hop', 3), ('Park Square', 0)]),
+                                        ('New York', [('The Dueling Pianos Bar', 0)])])
+
+    def test_area_index_serves_the_same_listing(self):
+        app.config['AREA_INDEX'] = True
+        try:
+            first = self.areas()
+            self.client().post('/shows/create', data={
+                'venue_id': str(self.venue_id),
+                'artist_id': str(self.artist_id),
+                'start_time': '2035-06-01 20:00:00',
+            })
+            second = self.areas()
+        finally:
+            app.config['AREA_INDEX'] = False
+
+        self.assertEqual(first, [('San Francisco', [('The Musical Hop', 3), ('Park Square', 0)]),
+                                 ('New York', [('The Dueling Pianos Bar', 0)])])
+        self.assertEqual(second[0][1][0], ('The Musical Hop', 4))
+
+
+class CalendarTestCase(ListingTestCase):
+    """Date-range show listings and calendar feeds with ETag revalidation."""
+
+    def test_shows_in_date_range(self):
+        res = self.client().get('/shows?from=2035-05-02&to=2035-05-08')
+        data = res.data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data.count('tile-show'), 1)
+        self.assertEqual(self.client().get('/shows?city=new+york').data.count(b'tile-show'), 0)
+        self.assertEqual(self.client().get('/shows?from=soon').status_code, 400)
+
+    def test_date_range_edges(self):
+        res = self.client().get('/shows?from=2035-05-08&to=9999-12-31')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data.count(b'tile-show'), 2)
+
+        # an offset is converted to local time before comparing
+        start = datetime(2035, 5, 8, 20, 0).astimezone().isoformat()
+        res = self.client().get('/shows', query_string={'from': start})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data.count(b'tile-show'), 2)
+
+    def test_venue_calendar(self):
+        res = self.client().get('/venues/%d/calendar.ics?from=2035-01-01' % self.venue_id)
+        data = res.data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/calendar')
+        self.assertEqual(data.count('BEGIN:VEVENT'), 3)
+        self.assertIn('DTSTART:20350508T200000', data)
+        self.assertIn('LOCATION:1015 Folsom Street\\, San Francisco\\, CA', data)
+
+    def test_artist_calendar_json(self):
+        res = self.client().get('/artists/%d/calendar.json?to=2035-05-01' % self.artist_id)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([show['start_time'] for show in data['shows']], ['2035-05-01T20:00:00'])
+
+    def test_unchanged_calendar_is_not_modified(self):
+        url = '/venues/%d/calendar.ics' % self.venue_id
+        etag = self.client().get(url).headers['ETag']
+
+        res = self.client().get(url, headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+        with app.app_context():
+            db.session.add(Show(venue_id=self.venue_id, artist_id=self.artist_id,
+                                start_time=datetime(2035, 5, 22, 20, 0)))
+            db.session.commit()
+        res = self.client().get(url, headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+
+    def test_unchanged_show_page_is_not_modified(self):
+        url = '/shows?per_page=2'
+        etag = self.client().get(url).headers['ETag']
+
+        self.assertEqual(self.client().get(url, headers={'If-None-Match': etag}).status_code, 304)
+        self.assertNotIn('ETag', self.client().get('/shows?stream=1').headers)
+        with app.app_context():
+            Artist.query.get(self.artist_id).name = 'Guns N Roses'
+            db.session.commit()
+        res = self.client().get(url, headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'Guns N Roses', res.data)
+
+
+
+class ApiTestCase(ListingTestCase):
+    """The JSON API returns the page data, limited to ?fields= when given."""
+
+    def test_venue_detail(self):
+        res = self.client().get('/api/v1/venues/%d?fields=name,upcoming_shows' % self.venue_id)
+        data = json.loads(res.data)['data']
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sorted(data), ['id', 'name', 'upcoming_shows'])
+        self.assertEqual(data['upcoming_shows'][0]['start_time'], '2035-05-01T20:00:00')
+
+    def test_shows_page(self):
+        res = self.client().get('/api/v1/shows?per_page=2&fields=artist_name')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['data'], [{'id': 1, 'artist_name': 'Guns N Petals'},
+                                        {'id': 2, 'artist_name': 'Guns N Petals'}])
+        res = self.client().get('/api/v1/shows?per_page=2&after=' + data['next'])
+        self.assertEqual(len(json.loads(res.data)['data']), 1)
+
+    def test_missing_artist(self):
+        res = self.client().get('/api/v1/artists/1000')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_bad_arguments_are_json_errors(self):
+        for url in ('/api/v1/shows?after=not-a-cursor', '/api/v1/artists?before=WyJ4Il0=',
+                    '/api/v1/shows?from=May', '/api/v1/shows?to=2035-13-01',
+                    '/api/v1/venues/nearby', '/api/v1/venues/nearby?lat=91&lng=0',
+                    '/api/v1/venues/nearby?lat=37.7&lng=-122.4&radius=0'):
+            res = self.client().get(url)
+
+            self.assertEqual(res.status_code, 400, url)
+            self.assertEqual(res.mimetype, 'application/json', url)
+            self.assertEqual(res.json['success'], False, url)
+            self.assertEqual(res.json['error'], 400, url)
+            self.assertTrue(res.json['message'], url)
+
+    def test_pages_keep_html_errors(self):
+        res = self.client().get('/shows?from=May')
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.mimetype, 'text/html')
+
+
+class StreamTestCase(ListingTestCase):
+    """/shows?stream=1 renders the whole listing in batches, like the paged listing."""
+
+    def test_stream_lists_every_show_in_order(self):
+        batch_size = app.config['STREAM_BATCH_SIZE']
+        app.config['STREAM_BATCH_SIZE'] = 2
+        try:
+            res = self.client().get('/shows?stream=1')
+            text = res.get_data(as_text=True)
+        finally:
+            app.config['STREAM_BATCH_SIZE'] = batch_size
+
+        self.assertEqual(res.status_code, 200)
+        # sent as it renders, so the length isn't known up front
+        self.assertNotIn('Content-Length', res.headers)
+        times = [text.index(format_datetime(datetime(2035, 5, day, 20, 0), 'full')) for day in (1, 8, 15)]
+        self.assertEqual(times, sorted(times))
+        self.assertEqual(text.count('Guns N Petals'), 3)
+
+    def test_stream_matches_paged_listing(self):
+        streamed = self.client().get('/shows?stream=1&city=san+francisco').get_data(as_text=True)
+        paged = self.client().get('/shows?city=san+francisco').get_data(as_text=True)
+
+        self.assertEqual(re.findall(r'href="/artists/\d+"', streamed), re.findall(r'href="/artists/\d+"', paged))
+
+
+class RequestSQLStatsTestCase(ListingTestCase):
+    """Requests report their statements as headers and log repeated ones as N+1."""
+
+    def test_headers_count_the_statements(self):
+        with sqlstats.recording() as stats:
+            res = self.client().get('/shows')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertGreater(stats.count, 0)
+        self.assertEqual(res.headers['X-Query-Count'], str(stats.count))
+        self.assertRegex(res.headers['X-DB-Time'], r'^\d+\.\dms$')
+
+    def test_repeated_statement_is_logged_as_n_plus_1(self):
+        threshold = app.config['SQL_STATS_REPEAT_THRESHOLD']
+        with app.test_request_context('/venues'), self.assertLogs(app.logger, 'INFO') as logs:
+            app.preprocess_request()
+            for venue_id in range(threshold):
+                db.session.query(Venue.name).filter(Venue.id == venue_id).all()
+            db.session.query(Artist.name).all()
+            res = app.process_response(app.response_class('ok'))
+
+        self.assertEqual(res.headers['X-Query-Count'], str(threshold + 1))
+        warnings = [record.getMessage() for record in logs.records if record.levelno == logging.WARNING]
+        self.assertEqual(len(warnings), 1)
+        self.assertRegex(warnings[0], r'^possible N\+1 on GET /venues: %d x SELECT "Venue".name ' % threshold)
+
+    def test_statements_below_the_threshold_are_not_logged(self):
+        with app.test_request_context('/venues'), self.assertLogs(app.logger, 'INFO') as logs:
+            app.preprocess_request()
+            for venue_id in range(app.config['SQL_STATS_REPEAT_THRESHOLD'] - 1):
+                db.session.query(Venue.name).filter(Venue.id == venue_id).all()
+            app.process_response(app.response_class('ok'))
+
+        self.assertFalse([record for record in logs.records if record.levelno >= logging.WARNING])
+
+    def test_streamed_response_is_logged_when_closed(self):
+        with sqlstats.recording() as stats, self.assertLogs(app.logger, 'INFO') as logs:
+            res = self.client().get('/shows?stream=1')
+            self.assertIn('Guns N Petals', res.get_data(as_text=True))
+            res.close()
+
+        # the queries run while the body is sent, after the headers are gone
+        self.assertNotIn('X-Query-Count', res.headers)
+        self.assertNotIn('X-DB-Time', res.headers)
+        self.assertIn('GET /shows?stream=1 200: %d queries' % stats.count, logs.output[-1])
+        self.assertGreater(stats.count, 0)
+
+
+class SearchTestCase(FyyurTestCase):
+    """Search ranks name matches above genre and city matches and takes terms literally."""
+
+    def setUp(self):
+        super().setUp()
+        # the in-process index outlives the tables dropped by earlier tests
+        venue_search.invalidate()
+        with app.app_context():
+            venues = [Venue(name=name, city=city, state='CA', genres=genres)
+                      for name, city, genres in (('Blue Note', 'San Francisco', ['Jazz']),
+                                                 ('Jazz Corner', 'Oakland', ['Blues']),
+                                                 ('Clubs United', 'Jazzton', ['Folk']),
+                                                 ('Park Square', 'San Francisco', ['Folk']))]
+            db.session.add_all(venues)
+            db.session.commit()
+
+    def search(self, term):
+        with app.test_request_context():
+            return venue_search.search(term)
+
+    def names(self, term):
+        return [venue['name'] for venue in self.search(term)['data']]
+
+    def test_name_match_ranks_above_genre_and_city(self):
+        self.assertEqual(self.names('jazz'), ['Jazz Corner', 'Blue Note', 'Clubs United'])
+
+    def test_terms_match_word_prefixes_case_insensitively(self):
+        self.assertEqual(self.names('PARK squ'), ['Park Square'])
+        self.assertEqual(self.names('ark'), [])
+
+    def test_every_term_has_to_match(self):
+        self.assertEqual(self.names('folk san'), ['Park Square'])
+
+    def test_wildcards_are_taken_literally(self):
+        self.assertEqual(self.names('club_'), [])
+        self.assertEqual(self.names('%lubs'), [])
+        self.assertEqual(self.names('clubs'), ['Clubs United'])
+
+    def test_search_page(self):
+        res = self.client().post('/venues/search', data={'search_term': 'blue'})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'Blue Note', res.data)
+        self.assertIn(b'Jazz Corner', res.data)
+
+
+class ImportTestCase(FyyurTestCase):
+    """Imports keep the valid records and report the rest by line."""
+
+    links = 'https://www.facebook.com/hop,https://hop.example.com,https://hop.example.com/hop.jpg'
+
+    def upload(self, kind, filename, text):
+        res = self.client().post('/import/%s' % kind, data={'file': (io.BytesIO(text.encode()), filename)})
+        self.assertEqual(res.status_code, 200)
+        return res.json
+
+    def test_csv_rows_are_validated_like_the_form(self):
+        report = self.upload('venues', 'venues.csv', '\n'.join([
+            'name,city,state,address,genres,facebook_link,website,image_link',
+            'The Musical Hop,San Francisco,CA,1015 Folsom Street,Jazz,' + self.links,
+            ',San Francisco,CA,335 Delancey Street,Jazz,' + self.links,
+            'Park Square,Nowhere,ZZ,34 Whiskey Moore Ave,Folk,' + self.links,
+            '"Dueling Pianos Bar",New York,NY,335 Delancey Street,"Jazz, Blues",' + self.links,
+        ]))
+
+        self.assertEqual(report['imported'], 2)
+        self.assertFalse(report['success'])
+        self.assertEqual([(error['line'], sorted(error['errors'])) for error in report['errors']],
+                         [(3, ['name']), (4, ['state'])])
+        with app.app_context():
+            self.assertEqual(Venue.query.filter_by(name='Dueling Pianos Bar').one().genres, ['Jazz', 'Blues'])
+
+    def test_unparsable_ndjson_lines_are_reported(self):
+        report = self.upload('artists', 'artists.ndjson', '\n'.join([
+            json.dumps({'name': 'Guns N Petals', 'city': 'San Francisco', 'state': 'CA', 'phone': '326-123-5000',
+                        'genres': ['Rock n Roll'], 'facebook_link': 'https://www.facebook.com/gnp',
+                        'website': 'https://gnp.example.com', 'image_link': 'https://gnp.example.com/gnp.jpg'}),
+            '{"name": "Matt Quevedo",',
+            '',
+            '["not", "a", "record"]',
+        ]))
+
+        self.assertEqual(report['imported'], 1)
+        self.assertEqual(report['errors'], [{'line': 2, 'errors': {'record': ['Could not parse this line.']}},
+                                            {'line': 4, 'errors': {'record': ['Could not parse this line.']}}])
+
+    def test_shows_need_an_existing_venue_and_artist(self):
+        report = self.upload('shows', 'shows.csv', 'venue_id,artist_id,start_time\n1,1,2035-05-01 20:00:00\n')
+
+        self.assertEqual(report['imported'], 0)
+        self.assertEqual(report['errors'], [{'line': 2, 'errors': {'venue_id': ['Venue 1 does not exist.'],
+                                                                   'artist_id': ['Artist 1 does not exist.']}}])
+
+    def test_unknown_kind(self):
+        res = self.client().post('/import/tickets', data={'file': (io.BytesIO(b''), 'tickets.csv')})
+
+        self.assertEqual(res.status_code, 400)
+
+
+class GenreFacetTestCase(FyyurTestCase):
+    """Listings count every genre of the rows shown and filter on the selected ones."""
+
+    def setUp(self):
+        super().setUp()
+        with app.app_context():
+            artists = [Artist(name=name, city='San Francisco', state='CA', genres=genres)
+                       for name, genres in (('Guns N Petals', ['Rock n Roll', 'Jazz']),
+                                            ('Matt Quevedo', ['Jazz']),
+                                            ('The Wild Sax Band', ['Jazz', 'Classical']))]
+            venues = [Venue(name=name, city='San Francisco', state='CA', genres=genres)
+                      for name, genres in (('The Musical Hop', ['Jazz', 'Folk']),
+                                           ('Closed Hall', ['Folk']))]
+            venues[1].deleted_at = datetime.now()
+            db.session.add_all(artists + venues)
+            db.session.commit()
+
+    def facets(self, path):
+        text = self.client().get(path).get_data(as_text=True)
+        return re.findall(r'class="genre( selected)?" href="[^"]*">([^<]+) \((\d+)\)</a>', text), text
+
+    def test_counts_every_genre(self):
+        facets, text = self.facets('/artists')
+
+        self.assertEqual(facets, [('', 'Jazz', '3'), ('', 'Classical', '1'), ('', 'Rock n Roll', '1')])
+
+    def test_selected_genres_narrow_listing_and_counts(self):
+        facets, text = self.facets('/artists?genre=Jazz&genre=Classical')
+
+        self.assertEqual(facets, [(' selected', 'Classical', '1'), (' selected', 'Jazz', '1')])
+        self.assertIn('The Wild Sax Band', text)
+        self.assertNotIn('Matt Quevedo', text)
+
+    def test_unknown_genres_are_ignored(self):
+        facets, text = self.facets('/artists?genre=Polka')
+
+        self.assertEqual(len(facets), 3)
+        self.assertIn('Matt Quevedo', text)
+
+    def test_deleted_venues_are_not_counted(self):
+        facets, text = self.facets('/venues')
+
+        self.assertEqual(facets, [('', 'Folk', '1'), ('', 'Jazz', '1')])
+
+
+class PaginationTestCase(FyyurTestCase):
+    """Keyset pages follow each other without gaps and refuse forged cursors."""
+
+    def setUp(self):
+        super().setUp()
+        with app.app_context():
+            artists = [Artist(name='Artist %d' % number, city='San Francisco', state='CA') for number in range(5)]
+            db.session.add_all(artists)
+            db.session.commit()
+            self.artist_ids = [artist.id for artist in artists]
+
+    def page(self, **args):
+        res = self.client().get('/api/v1/artists', query_string=dict(per_page=2, **args))
+        self.assertEqual(res.status_code, 200)
+        return res.json
+
+    def cursor(self, *values):
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def test_pages_walk_forward_and_back(self):
+        first = self.page()
+        second = self.page(after=first['next'])
+        last = self.page(after=second['next'])
+
+        self.assertEqual([[artist['id'] for artist in page['data']] for page in (first, second, last)],
+                         [self.artist_ids[:2], self.artist_ids[2:4], self.artist_ids[4:]])
+        self.assertIsNone(first['prev'])
+        self.assertIsNone(last['next'])
+        back = self.page(before=last['prev'])
+        self.assertEqual([artist['id'] for artist in back['data']], self.artist_ids[2:4])
+        self.assertEqual(self.page(before=back['prev']), first)
+
+    def test_page_after_the_last_row_is_empty(self):
+        page = self.page(after=self.cursor(self.artist_ids[-1]))
+
+        self.assertEqual(page['data'], [])
+        self.assertIsNone(page['next'])
+
+    def test_forged_cursors_are_rejected(self):
+        for cursor in ('not a cursor', self.cursor(), self.cursor(1, 2), self.cursor('1'), self.cursor(True),
+                       self.cursor(1.5), base64.urlsafe_b64encode(b'{"id": 1}').decode()):
+            res = self.client().get('/api/v1/artists', query_string={'after': cursor})
+            self.assertEqual(res.status_code, 400, cursor)
+        for cursor in (self.cursor(1, 1), self.cursor('2035-05-01T20:00:00+02:00', 1),
+                       self.cursor('2035-05-01T20:00:00', '1')):
+            self.assertEqual(self.client().get('/shows', query_string={'after': cursor}).status_code, 400)
+        res = self.client().get('/shows', query_string={'after': self.cursor('2035-05-01T20:00:00', 1)})
+        self.assertEqual(res.status_code, 200)
+
+
+class SchemaUpgradeTestCase(ListingTestCase):
+    """upgrade-db adds what a database from an earlier version is missing."""
+
+    def test_upgrade_adds_missing_tables_columns_and_indexes(self):
+        with app.app_context():
+            with db.engine.begin() as connection:
+                connection.execute('DROP TABLE show_rollup')
+                connection.execute('DROP INDEX ix_show_start_time_id')
+                connection.execute('DROP INDEX "ix_Venue_deleted_at"')
+                for column in ('deleted_at', 'latitude', 'longitude'):
+                    connection.execute('ALTER TABLE "Venue" DROP COLUMN %s' % column)
+                connection.execute('ALTER TABLE "Artist" DROP COLUMN version_id')
+
+            added = upgrade_schema()
+            self.assertEqual(upgrade_schema(), [])
+            artist = Artist.query.one()
+            artist.name = 'The Wild Sax Band'
+            db.session.commit()
+
+            self.assertEqual(artist.version_id, 2)
+            self.assertEqual(ShowRollup.query.one().show_count, 3)
+            self.assertIsNotNone(Venue.query.one().latitude)
+        self.assertEqual(sorted(added), ['column Artist.version_id', 'column Venue.deleted_at',
+                                         'column Venue.latitude', 'column Venue.longitude',
+                                         'index ix_Venue_deleted_at', 'index ix_show_start_time_id',
+                                         'table show_rollup'])
+
+    def test_upgrade_adds_the_show_detail_indexes(self):
+        with app.app_context():
+            with db.engine.begin() as connection:
+                connection.execute('DROP INDEX ix_show_venue_id_start_time')
+                connection.execute('DROP INDEX ix_show_artist_id_start_time')
+
+            added = upgrade_schema()
+
+        self.assertEqual(sorted(added), ['index ix_show_artist_id_start_time', 'index ix_show_venue_id_start_time'])
+
+
+class RollupTestCase(ListingTestCase):
+    """Monthly rollups follow show inserts and deletes and back /analytics."""
+
+    def rollups(self):
+        with app.app_context():
+            return {(row.venue_id, row.month.isoformat()): row.show_count for row in ShowRollup.query}
+
+    def test_rollups_follow_shows(self):
+        self.assertEqual(self.rollups(), {(self.venue_id, '2035-05-01'): 3})
+
+        res = self.client().post('/shows/create', data={
+            'venue_id': str(self.venue_id),
+            'artist_id': str(self.artist_id),
+            'start_time': '2035-06-01 20:00:00',
+        })
+        self.assertEqual(res.status_code, 200)
+        with app.app_context():
+            db.session.delete(Show.query.filter(Show.start_time == datetime(2035, 5, 1, 20, 0)).one())
+            db.session.commit()
+
+        self.assertEqual(self.rollups(), {(self.venue_id, '2035-05-01'): 2,
+                                          (self.venue_id, '2035-06-01'): 1})
+
+    def test_backfill_rebuilds_rollups(self):
+        with app.app_context():
+            db.session.query(ShowRollup).update({'show_count': 100})
+            db.session.commit()
+            self.assertEqual(backfill_rollups(), 1)
+
+        self.assertEqual(self.rollups(), {(self.venue_id, '2035-05-01'): 3})
+
+    def test_analytics(self):
+        res = self.client().get('/analytics?from=2035-04-01&to=2035-06-30')
+        text = res.get_data(as_text=True)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(text.count('class="progress-bar"'), 3)
+        self.assertIn('San Francisco, CA: 3 shows', text)
+        self.assertIn('The Musical Hop: 3 shows', text)
+
+    def test_analytics_city_ignores_case(self):
+        res = self.client().get('/analytics?from=2035-04-01&to=2035-06-30&city=san+francisco')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('The Musical Hop: 3 shows', res.get_data(as_text=True))
+
+    def test_analytics_range_is_capped(self):
+        self.assertEqual(self.client().get('/analytics?from=0001-01-01&to=9999-12-31').status_code, 400)
+        self.assertEqual(self.client().get('/analytics?from=9999-12-01&to=9999-12-31').status_code, 200)
+
+    def test_deleted_venue_leaves_analytics(self):
+        app.config['PURGE_IN_BACKGROUND'] = False
+        try:
+            self.assertEqual(self.client().delete('/venues/%d' % self.venue_id).status_code, 200)
+        finally:
+            app.config['PURGE_IN_BACKGROUND'] = True
+
+        self.assertEqual(self.rollups(), {})
+
+
+class NearbyTestCase(FyyurTestCase):
+    """Venues are placed by city and found by distance from a point."""
+
+    def setUp(self):
+        super().setUp()
+        # the grid outlives the tables dropped by earlier tests
+        venue_locations.invalidate()
+        with app.app_context():
+            venues = [Venue(name=name, city=city, state=state) for name, city, state in (
+                ('The Musical Hop', 'San Francisco', 'CA'), ('Park Square', 'Oakland', 'CA'),
+                ('The Dueling Pianos Bar', 'New York', 'NY'))]
+            artist = Artist(name='Guns N Petals', city='San Francisco', state='CA')
+            db.session.add_all(venues + [artist])
+            db.session.flush()
+            db.session.add(Show(venue_id=venues[1].id, artist_id=artist.id, start_time=datetime(2035, 5, 1, 20, 0)))
+            db.session.commit()
+            self.venue_ids = [venue.id for venue in venues]
+
+    def nearby(self, query='lat=37.7749&lng=-122.4194'):
+        res = self.client().get('/api/v1/venues/nearby?' + query)
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)['venues']
+
+    def test_venues_are_placed_in_their_city(self):
+        with app.app_context():
+            venue = Venue.query.get(self.venue_ids[2])
+            self.assertAlmostEqual(venue.latitude, 40.7128)
+            self.assertAlmostEqual(venue.longitude, -74.0060)
+
+    def test_nearest_venues_within_radius(self):
+        venues = self.nearby()
+
+        self.assertEqual([venue['id'] for venue in venues], self.venue_ids[:2])
+        self.assertEqual(venues[0]['distance_km'], 0)
+        self.assertAlmostEqual(venues[1]['distance_km'], 13.3, delta=0.5)
+        self.assertEqual([venue['num_upcoming_shows'] for venue in venues], [0, 1])
+        self.assertEqual(len(self.nearby('lat=37.7749&lng=-122.4194&radius=5')), 1)
+
+    def test_moved_and_deleted_venues_leave_the_index(self):
+        self.nearby()
+        with app.app_context():
+            moved = Venue.query.get(self.venue_ids[0])
+            moved.city, moved.state = 'Boston', 'MA'
+            Venue.query.get(self.venue_ids[1]).deleted_at = datetime.now()
+            db.session.commit()
+
+        self.assertEqual(self.nearby(), [])
+        self.assertEqual([venue['id'] for venue in self.nearby('lat=42.36&lng=-71.06')], [self.venue_ids[0]])
+
+    def test_invalid_point(self):
+        res = self.client().get('/venues/nearby?lat=100&lng=0')
+
+        self.assertEqual(res.status_code, 400)
+
+
+def sample_image():
+    # an 800x600 PNG, or a 1x1 GIF when Pillow isn't installed
+    if images.Image is None:
+        return b'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04\x01\x00\x00\x00\x00' \
+            b',\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;', 'image/gif'
+    output = io.BytesIO()
+    images.Image.new('RGB', (800, 600), (200, 40, 40)).save(output, 'PNG')
+    return output.getvalue(), 'image/png'
+
+
+class ImageHost(BaseHTTPRequestHandler):
+    # stands in for the remote image hosts; counts the requests for each path
+    image = sample_image()
+    requests = Counter()
+    hosts = []
+
+    def do_GET(self):
+        self.requests[self.path] += 1
+        self.hosts.append(self.headers['Host'])
+        if self.path != '/band.png':
+            self.send_error(404)
+            return
+        data, content_type = self.image
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ImageProxyTestCase(FyyurTestCase):
+    """Images are fetched once, shrunk, cached on disk and served cacheable."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHost)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.host = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        super().setUp()
+        app.config['IMAGE_PROXY'] = True
+        app.config['IMAGE_CACHE_DIR'] = tempfile.mkdtemp()
+        # the stand-in host is on the loopback address
+        app.config['IMAGE_ALLOW_PRIVATE'] = True
+        ImageHost.requests.clear()
+        del ImageHost.hosts[:]
+        image_failures.clear()
+        with app.app_context():
+            venues = [Venue(name=name, city='San Francisco', state='CA', image_link=self.host + path)
+                      for name, path in (('The Musical Hop', '/band.png'), ('Park Square', '/missing.png'))]
+            db.session.add_all(venues)
+            db.session.commit()
+            self.venues = [(venue.id, venue.image_link) for venue in venues]
+
+    def tearDown(self):
+        app.config['IMAGE_PROXY'] = False
+        app.config['IMAGE_ALLOW_PRIVATE'] = False
+        super().tearDown()
+
+    def image(self, venue=0, size='tile', **headers):
+        with app.test_request_context():
+            url = image_url('venue', *self.venues[venue], size)
+        return self.client().get(url, headers=headers)
+
+    def test_thumbnail_is_fetched_once(self):
+        first, second = self.image(), self.image()
+
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(ImageHost.requests['/band.png'], 1)
+        self.assertEqual(second.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+        if images.Image is not None:
+            self.assertEqual(second.mimetype, 'image/jpeg')
+            self.assertEqual(images.Image.open(io.BytesIO(second.data)).size, (300, 200))
+
+        res = self.image(**{'If-None-Match': second.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
+    def test_failed_fetch_is_not_retried_at_once(self):
+        self.assertEqual(self.image(1).status_code, 404)
+        self.assertEqual(self.image(1).status_code, 404)
+        self.assertEqual(ImageHost.requests['/missing.png'], 1)
+
+    def test_private_addresses_are_refused(self):
+        app.config['IMAGE_ALLOW_PRIVATE'] = False
+
+        self.assertEqual(self.image().status_code, 404)
+        self.assertEqual(ImageHost.requests['/band.png'], 0)
+
+    def test_fetch_connects_to_the_checked_address(self):
+        port = self.server.server_address[1]
+        resolved = []
+        real_getaddrinfo = socket.getaddrinfo
+
+        def getaddrinfo(host, *args, **kwargs):
+            resolved.append(host)
+            return real_getaddrinfo('127.0.0.1', *args, **kwargs)
+
+        with mock.patch('socket.getaddrinfo', getaddrinfo):
+            data, content_type = images.fetch('http://images.example:%d/band.png' % port, 5, 10 ** 7, True)
+            with self.assertRaises(images.ImageError):
+                images.fetch('http://images.example:%d/band.png' % port, 5, 10 ** 7, False)
+
+        self.assertEqual(data, ImageHost.image[0])
+        # the second lookup is the connection's, of the address already checked
+        self.assertEqual(resolved, ['images.example', '127.0.0.1', 'images.example'])
+        self.assertEqual(ImageHost.hosts, ['images.example:%d' % port])
+
+    def test_failed_fetches_are_bounded(self):
+        app.config['IMAGE_FAILURE_ENTRIES'] = 1
+        try:
+            self.image(1)
+            with app.app_context():
+                db.session.add(Venue(name='Dueling Pianos Bar', city='New York', state='NY',
+                                     image_link=self.host + '/gone.png'))
+                db.session.commit()
+                self.venues.append((Venue.query.filter_by(name='Dueling Pianos Bar').one().id,
+                                    self.host + '/gone.png'))
+            self.image(2)
+        finally:
+            app.config['IMAGE_FAILURE_ENTRIES'] = 10000
+
+        self.assertEqual(list(image_failures), ['300x200 %s/gone.png' % self.host])
+
+    def age(self, cache):
+        # the files were all written just now; make them older than the next access
+        for directory, subdirectories, filenames in os.walk(cache.path('objects')):
+            for filename in filenames:
+                os.utime(os.path.join(directory, filename), (time.time() - 3600, time.time() - 3600))
+
+    def test_least_recently_used_files_are_evicted(self):
+        cache = images.DiskCache(tempfile.mkdtemp(), 250)
+        for key in ('a', 'b'):
+            cache.put(key, key.encode() * 100, 'image/png')
+        self.age(cache)
+        cache.get('a')
+        cache.put('c', b'c' * 100, 'image/png')
+
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual(len(os.listdir(cache.path('keys'))), 2)
+
+    def test_workers_share_the_size_limit(self):
+        # one DiskCache per worker process, on the same folder
+        folder = tempfile.mkdtemp()
+        first, second = images.DiskCache(folder, 250), images.DiskCache(folder, 250)
+        first.put('a', b'a' * 100, 'image/png')
+        second.put('b', b'b' * 100, 'image/png')
+        self.age(first)
+        second.get('b')
+        first.put('c', b'c' * 100, 'image/png')
+
+        self.assertEqual([second.get(key) is None for key in 'abc'], [True, False, False])
+        self.assertLessEqual(first.read_size(), 250)
+
+
+class DatetimeFilterTestCase(unittest.TestCase):
+    """The datetime filter formats model datetimes and strings alike."""
+
+    def test_named_formats(self):
+        moment = datetime(2035, 5, 1, 20, 0)
+
+        self.assertEqual(format_datetime(moment, 'full'), 'Tuesday May, 1, 2035 at 8:00PM')
+        self.assertEqual(format_datetime(moment), 'Tue 05, 01, 2035 8:00PM')
+        self.assertEqual(format_datetime(moment, 'yyyy-MM-dd'), '2035-05-01')
+
+    def test_strings_are_parsed(self):
+        self.assertEqual(format_datetime('2035-05-01 20:00:00', 'full'),
+                         format_datetime(datetime(2035, 5, 1, 20, 0), 'full'))
+
+    def test_matches_babel_on_every_format(self):
+        moments = [datetime(2035, 5, 1, 20, 0), datetime(2035, 5, 1, 23, 30, tzinfo=timezone(timedelta(hours=2))),
+                   datetime(2035, 12, 31, 23, 30, tzinfo=babel.dates.UTC)]
+        formats = ['full', 'medium', 'long', 'short', 'yyyy-MM-dd HH:mm zzzz']
+        for moment in moments:
+            for format in formats:
+                for tzinfo in (None, 'Europe/Berlin', 'America/Los_Angeles'):
+                    self.assertEqual(
+                        format_datetime(moment, format, tzinfo=tzinfo),
+                        babel.dates.format_datetime(moment, datetime_formats.get(format, format), tzinfo=tzinfo),
+                        (moment, format, tzinfo))
+
+
+class QueueLoggingTestCase(unittest.TestCase):
+    """Queued records reach the log file, which can be rotated by another process."""
+
+    def write(self, pipeline, message):
+        pipeline.handler.handle(logging.makeLogRecord({'msg': message, 'levelno': logging.ERROR}))
+
+    def test_file_is_reopened_after_rotation(self):
+        folder = tempfile.mkdtemp()
+        filename = os.path.join(folder, 'error.log')
+        pipeline = logqueue.QueueLogging(filename)
+        pipeline.setFormatter(logging.Formatter('%(message)s'))
+        self.write(pipeline, 'before')
+        # logrotate moves the file aside while the workers still hold it open
+        while not os.path.exists(filename) or not os.path.getsize(filename):
+            time.sleep(0.01)
+        os.rename(filename, filename + '.1')
+        self.write(pipeline, 'after')
+        pipeline.stop()
+
+        with open(filename + '.1') as f:
+            self.assertEqual(f.read(), 'before\n')
+        with open(filename) as f:
+            self.assertEqual(f.read(), 'after\n')
+
+
+@unittest.skipIf(recommend.numpy is None, 'suggestions need numpy')
+class SuggestionTestCase(FyyurTestCase):
+    """Venue pages suggest unbooked artists by genre and booking history."""
+
+    def setUp(self):
+        super().setUp()
+        # both outlive the tables dropped by earlier tests
+        detail_cache.clear()
+        suggestions.clear()
+        with app.app_context():
+            venue = Venue(name='The Musical Hop', city='San Francisco', state='CA', genres=['Jazz'])
+            artists = [Artist(name=name, city='San Francisco', state='CA', genres=[genre])
+                       for name, genre in (('Guns N Petals', 'Jazz'), ('The Wild Sax Band', 'Blues'),
+                                           ('Matt Quevedo', 'Rock n Roll'), ('The Sax Pack', 'Blues'))]
+            db.session.add_all([venue] + artists)
+            db.session.commit()
+            self.venue_id = venue.id
+            self.artist_ids = [artist.id for artist in artists]
+
+    def suggested_artist_ids(self):
+        res = self.client().get('/venues/%d' % self.venue_id)
+        self.assertEqual(res.status_code, 200)
+        section = res.get_data(as_text=True).partition('Suggested Artists')[2]
+        return [int(id) for id in re.findall(r'href="/artists/(\d+)"', section)]
+
+    def test_suggests_artists_of_the_venue_genres(self):
+        self.assertEqual(self.suggested_artist_ids(), [self.artist_ids[0]])
+
+    def test_booking_updates_suggestions(self):
+        self.suggested_artist_ids()
+        recommender = suggestions.recommender
+
+        res = self.client().post('/shows/create', data={
+            'venue_id': str(self.venue_id),
+            'artist_id': str(self.artist_ids[1]),
+            'start_time': '2035-04-01 20:00:00',
+        })
+        self.assertEqual(res.status_code, 200)
+
+        # the booked Blues artist is left out and the other one now matches
+        self.assertCountEqual(self.suggested_artist_ids(), [self.artist_ids[0], self.artist_ids[3]])
+        self.assertIs(suggestions.recommender, recommender)
+
+    def test_cached_page_runs_no_queries(self):
+        self.suggested_artist_ids()
+        res = self.client().get('/venues/%d' % self.venue_id)
+
+        self.assertIn(b'Guns N Petals', res.data.partition(b'Suggested Artists')[2])
+        self.assertEqual(res.headers['X-Query-Count'], '0')
+
+    def test_rebuild_waits_for_changes_to_settle(self):
+        self.suggested_artist_ids()
+        recommender = suggestions.recommender
+        # one invalidation per import batch
+        for batch in range(3):
+            suggestions.invalidate()
+        detail_cache.clear()
+        self.suggested_artist_ids()
+        self.assertIs(suggestions.recommender, recommender)
+
+        delay = app.config['SUGGESTION_REBUILD_DELAY']
+        app.config['SUGGESTION_REBUILD_DELAY'] = 0
+        try:
+            detail_cache.clear()
+            self.suggested_artist_ids()
+        finally:
+            app.config['SUGGESTION_REBUILD_DELAY'] = delay
+        self.assertIsNot(suggestions.recommender, recommender)
+
+
+class SessionTestCase(FyyurTestCase):
+    """Session data is kept on the server and read back by any worker."""
+
+    def setUp(self):
+        super().setUp()
+        self.worker_store = app.session_interface.store
+
+    def tearDown(self):
+        app.session_interface.store = self.worker_store
+        super().tearDown()
+
+    def other_worker(self):
+        # a second worker: its own memory tier in front of the same table
+        return sessions.TieredStore(sessions.MemoryStore(10), self.worker_store.shared)
+
+    def session_cookie(self, client):
+        return next(cookie.value for cookie in client.cookie_jar if cookie.name == app.session_cookie_name)
+
+    def test_cookie_only_names_the_session(self):
+        client = self.client()
+        with client.session_transaction() as session:
+            session['band'] = 'The Wild Sax Band'
+
+        self.assertNotIn('Wild', self.session_cookie(client))
+        with app.app_context():
+            self.assertEqual(SessionRecord.query.count(), 1)
+
+    def test_another_worker_reads_the_session(self):
+        client = self.client()
+        with client.session_transaction() as session:
+            session['_flashes'] = [('message', 'Venue The Musical Hop was successfully listed!')]
+
+        app.session_interface.store = self.other_worker()
+        with client.session_transaction() as session:
+            self.assertEqual(session['_flashes'], [('message', 'Venue The Musical Hop was successfully listed!')])
+
+    def test_stale_memory_copy_is_not_used(self):
+        client = self.client()
+        with client.session_transaction() as session:
+            session['page'] = 1
+        app.session_interface.store = self.other_worker()
+        with client.session_transaction() as session:
+            session['page'] = 2
+
+        app.session_interface.store = self.worker_store
+        with client.session_transaction() as session:
+            self.assertEqual(session['page'], 2)
+
+    def test_tampered_cookie_starts_a_new_session(self):
+        client = self.client()
+        with client.session_transaction() as session:
+            session['page'] = 1
+        sid = self.session_cookie(client).rpartition('.')[0]
+        client.set_cookie('localhost', app.session_cookie_name, sid + '.9.forged')
+
+        with client.session_transaction() as session:
+            self.assertNotIn('page', session)
+
+    def test_cleared_session_is_deleted(self):
+        client = self.client()
+        with client.session_transaction() as session:
+            session['page'] = 1
+        with client.session_transaction() as session:
+            session.clear()
+
+        with app.app_context():
+            self.assertEqual(SessionRecord.query.count(), 0)
+
+    def test_stored_secret_key_is_kept(self):
+        path = os.path.join(tempfile.mkdtemp(), 'secret-key')
+        key = sessions.stored_secret_key(path)
+
+        self.assertEqual(sessions.stored_secret_key(path), key)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+
+
+class SyntheticDataTestCase(unittest.TestCase):
+    """The generated catalog is repeatable and skewed like real listings."""
+
+    genres = ['Jazz', 'Rock n Roll', 'Pop', 'Blues', 'Folk']
+
+    def catalog(self, seed):
+        rng = random.Random(seed)
+        venues = list(synthetic.venue_rows(rng, 50, self.genres))
+        artists = list(synthetic.artist_rows(rng, 100, self.genres))
+        shows = list(synthetic.show_rows(rng, 1000, list(range(1, 51)), list(range(1, 101)),
+                                         today=datetime(2035, 5, 1)))
+        return venues, artists, shows
+
+    def test_same_seed_gives_the_same_rows(self):
+        self.assertEqual(self.catalog(1), self.catalog(1))
+        self.assertNotEqual(self.catalog(1), self.catalog(2))
+
+    def test_row_counts(self):
+        venues, artists, shows = self.catalog(1)
+
+        self.assertEqual((len(venues), len(artists), len(shows)), (50, 100, 1000))
+        self.assertEqual(synthetic.dataset_size(1000), (50, 100))
+
+    def test_scarce_venues_cap_the_shows(self):
+        # two venues can hold at most two shows a day
+        shows = list(synthetic.show_rows(random.Random(1), 100, [1, 2], list(range(1, 21)),
+                                         past_days=10, future_days=10))
+
+        self.assertEqual(len(shows), 40)
+        per_day = Counter((show['venue_id'], show['start_time'].date()) for show in shows)
+        self.assertEqual(max(per_day.values()), 1)
+
+    def test_popularity_is_skewed(self):
+        rng = random.Random(1)
+        venues = list(synthetic.venue_rows(rng, 2000, self.genres))
+        shows = list(synthetic.show_rows(rng, 5000, list(range(1, 101)), list(range(1, 201))))
+        cities = Counter(venue['city'] for venue in venues)
+        genres = Counter(venue['genres'][0] for venue in venues)
+        bookings = Counter(show['venue_id'] for show in shows)
+
+        self.assertEqual(cities.most_common(1)[0][0], 'New York')
+        self.assertGreater(cities['New York'], 5 * cities['New Orleans'])
+        self.assertEqual(genres.most_common(1)[0][0], 'Rock n Roll')
+        self.assertGreater(bookings[1], 5 * bookings[100])
+
+
+class BenchmarkTestCase(FyyurTestCase):
+    """flask benchmark generates a catalog and times every route on it."""
+
+    def test_generated_counts_are_the_rows_added(self):
+        with app.app_context():
+            added = generate_catalog(200, 1)
+
+            self.assertEqual(added, (Venue.query.count(), Artist.query.count(), Show.query.count()))
+            self.assertEqual(added[:2], (10, 20))
+
+    def test_benchmark_on_a_small_catalog(self):
+        with mock.patch('benchmark.run', side_effect=benchmark.run) as run, \
+                mock.patch('benchmark.report', side_effect=benchmark.report) as report:
+            result = app.test_cli_runner().invoke(
+                args=['benchmark', '--sizes', '200', '--requests', '1', '--samples', '2', '--yes'])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('generated 10 venues, 20 artists and', result.output)
+        routes = run.call_args[0][1]
+        self.assertIn('lat=', routes['/venues/nearby'][0])
+        self.assertIn('lat=', routes['/api/v1/venues/nearby'][0])
+        results = report.call_args[0][0]
+        self.assertEqual(len(results), len(routes))
+        for row in results:
+            self.assertEqual(row['status'], '200', row['route'])
+
+class TemplateCacheTestCase(unittest.TestCase):
+    """Compiled templates are written to TEMPLATE_CACHE_DIR and reused by the next app."""
+
+    def template_app(self, cache_dir):
+        flask_app = Flask('app', root_path=app.root_path)
+        flask_app.config.update(TEMPLATE_CACHE_DIR=cache_dir, TEMPLATE_PRELOAD=True)
+        flask_app.jinja_env.filters.update(app.jinja_env.filters)
+        flask_app.jinja_env.globals.update(app.jinja_env.globals)
+        return flask_app
+
+    def test_preload_compiles_every_template_into_the_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        flask_app = self.template_app(cache_dir)
+        init_templates(flask_app)
+
+        self.assertEqual(len(os.listdir(cache_dir)), len(flask_app.jinja_env.list_templates()))
+
+    def test_next_app_loads_from_the_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        init_templates(self.template_app(cache_dir))
+
+        flask_app = self.template_app(cache_dir)
+        with mock.patch.object(flask_app.jinja_env, 'compile', side_effect=AssertionError('compiled')):
+            init_templates(flask_app)
+        self.assertEqual(len(flask_app.jinja_env.cache), len(flask_app.jinja_env.list_templates()))
+
+    def test_relative_directory_is_in_the_instance_folder(self):
+        flask_app = self.template_app('template-cache')
+        flask_app.instance_path = tempfile.mkdtemp()
+        flask_app.config['TEMPLATE_PRELOAD'] = False
+        init_templates(flask_app)
+
+        self.assertTrue(os.path.isdir(os.path.join(flask_app.instance_path, 'template-cache')))
+
+
+class AssetTestCase(unittest.TestCase):
+    """flask build-assets output and the /assets/ route that serves it."""
+
+    def setUp(self):
+        self.client = app.test_client
+        self.static_folder = tempfile.mkdtemp()
+        files = {
+            'css/main.css': b'body { background: url("../img/bg.png"); }\n'
+                            b'@font-face { src: url(../fonts/icons.eot?#iefix), url(https://example.com/x.woff); }\n'
+                            + b'.padding { margin: 0; }\n' * 50,
+            'img/bg.png': b'\x89PNG not really',
+            'fonts/icons.eot': b'font ' * 100,
+        }
+        for path, content in files.items():
+            assets.write(os.path.join(self.static_folder, path), content)
+        self.out_folder = os.path.join(self.static_folder, 'dist')
+
+    def test_build_fingerprints_and_rewrites_references(self):
+        manifest = assets.build(self.static_folder, self.out_folder)
+
+        self.assertEqual(sorted(manifest), ['css/main.css', 'fonts/icons.eot', 'img/bg.png'])
+        for path, built in manifest.items():
+            self.assertRegex(built, r'^%s\.[0-9a-f]{12}%s$' % os.path.splitext(path))
+            self.assertTrue(os.path.isfile(os.path.join(self.out_folder, built)))
+        self.assertEqual(assets.load_manifest(self.out_folder), manifest)
+
+        with open(os.path.join(self.out_folder, manifest['css/main.css']), 'rb') as f:
+            css = f.read().decode()
+        self.assertIn('url("../%s")' % manifest['img/bg.png'], css)
+        self.assertIn('url(../%s?#iefix)' % manifest['fonts/icons.eot'], css)
+        self.assertIn('url(https://example.com/x.woff)', css)
+        # the fingerprint is of the rewritten stylesheet
+        self.assertEqual(manifest['css/main.css'], assets.fingerprint('css/main.css', css.encode()))
+
+        built_css = os.path.join(self.out_folder, manifest['css/main.css'])
+        self.assertTrue(os.path.isfile(built_css + '.gz'))
+        self.assertEqual(os.path.isfile(built_css + '.br'), assets.brotli is not None)
+        # too small to be worth compressing
+        self.assertFalse(os.path.isfile(os.path.join(self.out_folder, manifest['img/bg.png']) + '.gz'))
+
+    def test_asset_negotiates_the_encoding(self):
+        built = 'css/main.0123456789ab.css'
+        for suffix, content in (('', b'plain'), ('.gz', b'gzipped'), ('.br', b'brotli')):
+            assets.write(os.path.join(self.out_folder, built + suffix), content)
+
+        with mock.patch('app.asset_folder', self.out_folder):
+            for accept, encoding, content in (('gzip, br', 'br', b'brotli'), ('gzip', 'gzip', b'gzipped'),
+                                              ('identity', None, b'plain')):
+                res = self.client().get('/assets/' + built, headers={'Accept-Encoding': accept})
+
+                self.assertEqual(res.status_code, 200)
+                self.assertEqual(res.data, content)
+                self.assertEqual(res.headers.get('Content-Encoding'), encoding)
+                self.assertEqual(res.mimetype, 'text/css')
+                self.assertEqual(res.headers['Vary'], 'Accept-Encoding')
+                self.assertEqual(res.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+                res.close()
+
+    def test_asset_url_uses_the_manifest(self):
+        with mock.patch('app.asset_manifest', {'css/main.css': 'css/main.0123456789ab.css'}), \
+                app.test_request_context():
+            self.assertEqual(asset_url('css/main.css'), '/assets/css/main.0123456789ab.css')
+            self.assertEqual(asset_url('js/script.js'), '/static/js/script.js')
+
+    def test_asset_url_falls_back_without_the_pipeline(self):
+        # with ASSET_PIPELINE off no manifest is loaded, so pages link static/ directly
+        with mock.patch('app.asset_manifest', {}):
+            res = self.client().get('/')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'href="/static/css/bootstrap.min.css"', res.data)
+        self.assertNotIn(b'/assets/', res.data)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()